@@ -2,8 +2,11 @@ import azure.functions as func
 import os
 import logging
 import datetime
+import uuid
+import json
+from azure.core import MatchConditions
 from azure.identity.aio import DefaultAzureCredential
-from azure.cosmos.aio import CosmosClient
+from auditing.content_store import content_store, AUDIT_CONTENT_STORE, AUDIT_CONTENT_CONTAINER
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 CONTENT_SAFETY_ENDPOINT = os.environ.get("CONTENT_SAFETY_ENDPOINT")
@@ -15,32 +18,156 @@ AZURE_DB_ID=os.environ.get("AZURE_DB_ID")
 AZURE_DB_URI = f"https://{AZURE_DB_ID}.documents.azure.com:443/"
 PLUGINS_FOLDER = f"plugins"
 RESPONSABLE_AI_CHECK=os.environ.get("RESPONSABLE_AI_CHECK", "false").lower() == "true"
+# "append": one item per interaction (container partitioned on /conversation_id)
+# "legacy": one document per conversation, updated with ETag checks
+AUDIT_STORAGE_MODE=os.environ.get("AUDIT_STORAGE_MODE", "legacy").lower()
+AUDIT_LEGACY_CONTAINER=os.environ.get("AUDIT_LEGACY_CONTAINER", "security_logs")
+AUDIT_INTERACTIONS_CONTAINER=os.environ.get("AUDIT_INTERACTIONS_CONTAINER", "security_logs_interactions")
+AUDIT_MAX_ETAG_RETRIES=int(os.environ.get("AUDIT_MAX_ETAG_RETRIES", "5"))
+# Cosmos limits for one transactional batch: operations, and request size (2 MB, with room for the envelope)
+MAX_TRANSACTIONAL_BATCH_OPERATIONS=100
+MAX_TRANSACTIONAL_BATCH_BYTES=2 * 1024 * 1024 - 64 * 1024
+# Characters Cosmos does not accept in an item id
+INVALID_ID_CHARACTERS = ('/', '\\', '?', '#')
+
+def validate_conversation_id(conversation_id):
+    """Raises ValueError for a conversation_id that Cosmos would reject as an item id or partition key."""
+    if not isinstance(conversation_id, str) or not conversation_id.strip():
+        raise ValueError("conversation_id must be a non-empty string")
+    if len(conversation_id) > 255 or any(character in conversation_id for character in INVALID_ID_CHARACTERS):
+        raise ValueError(f"conversation_id must be at most 255 characters without {' '.join(INVALID_ID_CHARACTERS)}")
+
+def build_interaction(question, answer, sources, security_checks):
+    now = datetime.datetime.now()
+    return {
+        "time": now.strftime("%Y-%m-%d %H:%M:%S"),
+        # Sub-second ordering key; "time" keeps the historical format
+        "timestamp": now.timestamp(),
+        'question': question, 
+        'answer': answer, 
+        'sources': sources,
+        "security_checks": security_checks
+    }
 
 async def audit_to_db(conversation_id, question, answer, sources, security_checks):
+    interaction = build_interaction(question, answer, sources, security_checks)
+    # Cosmos is imported when the first audit is written, not at worker start
+    from azure.cosmos.aio import CosmosClient
     async with DefaultAzureCredential() as credential:       
         async with CosmosClient(AZURE_DB_URI, credential=credential) as db_client:
             db = db_client.get_database_client(database=AZURE_DB_NAME)
-            container = db.get_container_client('security_logs')
+            await write_interactions(db, conversation_id, [interaction])
+    return
+
+async def write_interactions(db, conversation_id, interactions):
+    """Stores interactions of one conversation using the configured AUDIT_STORAGE_MODE."""
+    if AUDIT_CONTENT_STORE:
+        interactions = await content_store.externalize(db.get_container_client(AUDIT_CONTENT_CONTAINER), interactions)
+    if AUDIT_STORAGE_MODE == "append":
+        await append_interactions(db.get_container_client(AUDIT_INTERACTIONS_CONTAINER), conversation_id, interactions)
+    else:
+        await append_interactions_legacy(db.get_container_client(AUDIT_LEGACY_CONTAINER), conversation_id, interactions)
+
+def transactional_groups(items):
+    """Splits items into groups within the operation and size limits of a transactional batch."""
+    groups = []
+    size = 0
+    for item in items:
+        item_size = len(json.dumps(item).encode("utf-8"))
+        if not groups or len(groups[-1]) >= MAX_TRANSACTIONAL_BATCH_OPERATIONS or size + item_size > MAX_TRANSACTIONAL_BATCH_BYTES:
+            groups.append([])
+            size = 0
+        groups[-1].append(item)
+        size += item_size
+    return groups
+
+async def append_interactions(container, conversation_id, interactions):
+    """
+    Writes each interaction as its own item: creates only, no read and no contention.
+    Several interactions go in transactional batches on the conversation's partition.
+    """
+    items = [{"id": str(uuid.uuid4()), "conversation_id": conversation_id, "type": "interaction", **interaction}
+             for interaction in interactions]
+    if len(items) == 1:
+        await container.create_item(body=items[0])
+    else:
+        for group in transactional_groups(items):
+            operations = [("create", (item,)) for item in group]
+            await container.execute_item_batch(batch_operations=operations, partition_key=conversation_id)
+    logging.info(f"[orchestrator] conversation {conversation_id} appended {len(items)} interaction(s).")
+
+async def append_interactions_legacy(container, conversation_id, interactions):
+    """
+    Appends to the single conversation document. The replace is conditioned on the
+    ETag that was read, and retried on conflict, so concurrent audits of the same
+    conversation no longer overwrite each other.
+    """
+    from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+    for attempt in range(AUDIT_MAX_ETAG_RETRIES):
+        try:
+            conversation = await container.read_item(item=conversation_id, partition_key=conversation_id)
+            logging.info(f"[orchestrator] conversation {conversation_id} retrieved.")
+        except CosmosResourceNotFoundError:
+            logging.info(f"[orchestrator] customer sent an inexistent conversation_id, saving new conversation_id")        
             try:
-                conversation = await container.read_item(item=conversation_id, partition_key=conversation_id)
-                logging.info(f"[orchestrator] conversation {conversation_id} retrieved.")
-            except Exception as e:
-                logging.info(f"[orchestrator] customer sent an inexistent conversation_id, saving new conversation_id")        
                 conversation = await container.create_item(body={"id": conversation_id})
-            # get conversation data
-            conversation_data = conversation.get('conversation_data', 
-                                                {'start_date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'interactions': []})
-            # Append the question and answer to the respective arrays
-            interaction = {
-                "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                'question': question, 
-                'answer': answer, 
-                'sources': sources,
-                "security_checks": security_checks
-            }
-            conversation_data['interactions'].append(interaction)
-            conversation['conversation_data'] = conversation_data
-            # Update the item in the container
-            await container.replace_item(item=conversation, body=conversation)
-            logging.info(f"[orchestrator] conversation {conversation_id} updated with new interaction.")
-    return   
\ No newline at end of file
+            except CosmosResourceExistsError:
+                # Created concurrently by another audit; read it on the next attempt
+                continue
+        # get conversation data
+        conversation_data = conversation.get('conversation_data', 
+                                            {'start_date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'interactions': []})
+        conversation_data['interactions'].extend(interactions)
+        conversation['conversation_data'] = conversation_data
+        try:
+            # Update the item in the container only if nobody changed it since we read it
+            await container.replace_item(item=conversation, body=conversation,
+                                         etag=conversation.get('_etag'), match_condition=MatchConditions.IfNotModified)
+            logging.info(f"[orchestrator] conversation {conversation_id} updated with {len(interactions)} new interaction(s).")
+            return
+        except CosmosAccessConditionFailedError:
+            logging.info(f"[orchestrator] conversation {conversation_id} changed concurrently, retrying ({attempt + 1}/{AUDIT_MAX_ETAG_RETRIES})")
+    raise Exception(f"Could not update conversation {conversation_id} after {AUDIT_MAX_ETAG_RETRIES} attempts")
+
+async def read_conversation(conversation_id):
+    """
+    Rebuilds the conversation view ({"id", "conversation_data": {"start_date",
+    "interactions"}}) from the legacy document and the per-interaction items,
+    with the passages kept in the content container put back in place.
+    """
+    from azure.cosmos.aio import CosmosClient
+    async with DefaultAzureCredential() as credential:       
+        async with CosmosClient(AZURE_DB_URI, credential=credential) as db_client:
+            db = db_client.get_database_client(database=AZURE_DB_NAME)
+            return await read_conversation_from(db.get_container_client(AUDIT_LEGACY_CONTAINER),
+                                                db.get_container_client(AUDIT_INTERACTIONS_CONTAINER),
+                                                conversation_id,
+                                                db.get_container_client(AUDIT_CONTENT_CONTAINER))
+
+async def read_conversation_from(legacy_container, interactions_container, conversation_id, content_container=None):
+    from azure.cosmos.exceptions import CosmosResourceNotFoundError
+    interactions = []
+    start_date = None
+    try:
+        legacy = await legacy_container.read_item(item=conversation_id, partition_key=conversation_id)
+        legacy_data = legacy.get('conversation_data', {})
+        start_date = legacy_data.get('start_date')
+        interactions.extend(legacy_data.get('interactions', []))
+    except CosmosResourceNotFoundError:
+        pass
+    try:
+        query = "SELECT * FROM c WHERE c.conversation_id = @conversation_id AND c.type = 'interaction'"
+        items = interactions_container.query_items(query=query, parameters=[{"name": "@conversation_id", "value": conversation_id}],
+                                                   partition_key=conversation_id)
+        appended = [item async for item in items]
+    except CosmosResourceNotFoundError:
+        appended = []
+    appended.sort(key=lambda item: item.get("timestamp", 0))
+    for item in appended:
+        interactions.append({key: value for key, value in item.items()
+                             if key not in ("id", "conversation_id", "type") and not key.startswith("_")})
+    if content_container is not None:
+        interactions = await content_store.rehydrate(content_container, interactions)
+    if start_date is None and interactions:
+        start_date = interactions[0].get("time")
+    return {"id": conversation_id, "conversation_data": {"start_date": start_date, "interactions": interactions}}
@@ -0,0 +1,180 @@
+import os
+import re
+import gzip
+import base64
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+# Store long passages of the audited fields once, by hash, in a side container
+AUDIT_CONTENT_STORE = os.environ.get("AUDIT_CONTENT_STORE", "false").lower() == "true"
+# Partitioned on /id
+AUDIT_CONTENT_CONTAINER = os.environ.get("AUDIT_CONTENT_CONTAINER", "security_logs_content")
+AUDIT_CONTENT_FIELDS = [field.strip() for field in os.environ.get("AUDIT_CONTENT_FIELDS", "sources,answer").split(",") if field.strip()]
+# "gzip", or "zstd" when the zstandard package is installed
+AUDIT_CONTENT_COMPRESSION = os.environ.get("AUDIT_CONTENT_COMPRESSION", "gzip").lower()
+# Shorter passages stay inline; a reference would cost about as much as the text
+AUDIT_CONTENT_MIN_BYTES = int(os.environ.get("AUDIT_CONTENT_MIN_BYTES", "256"))
+# Hashes this worker knows are stored, so repeated passages are not written again
+AUDIT_CONTENT_KNOWN_HASHES = int(os.environ.get("AUDIT_CONTENT_KNOWN_HASHES", "10000"))
+# Blank lines between passages, kept inline so the text is rebuilt exactly
+_PASSAGE_BREAK = re.compile(r"(\n[ \t]*\n\s*)")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def _compress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+def _decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("content item is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+def _groups(reference):
+    """The part lists of a field reference: one for a string, one per item for a list."""
+    return [reference["parts"]] if reference["type"] == "str" else reference["items"]
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ContentStore:
+    """
+    Content-addressed storage for the large fields of audited interactions.
+
+    `externalize` splits each configured field (the answer, each source) into
+    passages on blank lines and replaces every passage of AUDIT_CONTENT_MIN_BYTES
+    or more with {"ref": <sha256>}. The passage itself is written, compressed, to
+    the content container under its hash, once for all interactions and
+    conversations. The references go in the interaction's "content_refs", and
+    `rehydrate` puts the original fields back when the conversation is read.
+    Interactions written without references are returned as they are.
+    """
+
+    def __init__(self, fields=AUDIT_CONTENT_FIELDS, compression=AUDIT_CONTENT_COMPRESSION, min_bytes=AUDIT_CONTENT_MIN_BYTES):
+        if compression == "zstd" and zstandard is None:
+            logging.warning("[content_store] zstandard is not installed, compressing with gzip")
+            compression = "gzip"
+        self.fields = fields
+        self.compression = compression
+        self.min_bytes = min_bytes
+        self._known = OrderedDict()
+        self.passages_written = 0
+        self.passages_reused = 0
+        self.bytes_written = 0
+
+    def _parts(self, text, passages):
+        parts = []
+        for part in _PASSAGE_BREAK.split(text):
+            if len(part.encode("utf-8")) < self.min_bytes:
+                if part:
+                    parts.append(part)
+                continue
+            digest = content_hash(part)
+            passages[digest] = part
+            parts.append({"ref": digest})
+        return parts
+
+    def _reference(self, value, passages):
+        if isinstance(value, str):
+            reference = {"type": "str", "parts": self._parts(value, passages)}
+        elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+            reference = {"type": "list", "items": [self._parts(item, passages) for item in value]}
+        else:
+            # Anything else is structured; it stays inline
+            return None
+        # Fields with no passage long enough to reference stay inline too
+        return reference if any(isinstance(part, dict) for parts in _groups(reference) for part in parts) else None
+
+    async def externalize(self, container, interactions):
+        """Writes the passages of `interactions` and returns copies that reference them."""
+        passages = {}
+        externalized = []
+        for interaction in interactions:
+            interaction = dict(interaction)
+            refs = {}
+            for field in self.fields:
+                reference = self._reference(interaction.get(field), passages)
+                if reference is not None:
+                    refs[field] = reference
+                    del interaction[field]
+            if refs:
+                interaction["content_refs"] = refs
+            externalized.append(interaction)
+        # Passages first: an interaction is never stored with a reference to nothing
+        await asyncio.gather(*(self._write(container, digest, text) for digest, text in passages.items()))
+        return externalized
+
+    async def _write(self, container, digest, text):
+        if digest in self._known:
+            self._known.move_to_end(digest)
+            self.passages_reused += 1
+            return
+        from azure.cosmos.exceptions import CosmosResourceExistsError
+        data = base64.b64encode(_compress(text.encode("utf-8"), self.compression)).decode("ascii")
+        try:
+            await container.create_item(body={"id": digest, "codec": self.compression, "data": data, "length": len(text)})
+            self.passages_written += 1
+            self.bytes_written += len(data)
+        except CosmosResourceExistsError:
+            # Stored earlier by this or another worker; content addressing makes that the same passage
+            self.passages_reused += 1
+        self._known[digest] = True
+        if len(self._known) > AUDIT_CONTENT_KNOWN_HASHES:
+            self._known.popitem(last=False)
+
+    async def _read(self, container, digest):
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            item = await container.read_item(item=digest, partition_key=digest)
+        except CosmosResourceNotFoundError:
+            return None
+        return _decompress(base64.b64decode(item["data"]), item.get("codec", "gzip")).decode("utf-8")
+
+    async def rehydrate(self, container, interactions):
+        """Returns `interactions` with referenced fields rebuilt; each passage is read once."""
+        digests = {part["ref"] for interaction in interactions
+                   for reference in interaction.get("content_refs", {}).values()
+                   for parts in _groups(reference)
+                   for part in parts if isinstance(part, dict)}
+        if not digests:
+            return interactions
+        digests = list(digests)
+        texts = dict(zip(digests, await asyncio.gather(*(self._read(container, digest) for digest in digests))))
+        missing = [digest for digest, text in texts.items() if text is None]
+        if missing:
+            logging.warning(f"[content_store] {len(missing)} referenced passage(s) not found; those fields keep their references")
+        rebuilt = []
+        for interaction in interactions:
+            refs = interaction.get("content_refs")
+            if not refs:
+                rebuilt.append(interaction)
+                continue
+            interaction = dict(interaction)
+            unresolved = {}
+            for field, reference in refs.items():
+                groups = _groups(reference)
+                if any(isinstance(part, dict) and texts.get(part["ref"]) is None for parts in groups for part in parts):
+                    unresolved[field] = reference
+                    continue
+                values = ["".join(texts[part["ref"]] if isinstance(part, dict) else part for part in parts) for parts in groups]
+                interaction[field] = values[0] if reference["type"] == "str" else values
+            if unresolved:
+                interaction["content_refs"] = unresolved
+            else:
+                del interaction["content_refs"]
+            rebuilt.append(interaction)
+        return rebuilt
+
+    def stats(self):
+        return {"passages_written": self.passages_written, "passages_reused": self.passages_reused,
+                "bytes_written": self.bytes_written}
+
+content_store = ContentStore()
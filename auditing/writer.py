@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import glob
+import atexit
+import signal
+import socket
+import asyncio
+import logging
+import tempfile
+import itertools
+from shared.identity import get_azure_credential
+import auditing.audit as audit
+
+AUDIT_BUFFERED = os.environ.get("AUDIT_BUFFERED", "true").lower() == "true"
+AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", "1000"))
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "100"))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.environ.get("AUDIT_FLUSH_INTERVAL_SECONDS", "1"))
+AUDIT_WRITE_RETRIES = int(os.environ.get("AUDIT_WRITE_RETRIES", "3"))
+# Spilled records must outlive the instance that spilled them: on Azure Functions
+# (WEBSITE_INSTANCE_ID is set) the default is the persistent %HOME%/data share that
+# every instance mounts, elsewhere the temp directory
+AUDIT_DATA_DIR = os.environ.get("AUDIT_DATA_DIR") or (
+    os.path.join(os.environ["HOME"], "data", "securityhub-audit")
+    if os.environ.get("WEBSITE_INSTANCE_ID") and os.environ.get("HOME") else tempfile.gettempdir())
+# Each worker process spills to its own file, <name>.<host>-<pid>.ndjson; any process replays them all
+AUDIT_SPILL_FILE = os.environ.get("AUDIT_SPILL_FILE") or os.path.join(AUDIT_DATA_DIR, "securityhub-audit-spill.ndjson")
+# Records Cosmos rejected for good (a non-retryable 4xx); kept for inspection, never replayed
+AUDIT_DEAD_LETTER_FILE = os.environ.get("AUDIT_DEAD_LETTER_FILE") or os.path.join(AUDIT_DATA_DIR, "securityhub-audit-deadletter.ndjson")
+# Time given to the final flush when the worker is stopped (SIGTERM on scale-in)
+AUDIT_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("AUDIT_SHUTDOWN_TIMEOUT_SECONDS", "5"))
+# A replay file this old whose owner cannot be checked is taken over at start
+AUDIT_REPLAY_STALE_SECONDS = float(os.environ.get("AUDIT_REPLAY_STALE_SECONDS", "60"))
+# Cosmos statuses below 500 that are worth retrying: timeout, throttling, retry-with
+RETRYABLE_STATUS_CODES = (408, 429, 449)
+
+# Unique across the instances sharing AUDIT_DATA_DIR
+PROCESS_ID = f"{socket.gethostname()}-{os.getpid()}"
+_replay_numbers = itertools.count()
+
+def _process_file(path):
+    root, extension = os.path.splitext(path)
+    return f"{root}.{PROCESS_ID}{extension}"
+
+def _replay_owner_alive(replay_file):
+    """False when the process that claimed `replay_file` is gone; None when it cannot be told."""
+    owner = os.path.basename(replay_file)[len(os.path.basename(AUDIT_SPILL_FILE)) + 1:-len(".replay")].rsplit(".", 1)[0]
+    host, _, pid = owner.rpartition("-")
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def retryable(error):
+    """Whether a failed write may succeed later; a 4xx other than throttling never will."""
+    status_code = getattr(error, "status_code", None)
+    return status_code is None or status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+
+class AuditWriter:
+    """
+    Buffers audit records in memory and writes them to Cosmos in the background.
+
+    `submit` never waits on Cosmos: records go into a bounded queue, or to a local
+    spill file when the queue is full. The flusher groups queued records by
+    conversation and writes each group in one call through a long-lived client.
+    Groups that still fail after retries are spilled too, unless Cosmos rejected
+    them outright (a non-retryable 4xx): those go to the dead-letter file at once.
+    Spilled records are re-queued when there is room, and `close` drains the
+    queue before returning. `close` also runs on SIGTERM, which is how a scaled-in
+    worker is stopped, and at exit.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._loop = None
+        self._flusher = None
+        self._db_client = None
+        self._closing = False
+        self.written = 0
+        self.spilled = 0
+        self.dead_lettered = 0
+        self.failed_batches = 0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._queue = asyncio.Queue(maxsize=AUDIT_QUEUE_SIZE)
+            self._loop = loop
+            self._flusher = None
+            self._db_client = None
+        if self._flusher is None or self._flusher.done():
+            self._closing = False
+            self._flusher = asyncio.create_task(self._run())
+            _install_sigterm_handler(loop)
+
+    def submit(self, conversation_id, question, answer, sources, security_checks):
+        """
+        Accepts a record; returns "queued" or "spilled". Raises ValueError for a
+        record that could never be written, so the caller can reject it.
+        """
+        audit.validate_conversation_id(conversation_id)
+        self._ensure_started()
+        record = {"conversation_id": conversation_id,
+                  "interaction": audit.build_interaction(question, answer, sources, security_checks)}
+        try:
+            self._queue.put_nowait(record)
+            return "queued"
+        except asyncio.QueueFull:
+            logging.warning("[audit_writer] queue full, spilling record to disk")
+            self._spill([record])
+            return "spilled"
+
+    async def _get_db(self):
+        if self._db_client is None:
+            from azure.cosmos.aio import CosmosClient
+            self._db_client = CosmosClient(audit.AZURE_DB_URI, credential=get_azure_credential())
+        return self._db_client.get_database_client(database=audit.AZURE_DB_NAME)
+
+    async def _run(self):
+        # Also takes over replay files a dead process claimed but never re-queued
+        self._replay_spill(leftovers=True)
+        while not (self._closing and self._queue.empty()):
+            batch = await self._collect()
+            if batch:
+                try:
+                    await self._flush(batch)
+                except Exception as e:
+                    logging.error(f"[audit_writer] flush failed, spilling {len(batch)} record(s): {e}")
+                    self._spill(batch)
+            elif not self._closing:
+                self._replay_spill()
+
+    async def _collect(self):
+        """Waits for a first record, then gathers more for up to the flush interval."""
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self._queue.get(), timeout=AUDIT_FLUSH_INTERVAL_SECONDS))
+        except asyncio.TimeoutError:
+            return batch
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL_SECONDS
+        try:
+            while len(batch) < AUDIT_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if self._closing or remaining <= 0:
+                    # Draining: take whatever is already queued without waiting
+                    try:
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            self._spill(batch)
+            raise
+        return batch
+
+    async def _flush(self, batch):
+        groups = {}
+        for record in batch:
+            groups.setdefault(record["conversation_id"], []).append(record)
+        pending = list(groups.items())
+        try:
+            db = await self._get_db()
+            while pending:
+                conversation_id, records = pending[0]
+                await self._write_group(db, conversation_id, records)
+                pending.pop(0)
+        except asyncio.CancelledError:
+            # Stopped mid-flush (shutdown timeout): keep what was not written for the next worker
+            self._spill([record for _, records in pending for record in records])
+            raise
+
+    async def _write_group(self, db, conversation_id, records):
+        interactions = [record["interaction"] for record in records]
+        for attempt in range(AUDIT_WRITE_RETRIES):
+            try:
+                await audit.write_interactions(db, conversation_id, interactions)
+                self.written += len(records)
+                return
+            except Exception as e:
+                logging.warning(f"[audit_writer] write for conversation {conversation_id} failed ({attempt + 1}/{AUDIT_WRITE_RETRIES}): {e}")
+                if not retryable(e):
+                    logging.error(f"[audit_writer] dead-lettering {len(records)} record(s) of conversation {conversation_id}")
+                    self.failed_batches += 1
+                    self._dead_letter(records, e)
+                    return
+                if attempt + 1 < AUDIT_WRITE_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        self.failed_batches += 1
+        self._spill(records)
+
+    def _append(self, path, records):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(_process_file(path), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def _spill(self, records):
+        self._append(AUDIT_SPILL_FILE, records)
+        self.spilled += len(records)
+
+    def _dead_letter(self, records, error):
+        self._append(AUDIT_DEAD_LETTER_FILE, [dict(record, error=str(error)) for record in records])
+        self.dead_lettered += len(records)
+
+    def _claim_spills(self, leftovers=False):
+        """
+        Takes the spill files of every process (and the single file older versions
+        wrote) by renaming each to a replay file of this process's own; a file
+        another process renamed first is left to it, so no record is read twice or
+        lost. With `leftovers`, replay files whose owner died before re-queuing them
+        are taken over the same way.
+        """
+        root, extension = os.path.splitext(AUDIT_SPILL_FILE)
+        paths = [AUDIT_SPILL_FILE, *glob.glob(f"{glob.escape(root)}.*{extension}")]
+        if leftovers:
+            paths += [path for path in glob.glob(f"{glob.escape(root)}*.replay") if self._abandoned(path)]
+        claimed = []
+        for path in paths:
+            replay_file = f"{AUDIT_SPILL_FILE}.{PROCESS_ID}.{next(_replay_numbers)}.replay"
+            try:
+                os.rename(path, replay_file)
+            except OSError:
+                continue
+            claimed.append(replay_file)
+        return claimed
+
+    @staticmethod
+    def _abandoned(replay_file):
+        alive = _replay_owner_alive(replay_file)
+        if alive is not None:
+            return not alive
+        # Another instance's file: its owner re-queues within moments of claiming it
+        try:
+            return time.time() - os.stat(replay_file).st_ctime >= AUDIT_REPLAY_STALE_SECONDS
+        except OSError:
+            return False
+
+    def _replay_spill(self, leftovers=False):
+        if self._queue.full():
+            return
+        records = []
+        for replay_file in self._claim_spills(leftovers):
+            try:
+                with open(replay_file, encoding="utf-8") as spill:
+                    records.extend(json.loads(line) for line in spill if line.strip())
+                os.remove(replay_file)
+            except (OSError, ValueError) as e:
+                logging.warning(f"[audit_writer] could not read spill file {replay_file}: {e}")
+        if not records:
+            return
+        overflow = []
+        for record in records:
+            try:
+                self._queue.put_nowait(record)
+            except asyncio.QueueFull:
+                overflow.append(record)
+        if overflow:
+            self._spill(overflow)
+        logging.info(f"[audit_writer] re-queued {len(records) - len(overflow)} spilled record(s)")
+
+    async def close(self):
+        """Drains the queue, then closes the Cosmos client."""
+        if self._flusher is not None and self._loop is asyncio.get_running_loop():
+            self._closing = True
+            await self._flusher
+        if self._db_client is not None:
+            await self._db_client.close()
+            self._db_client = None
+
+    def spill_pending(self):
+        """Synchronously moves anything still queued to the spill file (used at exit)."""
+        records = []
+        while self._queue is not None and not self._queue.empty():
+            records.append(self._queue.get_nowait())
+        if records:
+            self._spill(records)
+
+    def stats(self):
+        return {"queue_depth": self._queue.qsize() if self._queue is not None else 0, "written": self.written,
+                "spilled": self.spilled, "dead_lettered": self.dead_lettered, "failed_batches": self.failed_batches}
+
+audit_writer = AuditWriter()
+
+_sigterm_loops = set()
+
+def _install_sigterm_handler(loop):
+    """
+    Flushes the queue when the worker gets SIGTERM, then hands the signal to the
+    handler that was there before. Python runs no atexit handlers on SIGTERM.
+    """
+    if loop in _sigterm_loops:
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(_drain_on_sigterm(loop, previous)))
+    except (NotImplementedError, RuntimeError, ValueError) as e:
+        # Not the main thread, or no signal support on this platform
+        logging.info(f"[audit_writer] no SIGTERM handler installed: {e}")
+        return
+    _sigterm_loops.add(loop)
+
+async def _drain_on_sigterm(loop, previous):
+    logging.info(f"[audit_writer] SIGTERM: flushing {audit_writer.stats()['queue_depth']} queued record(s)")
+    try:
+        await asyncio.wait_for(audit_writer.close(), timeout=AUDIT_SHUTDOWN_TIMEOUT_SECONDS)
+    except Exception as e:
+        logging.warning(f"[audit_writer] error draining audit queue on SIGTERM: {e}")
+    audit_writer.spill_pending()
+    loop.remove_signal_handler(signal.SIGTERM)
+    _sigterm_loops.discard(loop)
+    signal.signal(signal.SIGTERM, previous if previous is not None else signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def _drain_on_exit():
+    loop = audit_writer._loop
+    if loop is not None and not loop.is_closed() and not loop.is_running():
+        try:
+            loop.run_until_complete(audit_writer.close())
+        except Exception as e:
+            logging.warning(f"[audit_writer] error draining audit queue on shutdown: {e}")
+    # Whatever could not be written is kept on disk and replayed by the next worker
+    audit_writer.spill_pending()
+
+atexit.register(_drain_on_exit)
@@ -0,0 +1,304 @@
+"""
+Offline benchmark for the security checks.
+
+Starts the local stub server (benchmarks/stub_server.py) in-process, points the
+function code at it and replays question / answer / audit payloads at a fixed
+concurrency. Reports p50/p95/p99 latency, backend calls per request and memory.
+
+Secrets and audits go through the function code's own entry points (get_secret,
+the buffered audit writer or audit_to_db); only the Key Vault and Cosmos SDK
+clients are replaced by stand-ins that call the stub. The fairness check is not
+exercised: the stub has no Azure OpenAI route, so RESPONSABLE_AI_CHECK stays off.
+
+    python -m benchmarks.harness --requests 200 --concurrency 16 --latency-ms 40 --throttle-rate 0.05
+    python -m benchmarks.harness --replay captured.ndjson --scenario answer
+    python -m benchmarks.harness --scenario question --endpoints 2 --slow-rate 0.02 --slow-ms 1500
+
+Replay files are NDJSON, one request body per line, as sent to /QuestionChecks,
+/AnswerChecks or /Audit. The scenario of each line is taken from its "route" field
+if present, otherwise from its keys. Without --replay, payloads are built from the
+curl templates in request_templates/ with generated text.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import functools
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+TEMPLATES_DIR = os.path.join(REPO_ROOT, "request_templates")
+SCENARIOS = ("question", "answer", "audit")
+TEMPLATE_FILES = {"question": "question_checks", "answer": "answer_checks", "audit": "audit"}
+WORDS = ("the", "policy", "covers", "claims", "submitted", "within", "thirty", "days", "of", "service",
+         "members", "may", "request", "a", "review", "by", "contacting", "support", "and", "providing",
+         "their", "reference", "number", "benefits", "apply", "to", "all", "plans", "except", "where", "noted")
+
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+##########################################################
+# PAYLOADS
+##########################################################
+
+def read_template(scenario):
+    """Returns the JSON body of a curl template in request_templates/."""
+    with open(os.path.join(TEMPLATES_DIR, TEMPLATE_FILES[scenario]), encoding="utf-8") as f:
+        match = re.search(r"--data '(.*)'", f.read(), re.DOTALL)
+    return json.loads(match.group(1))
+
+def generate_text(rng, chars, attack_rate=0.0):
+    words = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    text = " ".join(words)[:chars]
+    if rng.random() < attack_rate:
+        from benchmarks.stub_server import ATTACK_MARKER
+        text = f"{ATTACK_MARKER} {text}"
+    return text
+
+def generate_sources(rng, chars, pool, attack_rate=0.0):
+    """Sources built from passages of `pool`, as retrieval returns the same passages again and again."""
+    passages = []
+    length = 0
+    while length < chars:
+        passages.append(rng.choice(pool))
+        length += len(passages[-1]) + 2
+    text = "\n\n".join(passages)
+    if rng.random() < attack_rate:
+        from benchmarks.stub_server import ATTACK_MARKER
+        text = f"{ATTACK_MARKER} {text}"
+    return text
+
+def generate_payloads(scenario, args, rng):
+    """Fills the template's fields with generated text; --repeat-rate re-sends earlier payloads."""
+    template = read_template(scenario)
+    pool = [generate_text(rng, args.passage_chars) for _ in range(args.source_pool)]
+    sizes = {"question": args.question_chars, "answer": args.answer_chars, "sources": args.sources_chars}
+    payloads = []
+    for i in range(args.requests):
+        if payloads and rng.random() < args.repeat_rate:
+            payloads.append(rng.choice(payloads))
+            continue
+        payload = dict(template)
+        for field in payload:
+            if field == "sources" and pool:
+                payload[field] = generate_sources(rng, sizes[field], pool, args.attack_rate)
+            elif field in sizes:
+                payload[field] = generate_text(rng, sizes[field], args.attack_rate)
+        if "conversation_id" in payload:
+            payload["conversation_id"] = f"bench-{rng.randrange(args.conversations)}"
+        if "security_checks" in payload:
+            payload["security_checks"] = {"results": {"promptShield(Question)": "Passed"}, "details": {}}
+        payloads.append(payload)
+    return payloads
+
+def scenario_of(record):
+    route = str(record.get("route", "")).lower()
+    for scenario, template in TEMPLATE_FILES.items():
+        if template.replace("_", "") in route.replace("_", ""):
+            return scenario
+    if "conversation_id" in record or "security_checks" in record:
+        return "audit"
+    return "answer" if "answer" in record else "question"
+
+def read_replay(path):
+    payloads = {scenario: [] for scenario in SCENARIOS}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                payloads[scenario_of(record)].append(record)
+    return payloads
+
+##########################################################
+# RUN
+##########################################################
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def configure_environment(base_url, args):
+    """Points the function code at the stub. Must run before the service modules are imported."""
+    os.environ["APIM_ENABLED"] = "true"
+    os.environ["APIM_ENDPOINT"] = base_url
+    os.environ.setdefault("AZURE_KEY_VAULT_NAME", "stub")
+    os.environ.setdefault("RESPONSABLE_AI_CHECK", "false")
+    os.environ.setdefault("SECRET_CACHE_TTL_SECONDS", "86400")
+    os.environ.setdefault("AZURE_DB_NAME", "stub")
+    os.environ["AUDIT_BUFFERED"] = "true" if args.audit_mode == "buffered" else "false"
+    # Spill and dead-letter files of this run only
+    os.environ.setdefault("AUDIT_DATA_DIR", tempfile.mkdtemp(prefix="securityhub-bench-"))
+    if args.no_cache:
+        os.environ["VERDICT_CACHE_ENABLED"] = "false"
+    if args.content_store:
+        os.environ["AUDIT_CONTENT_STORE"] = "true"
+    if args.endpoints > 1:
+        os.environ["CONTENT_SAFETY_ENDPOINTS"] = ",".join(f"{base_url}/r{index}" for index in range(args.endpoints))
+
+def install_stub_clients(session, base_url):
+    """
+    Replaces the Key Vault and Cosmos SDK clients with stand-ins that call the stub.
+    The function code imports them on first use, so it picks up the stand-ins.
+    """
+    import azure.cosmos.aio
+    import azure.keyvault.secrets.aio
+    from benchmarks.stub_cosmos import StubCosmosClient
+    from benchmarks.stub_keyvault import StubSecretClient
+    azure.keyvault.secrets.aio.SecretClient = functools.partial(StubSecretClient, session, base_url)
+    azure.cosmos.aio.CosmosClient = functools.partial(StubCosmosClient, session, base_url)
+
+def make_handler(scenario):
+    """Returns (handler, drain): `drain()`, if not None, waits for work the handler left in the background."""
+    if scenario == "question":
+        from safety_checks.check_execution import question_checks
+        return lambda payload: question_checks(payload.get("question", "")), None
+    if scenario == "answer":
+        from safety_checks.check_execution import answer_checks
+        return lambda payload: answer_checks(payload.get("answer", ""), payload.get("question", ""), payload.get("sources", "")), None
+    import auditing.audit as audit
+    from auditing.writer import audit_writer, AUDIT_BUFFERED
+
+    def fields(payload):
+        return (payload.get("conversation_id") or "bench-0", payload.get("question", ""), payload.get("answer", ""),
+                payload.get("sources", ""), payload.get("security_checks", ""))
+
+    if AUDIT_BUFFERED:
+        # As /Audit does: the request only queues the record, the writer flushes it
+        async def submit(payload):
+            audit_writer.submit(*fields(payload))
+        return submit, audit_writer.close
+    return lambda payload: audit.audit_to_db(*fields(payload)), None
+
+async def run_scenario(scenario, payloads, handler, concurrency, state, drain=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    calls_before = dict(state.calls)
+
+    async def one(payload):
+        nonlocal errors
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                await handler(payload)
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - start_time) * 1000)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(one(payload) for payload in payloads))
+    elapsed = time.perf_counter() - start_time
+    drain_time = None
+    if drain is not None:
+        await drain()
+        drain_time = time.perf_counter() - start_time - elapsed
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = {operation: count - calls_before.get(operation, 0) for operation, count in state.calls.items()
+             if count != calls_before.get(operation, 0)}
+    requests = len(payloads)
+    return {
+        "scenario": scenario,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "calls_per_request": round(sum(calls.values()) / requests, 2),
+        "calls": calls,
+        "peak_traced_mb": round(peak / 1024 / 1024, 2),
+        "drain_ms": round(drain_time * 1000, 2) if drain_time is not None else None,
+    }
+
+def print_report(report):
+    print(f"{'scenario':<10}{'requests':>9}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'calls/req':>11}{'peak MB':>9}")
+    for result in report["scenarios"]:
+        print(f"{result['scenario']:<10}{result['requests']:>9}{result['errors']:>8}{result['throughput_rps']:>9}"
+              f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result['calls_per_request']:>11}{result['peak_traced_mb']:>9}")
+        for operation, count in sorted(result["calls"].items()):
+            print(f"    {operation:<40}{count:>8}")
+        if result["drain_ms"] is not None:
+            print(f"    background writes drained in {result['drain_ms']} ms")
+    print(f"max RSS: {report['max_rss_mb']} MB")
+    print(f"stored bytes per container: {report['stored_bytes']}")
+    if report["hedging"]:
+        print(f"hedged calls: {report['hedging']}")
+
+async def main(args):
+    import aiohttp
+    from benchmarks.stub_server import StubConfig, start_stub_server
+
+    config = StubConfig(args.latency_ms, args.throttle_rate, args.error_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    runner, base_url, state = await start_stub_server(config)
+    configure_environment(base_url, args)
+    rng = random.Random(args.seed)
+    if args.replay:
+        payloads = read_replay(args.replay)
+    else:
+        payloads = {scenario: generate_payloads(scenario, args, rng) for scenario in SCENARIOS}
+    results = []
+    async with aiohttp.ClientSession() as session:
+        install_stub_clients(session, base_url)
+        for scenario in args.scenario or SCENARIOS:
+            if payloads[scenario]:
+                handler, drain = make_handler(scenario)
+                results.append(await run_scenario(scenario, payloads[scenario], handler, args.concurrency, state, drain))
+    from shared.clients import content_safety_clients
+    from shared.rate_limiter import content_safety_scheduler
+    await content_safety_clients.close()
+    await runner.cleanup()
+    # ru_maxrss is in KB on Linux
+    report = {"scenarios": results, "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+              "stored_bytes": state.stored_bytes(), "hedging": content_safety_scheduler.stats()["hedging"]}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the security checks against a local stub")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="repeatable; default runs all")
+    parser.add_argument("--replay", help="NDJSON file of request bodies to replay")
+    parser.add_argument("--requests", type=int, default=100, help="generated requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of Content Safety calls to the first endpoint that are slow")
+    parser.add_argument("--slow-ms", type=float, default=1000, help="extra latency of a slow call")
+    parser.add_argument("--endpoints", type=int, default=1, help="stub regions to spread Content Safety calls over")
+    parser.add_argument("--attack-rate", type=float, default=0.0, help="share of generated texts the stub flags")
+    parser.add_argument("--repeat-rate", type=float, default=0.0, help="share of generated requests that repeat an earlier one")
+    parser.add_argument("--question-chars", type=int, default=200)
+    parser.add_argument("--answer-chars", type=int, default=3000)
+    parser.add_argument("--sources-chars", type=int, default=20000)
+    parser.add_argument("--conversations", type=int, default=10, help="distinct conversation ids used by audit")
+    parser.add_argument("--source-pool", type=int, default=0,
+                        help="build sources from a pool of this many passages instead of unique text")
+    parser.add_argument("--passage-chars", type=int, default=1000, help="size of each pooled source passage")
+    parser.add_argument("--content-store", action="store_true", help="store audited passages once in the content container")
+    parser.add_argument("--audit-mode", choices=("buffered", "direct"), default="buffered",
+                        help="queue audits for the background writer (AUDIT_BUFFERED) or write each one with audit_to_db")
+    parser.add_argument("--no-cache", action="store_true", help="disable the verdict cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,103 @@
+"""
+Import-time budget for the Functions worker start.
+
+Imports the function app in a fresh interpreter under `python -X importtime`
+and fails (exit code 1) when the import takes longer than the budget or than
+the committed baseline (benchmarks/import_baseline.json) plus the tolerance, or
+when a module that should only load on first use (Semantic Kernel, Cosmos,
+tenacity, Key Vault, the Azure Monitor exporter) is imported at start. The app
+is imported as in production, with Application Insights configured.
+
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --write-baseline
+    python -m benchmarks.import_budget --baseline other_machine.json --tolerance 0.5
+
+Import time depends on the machine: refresh the baseline with --write-baseline
+on the machine that runs the check.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+# Loaded on first use by the routes that need them, never at worker start
+DEFERRED_MODULES = ("semantic_kernel", "azure.cosmos", "tenacity", "azure.keyvault", "azure.monitor")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "import_baseline.json")
+# Hard ceiling whatever the baseline says
+DEFAULT_BUDGET_MS = 1000
+# Production workers have Application Insights configured; the exporter must still not load at import
+MEASURE_ENV = {"RESPONSABLE_AI_CHECK": "false",
+               "APPLICATIONINSIGHTS_CONNECTION_STRING": "InstrumentationKey=00000000-0000-0000-0000-000000000000;"
+                                                        "IngestionEndpoint=http://127.0.0.1:9/"}
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+def measure(module, env=None):
+    """Returns ({module: cumulative microseconds}, total microseconds) for importing `module`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=REPO_ROOT,
+                            env={**os.environ, **(env or {})}, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    cumulative = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        microseconds, indent, name = int(match.group(2)), match.group(3), match.group(4)
+        cumulative[name] = microseconds
+        if not indent:
+            # Top-level imports; nested ones are already inside their parent's cumulative time
+            total += microseconds
+    return cumulative, total
+
+def deferred_imported(cumulative):
+    return sorted(name for name in cumulative
+                  if any(name == deferred or name.startswith(f"{deferred}.") for deferred in DEFERRED_MODULES))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fails when the function app's import time exceeds its budget")
+    parser.add_argument("--module", default="function_app")
+    parser.add_argument("--runs", type=int, default=3, help="the fastest run is kept, to limit noise")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="absolute limit for the import")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON file with a previous total_ms")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown over the baseline")
+    parser.add_argument("--write-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    return parser.parse_args(argv)
+
+def main(args):
+    # The fairness check is off, as on a worker that only serves question checks
+    runs = [measure(args.module, MEASURE_ENV) for _ in range(max(1, args.runs))]
+    cumulative, total = min(runs, key=lambda run: run[1])
+    total_ms = total / 1000
+    print(f"import {args.module}: {total_ms:.1f} ms (fastest of {len(runs)})")
+    for name, microseconds in sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"    {name:<60}{microseconds / 1000:>10.1f} ms")
+    failures = []
+    deferred = deferred_imported(cumulative)
+    if deferred:
+        failures.append(f"imported at start but should load on first use: {', '.join(deferred)}")
+    if args.budget_ms is not None and total_ms > args.budget_ms:
+        failures.append(f"{total_ms:.1f} ms is over the {args.budget_ms} ms budget")
+    if args.baseline and not os.path.exists(args.baseline) and not args.write_baseline:
+        print(f"no baseline at {args.baseline}, only the {args.budget_ms} ms budget applies")
+    if args.baseline and os.path.exists(args.baseline) and not args.write_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline_ms = json.load(f)["total_ms"]
+        limit = baseline_ms * (1 + args.tolerance)
+        if total_ms > limit:
+            failures.append(f"{total_ms:.1f} ms is over the baseline {baseline_ms:.1f} ms (+{args.tolerance:.0%})")
+    if args.baseline and args.write_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"module": args.module, "total_ms": round(total_ms, 1)}, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,76 @@
+from azure.cosmos.exceptions import (CosmosHttpResponseError, CosmosResourceNotFoundError,
+                                    CosmosResourceExistsError, CosmosAccessConditionFailedError)
+
+_ERRORS = {404: CosmosResourceNotFoundError, 409: CosmosResourceExistsError, 412: CosmosAccessConditionFailedError}
+
+class StubContainer:
+    """
+    The subset of azure.cosmos.aio's ContainerProxy used by auditing.audit, backed
+    by the stub server's /cosmos routes so audit writes pay a real round trip.
+    """
+
+    def __init__(self, session, base_url, name):
+        self.session = session
+        self.url = f"{base_url}/cosmos/{name}"
+
+    async def _call(self, method, url, **kwargs):
+        async with self.session.request(method, url, **kwargs) as response:
+            body = await response.json()
+            if response.status >= 400:
+                error = _ERRORS.get(response.status, CosmosHttpResponseError)
+                raise error(status_code=response.status, message=str(body))
+            return body
+
+    async def read_item(self, item, partition_key):
+        return await self._call("GET", f"{self.url}/{item}")
+
+    async def create_item(self, body):
+        return await self._call("POST", self.url, json=body)
+
+    async def replace_item(self, item, body, etag=None, match_condition=None):
+        item_id = item["id"] if isinstance(item, dict) else item
+        headers = {"If-Match": etag} if etag and match_condition is not None else {}
+        return await self._call("PUT", f"{self.url}/{item_id}", json=body, headers=headers)
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        operations = [{"operation": operation, "body": args[0]} for operation, args in batch_operations]
+        return await self._call("POST", f"{self.url}/batch", json=operations)
+
+    def query_items(self, query, parameters=None, partition_key=None):
+        # Only equality filters are supported: each @name parameter filters on field `name`
+        filters = {parameter["name"].lstrip("@"): str(parameter["value"]) for parameter in parameters or []}
+        return self._query(filters)
+
+    async def _query(self, filters):
+        for item in await self._call("GET", self.url, params=filters):
+            yield item
+
+class StubDatabase:
+    def __init__(self, session, base_url):
+        self.session = session
+        self.base_url = base_url
+
+    def get_container_client(self, name):
+        return StubContainer(self.session, self.base_url, name)
+
+class StubCosmosClient:
+    """
+    Stand-in for azure.cosmos.aio's CosmosClient, built with the session and base
+    URL bound first; the account URL and credential are accepted and ignored.
+    """
+
+    def __init__(self, session, base_url, url=None, credential=None, **kwargs):
+        self.session = session
+        self.base_url = base_url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        pass
+
+    def get_database_client(self, database):
+        return StubDatabase(self.session, self.base_url)
@@ -0,0 +1,40 @@
+import asyncio
+from types import SimpleNamespace
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+class StubSecretClient:
+    """
+    The subset of azure.keyvault.secrets.aio's SecretClient used by shared.util,
+    backed by the stub server's /secrets route. Built with the session and base
+    URL bound first; vault_url and credential are accepted and ignored. Throttled
+    and 5xx responses are retried, as the SDK's retry policy does.
+    """
+
+    retries = 3
+
+    def __init__(self, session, base_url, vault_url=None, credential=None, **kwargs):
+        self.session = session
+        self.url = f"{base_url}/secrets"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        pass
+
+    async def get_secret(self, name, version=None, **kwargs):
+        for attempt in range(self.retries + 1):
+            async with self.session.get(f"{self.url}/{name}") as response:
+                body = await response.json()
+                status = response.status
+                retry_after_ms = float(response.headers.get("retry-after-ms", 0))
+            if status < 400:
+                return SimpleNamespace(name=name, value=body["value"], properties=SimpleNamespace(expires_on=None))
+            if status == 404:
+                raise ResourceNotFoundError(message=str(body))
+            if attempt == self.retries or (status != 429 and status < 500):
+                raise HttpResponseError(message=f"Operation returned {status}: {body}")
+            await asyncio.sleep(retry_after_ms / 1000 or 0.1 * 2 ** attempt)
@@ -0,0 +1,223 @@
+import json
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+# Text containing this marker is reported as an attack / ungrounded / protected by the stub
+ATTACK_MARKER = "[[attack]]"
+CATEGORIES = ("Hate", "SelfHarm", "Sexual", "Violence")
+# Characters the service accepts per request; larger payloads are rejected with 400, as the service does
+TEXT_LIMITS = {"text:shieldPrompt": 10000, "text:detectJailbreak": 1000, "text:detectProtectedMaterial": 1000,
+               "text:analyze": 10000}
+
+class StubConfig:
+    def __init__(self, latency_ms=50, throttle_rate=0.0, error_rate=0.0, retry_after_ms=100, slow_rate=0.0, slow_ms=1000):
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after_ms = retry_after_ms
+        # Share of calls that take slow_ms longer; only on the first region when several are used
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+
+class StubState:
+    """Call counters and the in-memory stores behind the stub."""
+
+    def __init__(self, config):
+        self.config = config
+        self.calls = {}
+        self.secrets = {"apimSubscriptionKey": "stub-subscription-key"}
+        self.containers = {}  # container -> id -> item
+        self.etag_counter = 0
+
+    def count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def total_calls(self, prefix=""):
+        return sum(count for operation, count in self.calls.items() if operation.startswith(prefix))
+
+    def stored_bytes(self):
+        return {name: sum(len(json.dumps(item)) for item in items.values()) for name, items in self.containers.items()}
+
+    def next_etag(self):
+        self.etag_counter += 1
+        return f"\"{self.etag_counter}\""
+
+async def _simulate(request, operation):
+    """Applies latency, throttling and errors; returns an error response or None."""
+    state = request.app["state"]
+    config = state.config
+    state.count(operation)
+    # Read the body even when failing the call: an unread body (e.g. a large
+    # audit document) can leave the keep-alive connection stuck for the next call
+    await request.read()
+    await asyncio.sleep(config.latency_ms * random.uniform(0.5, 1.5) / 1000)
+    if request.match_info.get("region", "r0") == "r0" and random.random() < config.slow_rate:
+        await asyncio.sleep(config.slow_ms / 1000)
+    roll = random.random()
+    if roll < config.throttle_rate:
+        return web.json_response({"error": {"code": "TooManyRequests"}}, status=429,
+                                 headers={"retry-after-ms": str(config.retry_after_ms)})
+    if roll < config.throttle_rate + config.error_rate:
+        return web.json_response({"error": {"code": "InternalServerError"}}, status=500)
+    return None
+
+def _flagged(*texts):
+    return any(ATTACK_MARKER in (text or "") for text in texts)
+
+##########################################################
+# CONTENT SAFETY
+##########################################################
+
+async def content_safety(request):
+    operation = request.match_info["operation"]
+    error = await _simulate(request, f"contentsafety/{operation}")
+    if error is not None:
+        return error
+    body = await request.json()
+    if operation == "text:shieldPrompt":
+        size = len(body.get("userPrompt") or "") + sum(len(document or "") for document in body.get("documents") or [])
+    else:
+        size = len(body.get("text") or "")
+    if size > TEXT_LIMITS.get(operation, size):
+        return web.json_response({"error": {"code": "InvalidRequestBody",
+                                            "message": f"{size} characters is over the {TEXT_LIMITS[operation]} limit"}}, status=400)
+    if operation == "text:shieldPrompt":
+        documents = body.get("documents") or []
+        return web.json_response({
+            "userPromptAnalysis": {"attackDetected": _flagged(body.get("userPrompt"))},
+            "documentsAnalysis": [{"attackDetected": _flagged(document)} for document in documents],
+        })
+    if operation == "text:detectJailbreak":
+        return web.json_response({"jailbreakAnalysis": {"detected": _flagged(body.get("text"))}})
+    if operation == "text:detectGroundedness":
+        ungrounded = _flagged(body.get("text"))
+        return web.json_response({"ungroundedDetected": ungrounded, "ungroundedPercentage": 1 if ungrounded else 0,
+                                  "ungroundedDetails": []})
+    if operation == "text:detectProtectedMaterial":
+        return web.json_response({"protectedMaterialAnalysis": {"detected": _flagged(body.get("text"))}})
+    if operation == "text:analyze":
+        severity = 4 if _flagged(body.get("text")) else 0
+        return web.json_response({"blocklistsMatch": [],
+                                  "categoriesAnalysis": [{"category": category, "severity": severity} for category in CATEGORIES]})
+    return web.json_response({"error": {"code": "NotFound"}}, status=404)
+
+##########################################################
+# KEY VAULT
+##########################################################
+
+async def key_vault_secret(request):
+    error = await _simulate(request, "keyvault/get_secret")
+    if error is not None:
+        return error
+    name = request.match_info["name"]
+    value = request.app["state"].secrets.get(name)
+    if value is None:
+        return web.json_response({"error": {"code": "SecretNotFound"}}, status=404)
+    return web.json_response({"value": value, "id": f"{request.url.origin()}/secrets/{name}/1", "attributes": {"enabled": True}})
+
+##########################################################
+# COSMOS-LIKE STORE
+##########################################################
+
+async def cosmos_read(request):
+    error = await _simulate(request, "cosmos/read")
+    if error is not None:
+        return error
+    items = request.app["state"].containers.get(request.match_info["container"], {})
+    item = items.get(request.match_info["id"])
+    if item is None:
+        return web.json_response({"code": "NotFound"}, status=404)
+    return web.json_response(item)
+
+async def cosmos_create(request):
+    error = await _simulate(request, "cosmos/create")
+    if error is not None:
+        return error
+    state = request.app["state"]
+    items = state.containers.setdefault(request.match_info["container"], {})
+    body = await request.json()
+    if body["id"] in items:
+        return web.json_response({"code": "Conflict"}, status=409)
+    body["_etag"] = state.next_etag()
+    items[body["id"]] = body
+    return web.json_response(body, status=201)
+
+async def cosmos_replace(request):
+    error = await _simulate(request, "cosmos/replace")
+    if error is not None:
+        return error
+    state = request.app["state"]
+    items = state.containers.setdefault(request.match_info["container"], {})
+    current = items.get(request.match_info["id"])
+    if current is None:
+        return web.json_response({"code": "NotFound"}, status=404)
+    if_match = request.headers.get("If-Match")
+    if if_match and if_match != current.get("_etag"):
+        return web.json_response({"code": "PreconditionFailed"}, status=412)
+    body = await request.json()
+    body["_etag"] = state.next_etag()
+    items[body["id"]] = body
+    return web.json_response(body)
+
+async def cosmos_batch(request):
+    error = await _simulate(request, "cosmos/batch")
+    if error is not None:
+        return error
+    state = request.app["state"]
+    items = state.containers.setdefault(request.match_info["container"], {})
+    operations = await request.json()
+    if any(operation["body"]["id"] in items for operation in operations):
+        return web.json_response({"code": "Conflict"}, status=409)
+    results = []
+    for operation in operations:
+        body = dict(operation["body"], _etag=state.next_etag())
+        items[body["id"]] = body
+        results.append(body)
+    return web.json_response(results)
+
+async def cosmos_query(request):
+    error = await _simulate(request, "cosmos/query")
+    if error is not None:
+        return error
+    items = request.app["state"].containers.get(request.match_info["container"], {})
+    filters = dict(request.query)
+    return web.json_response([item for item in items.values()
+                              if all(str(item.get(key)) == value for key, value in filters.items())])
+
+def create_app(config):
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["state"] = StubState(config)
+    app.router.add_post("/contentsafety/{operation}", content_safety)
+    # Stand-ins for several regions (CONTENT_SAFETY_ENDPOINTS): <base>/r0, <base>/r1, ...
+    app.router.add_post("/{region}/contentsafety/{operation}", content_safety)
+    app.router.add_get("/secrets/{name}", key_vault_secret)
+    app.router.add_get("/cosmos/{container}/{id}", cosmos_read)
+    app.router.add_put("/cosmos/{container}/{id}", cosmos_replace)
+    app.router.add_post("/cosmos/{container}/batch", cosmos_batch)
+    app.router.add_post("/cosmos/{container}", cosmos_create)
+    app.router.add_get("/cosmos/{container}", cosmos_query)
+    return app
+
+async def start_stub_server(config, host="127.0.0.1", port=0):
+    """Starts the stub in the running loop; returns (runner, base_url, state)."""
+    app = create_app(config)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}", app["state"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for Content Safety, Key Vault and Cosmos")
+    parser.add_argument("--port", type=int, default=7081)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-ms", type=float, default=1000)
+    args = parser.parse_args()
+    config = StubConfig(args.latency_ms, args.throttle_rate, args.error_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    web.run_app(create_app(config), port=args.port)
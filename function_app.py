@@ -3,7 +3,13 @@ import os
 import logging
 import json
 import safety_checks.check_execution as check_execution
+import safety_checks.batch as batch
+from safety_checks.policy import PolicyError
 import auditing.audit as auditing
+import shared.telemetry as telemetry
+import shared.deadline as deadline
+from safety_checks.warmup import warm_up
+from auditing.writer import audit_writer, AUDIT_BUFFERED
 
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
@@ -18,25 +24,64 @@ PLUGINS_FOLDER = f"plugins"
 RESPONSABLE_AI_CHECK=os.environ.get("RESPONSABLE_AI_CHECK", "false").lower() == "true"
 
 logging.basicConfig(level=logging.INFO)
+# The telemetry exporter is configured by the warm-up hook (or the first request), not here
+
+def build_response(check_results, details, timings=None):
+    response_data = {
+        "results": check_results,
+        "details":details
+    }
+    skipped = [name for name, status in check_results.items() if status == "Skipped"]
+    if skipped:
+        response_data["skipped"] = skipped
+    timed_out = [name for name, status in check_results.items() if status == deadline.TIMED_OUT]
+    if timed_out:
+        response_data["timed_out"] = timed_out
+        verdict = deadline.degraded_verdict(check_results)
+        if verdict is not None:
+            response_data["degraded_verdict"] = verdict
+    if timings is not None:
+        response_data["timings"] = timings.as_dict()
+    return response_data
+
+# Warm-up triggers need azure-functions 1.18+ and a Premium plan; /Warmup works everywhere
+if hasattr(app, "warm_up_trigger"):
+    @app.warm_up_trigger("warmup")
+    async def warmup_trigger(warmup) -> None:
+        await warm_up()
+
+@app.route(route="Warmup")
+async def cf_warmup(req: func.HttpRequest) -> func.HttpResponse:
+    timings = await warm_up()
+    return func.HttpResponse(json.dumps({"warmup_ms": timings}), status_code=200, mimetype="application/json")
+
 @app.route(route="QuestionChecks")
 async def cf_question_checks(req: func.HttpRequest) -> func.HttpResponse:
     # Extract question, answer, and sources from the request
     try:
         req_body = req.get_json()
         question = req_body.get('question')
+        fail_fast = req_body.get('fail_fast')
+        profile = req_body.get('profile')
+        with_timings = telemetry.timings_requested(req_body.get('timings'))
     except ValueError:
         return func.HttpResponse("Invalid request", status_code=400)
+    try:
+        deadline_ms = deadline.parse_deadline_ms(req.headers, req_body)
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid deadline: {e}", status_code=400)
 
     if not question:
         return func.HttpResponse("Missing question in the request", status_code=400)
     logging.info(f"Received params: question={question[:100]}")
-    check_results,details=await check_execution.question_checks(question)
+    try:
+        with telemetry.request_scope() as timings, deadline.deadline_scope(deadline_ms):
+            check_results,details=await check_execution.question_checks(question, fail_fast=fail_fast, profile=profile)
+    except PolicyError as e:
+        return func.HttpResponse(str(e), status_code=400)
 
     # Prepare the response object
-    response_data = {
-        "results": check_results,
-        "details":details
-    }
+    response_data = build_response(check_results, details, timings if with_timings else None)
 
     # Return a JSON response
     return func.HttpResponse(json.dumps(response_data), status_code=200, mimetype="application/json")
@@ -49,22 +94,97 @@ async def cf_answer_checks(req: func.HttpRequest) -> func.HttpResponse:
         question = req_body.get('question')
         answer = req_body.get('answer')
         sources = req_body.get('sources')
+        fail_fast = req_body.get('fail_fast')
+        profile = req_body.get('profile')
+        with_timings = telemetry.timings_requested(req_body.get('timings'))
     except ValueError:
         return func.HttpResponse("Invalid request", status_code=400)
+    try:
+        deadline_ms = deadline.parse_deadline_ms(req.headers, req_body)
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid deadline: {e}", status_code=400)
 
     if not question or not answer or not sources:
         return func.HttpResponse("Missing question, answer, or sources in the request", status_code=400)
     logging.info(f"Received params: question={question[:100]}, answer={answer[:100]}, sources={sources[:100]}")
-    check_results,details=await check_execution.answer_checks(answer,question,sources)
+    try:
+        with telemetry.request_scope() as timings, deadline.deadline_scope(deadline_ms):
+            check_results,details=await check_execution.answer_checks(answer,question,sources, fail_fast=fail_fast, profile=profile)
+    except PolicyError as e:
+        return func.HttpResponse(str(e), status_code=400)
     # Prepare the response object
-    response_data = {
-        "results": check_results,
-        "details":details
-    }
+    response_data = build_response(check_results, details, timings if with_timings else None)
 
     # Return a JSON response
     return func.HttpResponse(json.dumps(response_data), status_code=200, mimetype="application/json")
 
+async def question_item_checks(item):
+    question = item.get('question')
+    if not question:
+        return {"error": "Missing question in the request"}
+    try:
+        deadline_ms = deadline.parse_deadline_ms(None, item)
+    except ValueError as e:
+        return {"error": f"Invalid deadline: {e}"}
+    try:
+        with telemetry.request_scope() as timings, deadline.deadline_scope(deadline_ms):
+            check_results,details=await check_execution.question_checks(question, fail_fast=item.get('fail_fast'), profile=item.get('profile'))
+    except PolicyError as e:
+        return {"error": str(e)}
+    return build_response(check_results, details, timings if telemetry.timings_requested(item.get('timings')) else None)
+
+async def answer_item_checks(item):
+    question = item.get('question')
+    answer = item.get('answer')
+    sources = item.get('sources')
+    if not question or not answer or not sources:
+        return {"error": "Missing question, answer, or sources in the request"}
+    try:
+        deadline_ms = deadline.parse_deadline_ms(None, item)
+    except ValueError as e:
+        return {"error": f"Invalid deadline: {e}"}
+    try:
+        with telemetry.request_scope() as timings, deadline.deadline_scope(deadline_ms):
+            check_results,details=await check_execution.answer_checks(answer,question,sources, fail_fast=item.get('fail_fast'), profile=item.get('profile'))
+    except PolicyError as e:
+        return {"error": str(e)}
+    return build_response(check_results, details, timings if telemetry.timings_requested(item.get('timings')) else None)
+
+@app.route(route="QuestionChecks/batch")
+async def cf_question_checks_batch(req: func.HttpRequest) -> func.HttpResponse:
+    # Accepts a JSON array or NDJSON body; answers with one NDJSON line per item, in input order
+    try:
+        items = batch.parse_items(req.get_body())
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid request: {e}", status_code=400)
+    logging.info(f"Received question checks batch with {len(items)} items")
+    try:
+        # The default budget is per item, not for the whole batch
+        batch_deadline_ms = deadline.parse_deadline_ms(req.headers, None, default=None)
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid deadline: {e}", status_code=400)
+    # Items may set a shorter deadline_ms of their own
+    with deadline.deadline_scope(batch_deadline_ms):
+        lines = await batch.run_batch(items, question_item_checks)
+    return func.HttpResponse(batch.to_ndjson(lines), status_code=200, mimetype="application/x-ndjson")
+
+@app.route(route="AnswerChecks/batch")
+async def cf_answer_checks_batch(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        items = batch.parse_items(req.get_body())
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid request: {e}", status_code=400)
+    logging.info(f"Received answer checks batch with {len(items)} items")
+    try:
+        # The default budget is per item, not for the whole batch
+        batch_deadline_ms = deadline.parse_deadline_ms(req.headers, None, default=None)
+    except ValueError as e:
+        return func.HttpResponse(f"Invalid deadline: {e}", status_code=400)
+    # Items may set a shorter deadline_ms of their own
+    with deadline.deadline_scope(batch_deadline_ms):
+        lines = await batch.run_batch(items, answer_item_checks)
+    return func.HttpResponse(batch.to_ndjson(lines), status_code=200, mimetype="application/x-ndjson")
+
 @app.route(route="Audit")
 async def audit(req: func.HttpRequest) -> func.HttpResponse:
     try:
@@ -76,6 +196,13 @@ async def audit(req: func.HttpRequest) -> func.HttpResponse:
         conversation_id = req_body.get('conversation_id')
     except ValueError:
         return func.HttpResponse("Invalid request", status_code=400)
+    if AUDIT_BUFFERED:
+        # Written in the background by the audit writer; nothing waits on Cosmos here
+        try:
+            status = audit_writer.submit(conversation_id, question, answer, sources, security_checks)
+        except ValueError as e:
+            return func.HttpResponse(f"Error auditing to db: {e}", status_code=400)
+        return func.HttpResponse(f"Logging accepted ({status})", status_code=202)
     try:
         await auditing.audit_to_db(conversation_id, question, answer, sources, security_checks)
     except Exception as e:
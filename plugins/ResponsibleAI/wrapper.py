@@ -1,9 +1,29 @@
 # imports
+import os
+import re
 import json
 import logging
 from shared.util import call_semantic_function
+from safety_checks.verdict_cache import VerdictCache
 
-async def fairness(kernel, rai_plugin, arguments):
+FAIRNESS_CACHE_ENABLED = os.environ.get("FAIRNESS_CACHE_ENABLED", "true").lower() == "true"
+fairness_cache = VerdictCache(enabled=FAIRNESS_CACHE_ENABLED)
+
+def normalize_answer(answer):
+    """Case and whitespace differences do not change the fairness verdict."""
+    return re.sub(r"\s+", " ", answer or "").strip().lower()
+
+async def fairness(kernel, rai_plugin, arguments, prompt_version=None):
+    """
+    Cached entry point for the fairness evaluation. Verdicts are keyed by the
+    normalized answer and `prompt_version`; without a version nothing is cached.
+    """
+    if prompt_version is None:
+        return await evaluate_fairness(kernel, rai_plugin, arguments)
+    return await fairness_cache.cached(f"fairness:{prompt_version}", (normalize_answer(arguments.get("answer")),),
+                                       lambda: evaluate_fairness(kernel, rai_plugin, arguments))
+
+async def evaluate_fairness(kernel, rai_plugin, arguments):
     """
     This function is used to evaluate the fairness of a given context. 
     It calls a semantic function that returns a response indicating whether the context is fair or not.
@@ -0,0 +1,148 @@
+import os
+import time
+import hashlib
+import logging
+from shared.util import create_kernel, get_aoai_config, AZURE_OPENAI_CHATGPT_MODEL
+
+PLUGINS_FOLDER = f"plugins"
+PLUGINS_HOT_RELOAD = os.environ.get("PLUGINS_HOT_RELOAD", "false").lower() == "true"
+PLUGINS_RELOAD_CHECK_SECONDS = float(os.environ.get("PLUGINS_RELOAD_CHECK_SECONDS", "10"))
+PLUGIN_FILES = ("skprompt.txt", "config.json")
+
+class PluginRegistry:
+    """
+    Loads the Semantic Kernel plugins under PLUGINS_FOLDER once per worker and
+    keeps warm kernels that already have them attached.
+
+    A plugin is a directory whose subdirectories hold skprompt.txt/config.json,
+    e.g. plugins/ResponsibleAI/Semantic, and is registered as "ResponsibleAI/Semantic".
+    One kernel is kept per AOAI endpoint and deployment. It is rebuilt only when the
+    token it was created with has been refreshed. With PLUGINS_HOT_RELOAD the
+    prompt files are re-read when they change on disk.
+    """
+
+    def __init__(self, folder=PLUGINS_FOLDER):
+        self.folder = folder
+        self._plugins = {}  # key -> KernelPlugin
+        self._mtimes = {}  # key -> latest mtime of its prompt files
+        self._versions = {}  # key -> hash of its prompt files
+        self._kernels = {}  # (endpoint, deployment) -> (auth, kernel)
+        self._last_reload_check = 0
+        self._timings = {}
+
+    def _discover(self):
+        plugins = {}
+        for group in sorted(os.listdir(self.folder)):
+            group_dir = os.path.join(self.folder, group)
+            if not os.path.isdir(group_dir):
+                continue
+            for name in sorted(os.listdir(group_dir)):
+                plugin_dir = os.path.join(group_dir, name)
+                if os.path.isdir(plugin_dir) and any(
+                        os.path.isfile(os.path.join(plugin_dir, function, "skprompt.txt"))
+                        for function in os.listdir(plugin_dir)):
+                    plugins[f"{group}/{name}"] = (group_dir, name)
+        return plugins
+
+    def _content_hash(self, group_dir, name):
+        digest = hashlib.sha256()
+        plugin_dir = os.path.join(group_dir, name)
+        for function in sorted(os.listdir(plugin_dir)):
+            for file_name in PLUGIN_FILES:
+                path = os.path.join(plugin_dir, function, file_name)
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        digest.update(f.read())
+        return digest.hexdigest()[:16]
+
+    def _latest_mtime(self, group_dir, name):
+        latest = 0
+        plugin_dir = os.path.join(group_dir, name)
+        for function in os.listdir(plugin_dir):
+            for file_name in PLUGIN_FILES:
+                path = os.path.join(plugin_dir, function, file_name)
+                if os.path.isfile(path):
+                    latest = max(latest, os.path.getmtime(path))
+        return latest
+
+    def _load(self, key, group_dir, name):
+        start_time = time.time()
+        # Semantic Kernel is only imported once a plugin is needed (first fairness check or warm-up)
+        from semantic_kernel.functions import KernelPlugin
+        self._plugins[key] = KernelPlugin.from_directory(parent_directory=group_dir, plugin_name=name)
+        self._mtimes[key] = self._latest_mtime(group_dir, name)
+        self._versions[key] = self._content_hash(group_dir, name)
+        load_time = time.time() - start_time
+        self._timing(key)["load_ms"] = round(load_time * 1000, 2)
+        logging.info(f"[plugin_registry] loaded plugin {key}. {round(load_time, 2)} seconds")
+
+    def load_all(self):
+        """Loads every plugin that is not loaded yet. Safe to call at startup."""
+        for key, (group_dir, name) in self._discover().items():
+            if key not in self._plugins:
+                self._load(key, group_dir, name)
+
+    def _reload_changed(self):
+        now = time.time()
+        if now - self._last_reload_check < PLUGINS_RELOAD_CHECK_SECONDS:
+            return
+        self._last_reload_check = now
+        changed = False
+        for key, (group_dir, name) in self._discover().items():
+            if key not in self._plugins or self._latest_mtime(group_dir, name) > self._mtimes.get(key, 0):
+                logging.info(f"[plugin_registry] plugin {key} changed on disk, reloading")
+                self._load(key, group_dir, name)
+                changed = True
+        if changed:
+            # Kernels hold the old plugin objects
+            self._kernels.clear()
+
+    def get_plugin(self, key):
+        if PLUGINS_HOT_RELOAD:
+            self._reload_changed()
+        if key not in self._plugins:
+            self.load_all()
+        return self._plugins[key]
+
+    def get_version(self, key):
+        """Hash of the plugin's prompt files, so cached verdicts follow prompt changes."""
+        self.get_plugin(key)
+        return self._versions[key]
+
+    async def get_kernel(self, chatgpt_config=None):
+        """Returns a kernel with every plugin attached, reusing it while its auth is still current."""
+        if PLUGINS_HOT_RELOAD:
+            self._reload_changed()
+        if not self._plugins:
+            self.load_all()
+        if chatgpt_config is None:
+            chatgpt_config = await get_aoai_config(AZURE_OPENAI_CHATGPT_MODEL)
+        kernel_key = (chatgpt_config['endpoint'], chatgpt_config['deployment'])
+        auth = chatgpt_config.get('api_key')
+        cached = self._kernels.get(kernel_key)
+        if cached is not None and cached[0] == auth:
+            return cached[1]
+        kernel = await create_kernel(chatgpt_config=chatgpt_config)
+        for plugin in self._plugins.values():
+            kernel.add_plugin(plugin)
+        self._kernels[kernel_key] = (auth, kernel)
+        return kernel
+
+    def _timing(self, key):
+        return self._timings.setdefault(key, {"load_ms": None, "invocations": 0, "invoke_ms_total": 0.0})
+
+    async def timed(self, key, awaitable):
+        """Awaits a plugin invocation and records its duration under `key`."""
+        start_time = time.time()
+        try:
+            return await awaitable
+        finally:
+            timing = self._timing(key)
+            timing["invocations"] += 1
+            timing["invoke_ms_total"] += (time.time() - start_time) * 1000
+
+    def stats(self):
+        return {key: dict(timing, invoke_ms_avg=round(timing["invoke_ms_total"] / timing["invocations"], 2) if timing["invocations"] else None)
+                for key, timing in self._timings.items()}
+
+plugin_registry = PluginRegistry()
@@ -0,0 +1,50 @@
+import os
+import json
+import asyncio
+import logging
+
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+
+def parse_items(body):
+    """
+    Parses a batch request body: a JSON array, an object with an "items" array,
+    or NDJSON (one JSON object per line). Raises ValueError on malformed input.
+    """
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    text = text.strip()
+    if not text:
+        raise ValueError("Empty batch")
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(items, dict):
+        items = items.get("items", [items])
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError("Batch items must be JSON objects")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Batch has {len(items)} items, the maximum is {BATCH_MAX_ITEMS}")
+    return items
+
+async def run_batch(items, handler, max_concurrency=BATCH_MAX_CONCURRENCY):
+    """
+    Runs `handler(item)` for every item with at most `max_concurrency` in flight.
+    Returns one dict per item, in input order, tagged with its index and id.
+    A failing item produces an "error" entry instead of failing the batch.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_item(index, item):
+        async with semaphore:
+            try:
+                result = await handler(item)
+            except Exception as e:
+                logging.error(f"[batch] item {index} failed: {e}")
+                result = {"error": str(e)}
+        return {"index": index, "id": item.get("id"), **result}
+
+    return await asyncio.gather(*(run_item(index, item) for index, item in enumerate(items)))
+
+def to_ndjson(lines):
+    return "".join(json.dumps(line) + "\n" for line in lines)
@@ -1,15 +1,23 @@
 
 import os
 import safety_checks.safety_checks as safety_checks
+import time
+import random
 import logging
 import asyncio
-from shared.util import get_secret,create_kernel
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.contentsafety.aio import ContentSafetyClient
-from azure.identity.aio import DefaultAzureCredential
-from semantic_kernel.functions.kernel_arguments import KernelArguments
-from semantic_kernel.functions import KernelPlugin
+from shared.clients import content_safety_clients
+from shared.rate_limiter import content_safety_scheduler
+from safety_checks.verdict_cache import verdict_cache
+from safety_checks.runner import observable, CheckSkipped
+from safety_checks.policy import policy, run_profile
+from safety_checks.prefilter import local_prefilter, local_prefilter_check, LOCAL_PREFILTER_ENABLED
+from safety_checks.sources import prepare_sources, SOURCES_DEDUP_ENABLED
+from shared.deadline import TIMED_OUT, ensure_time
+from shared.telemetry import record_sources
 from plugins.ResponsibleAI.wrapper import fairness
+from plugins.registry import plugin_registry
+from shared.util import get_aoai_config, resource_available, AZURE_OPENAI_CHATGPT_MODEL
+from shared.balancer import aoai_balancer, resource_failure
 
 CONTENT_SAFETY_ENDPOINT = os.environ.get("CONTENT_SAFETY_ENDPOINT")
 CONTENT_SAFETY_API_VERSION = os.environ.get("CONTENT_SAFETY_API_VERSION", "2024-02-15-preview")
@@ -20,94 +28,144 @@ AZURE_DB_ID=os.environ.get("AZURE_DB_ID")
 AZURE_DB_URI = f"https://{AZURE_DB_ID}.documents.azure.com:443/"
 PLUGINS_FOLDER = f"plugins"
 RESPONSABLE_AI_CHECK=os.environ.get("RESPONSABLE_AI_CHECK", "false").lower() == "true"
-async def question_checks(question):
-    if APIM_ENABLED:
-        content_safety_key=await get_secret("apimSubscriptionKey")
-        key=AzureKeyCredential(content_safety_key)
-        endpoint=os.environ.get("APIM_ENDPOINT")
-    else:
-        endpoint=CONTENT_SAFETY_ENDPOINT
-    async with DefaultAzureCredential() as credential:
-        if(APIM_ENABLED):
-            content_safety_credential=key
-        else:
-            content_safety_credential=credential
-        async with ContentSafetyClient(endpoint=endpoint, credential=content_safety_credential) as client:
-            checks = [
-                safety_checks.prompt_shield_wrapper(question=question,client=client),
-                safety_checks.jailbreak_detection_wrapper(question,client),
-                safety_checks.analyze_text_wrapper(question,client)
-            ]
-            check_names = ["promptShield(Question)", "jailbreak","TextAnalysis"]
-            check_results = {}
-            details = {}
-            logging.info("Starting content safety checks")
-            results = await asyncio.gather(*checks, return_exceptions=True)
-            for index, result in enumerate(results):
-                check_name = check_names[index]
-                if isinstance(result, Exception):
-                    # Handle the exception
-                    logging.error(f"Error occurred during {check_name} content safety check: {result}")
-                    check_results[check_name] = "Failed"
-                    check_details = f"Error: Failed check with exception {result}"
-                else:
-                    # Assuming result is now a tuple (check_result, check_details)
-                    check_result, check_details = result
-                    logging.info(f"Checking {check_name}, result: {check_result}, details: {check_details}")
-                    # If the check_result indicates a failure, record the failure
-                    if check_result:
-                        check_results[check_name] = "Failed"
-                        details[check_name] = check_details  # Correctly update details with check_details
-                    else:
-                        check_results[check_name] = "Passed"
-                        details[check_name] = check_details  # Correctly update details even if check passed
+FAIRNESS_TIMEOUT_SECONDS=float(os.environ.get("FAIRNESS_TIMEOUT_SECONDS", "30"))
+# 0 runs fairness on every answer; otherwise only when a text analysis category reaches this severity
+FAIRNESS_MIN_SEVERITY=int(os.environ.get("FAIRNESS_MIN_SEVERITY", "0"))
+# Attempts of the fairness call; a 429 or 5xx is retried on the next AOAI resource
+FAIRNESS_MAX_ATTEMPTS=int(os.environ.get("FAIRNESS_MAX_ATTEMPTS", "3"))
+# Backoff before retrying when no other resource is out of cooldown
+FAIRNESS_RETRY_BASE_DELAY_SECONDS=1
+FAIRNESS_RETRY_MAX_DELAY_SECONDS=10
+async def question_checks(question, fail_fast=None, profile=None):
+    # Process-wide client: the connection pool and token are reused across requests
+    client=content_safety_clients
+    # The policy profile decides which of these run, and in which order
+    factories = {
+        "promptShield(Question)": lambda: safety_checks.prompt_shield_wrapper(question=question,client=client),
+        "jailbreak": lambda: safety_checks.jailbreak_detection_wrapper(question,client),
+        "TextAnalysis": lambda: safety_checks.analyze_text_wrapper(question,client),
+    }
+    if LOCAL_PREFILTER_ENABLED:
+        factories["localPrefilter"] = lambda: local_prefilter_check(question)
+    lengths = {check_name: len(question) for check_name in factories}
+    check_results, details = await run_profile(policy.profile("question", profile), factories, lengths, fail_fast)
+    if LOCAL_PREFILTER_ENABLED:
+        local_prefilter.record_outcome(check_results)
+        logging.info(f"Local pre-filter stats: {local_prefilter.stats()}")
+    logging.info(f"Verdict cache stats: {verdict_cache.stats()}")
+    logging.info(f"Single-flight stats: {verdict_cache.single_flight.stats()}")
+    logging.info(f"Content Safety scheduler stats: {content_safety_scheduler.stats()}")
     return check_results, details
 
-async def answer_checks(answer,question,sources):
-    if APIM_ENABLED:
-        content_safety_key=await get_secret("apimSubscriptionKey")
-        key=AzureKeyCredential(content_safety_key)
-        endpoint=os.environ.get("APIM_ENDPOINT")
+async def answer_checks(answer,question,sources, fail_fast=None, precomputed=None, profile=None):
+    # Process-wide client: the connection pool and token are reused across requests
+    client=content_safety_clients
+    check_profile = policy.profile("answer", profile)
+    # Checks already running elsewhere (e.g. a streaming session), by check name
+    precomputed=precomputed or {}
+    # Sources are normalized, de-duplicated and chunked once for every source check
+    source_plan=None
+    if SOURCES_DEDUP_ENABLED:
+        source_plan=prepare_sources(sources, safety_checks.MAX_PROMPTSHIELD_LENGTH)
+        record_sources(source_plan.stats())
+    # The fairness gate waits on the same text analysis result
+    text_analysis_check=precomputed.get("TextAnalysis") or safety_checks.analyze_text_wrapper(answer,client)
+    text_analysis, text_analysis_result=observable(text_analysis_check)
+    factories = {
+        "groundedness": lambda: safety_checks.groundedness_check_wrapper(question, answer, sources,client, source_plan=source_plan),
+        "protectedMaterial": lambda: precomputed.get("protectedMaterial") or safety_checks.protected_material_detection_wrapper(answer,client),
+        "TextAnalysis": lambda: text_analysis,
+        "promptShield(sources)": lambda: safety_checks.prompt_shield_wrapper(sources=sources,client=client, source_plan=source_plan),
+    }
+    if(RESPONSABLE_AI_CHECK==True):
+        factories["fairness"] = lambda: fairness_check(answer, text_analysis_result)
+    if LOCAL_PREFILTER_ENABLED:
+        # Jailbreak phrases are looked for in questions only
+        factories["localPrefilter"] = lambda: local_prefilter_check(answer, jailbreak=False)
+    lengths = {check_name: len(answer) for check_name in factories}
+    if source_plan is not None:
+        lengths["promptShield(sources)"] = len(source_plan.text)
     else:
-        endpoint=CONTENT_SAFETY_ENDPOINT
-    async with DefaultAzureCredential() as credential:
-        if(APIM_ENABLED):
-            content_safety_credential=key
-        else:
-            content_safety_credential=credential
-        async with ContentSafetyClient(endpoint=endpoint, credential=content_safety_credential) as client:
-            checks = [
-                safety_checks.groundedness_check_wrapper(question, answer, sources,client),
-                safety_checks.protected_material_detection_wrapper(answer,client),
-                safety_checks.analyze_text_wrapper(answer,client),
-                safety_checks.prompt_shield_wrapper(sources=sources,client=client)
-            ]
-            check_names = ["groundedness","protectedMaterial","TextAnalysis","promptShield(sources)"]
-            if(RESPONSABLE_AI_CHECK==True):
-                kernel=await create_kernel()
-                raiPlugin = kernel.add_plugin(KernelPlugin.from_directory(parent_directory=f"{PLUGINS_FOLDER}/ResponsibleAI",plugin_name="Semantic"))
-                arguments=KernelArguments(answer=answer)
-                checks.append(fairness(kernel, raiPlugin, arguments))
-                check_names.append("fairness")
-            check_results = {}
-            details = {}
-            logging.info("Starting content safety checks")
-            results = await asyncio.gather(*checks, return_exceptions=True)
-            for index, result in enumerate(results):
-                check_name = check_names[index]
-                if isinstance(result, Exception):
-                    # Handle the exception
-                    logging.error(f"Error occurred during {check_name} content safety check: {result}")
-                    check_results[check_name] = "Failed"
-                    check_details = f"Error: Failed check with exception {result}"
-                else:
-                    # Assuming result is now a tuple (check_result, check_details)
-                    check_result, check_details = result
-                    # If the check_result indicates a failure, record the failure
-                    if check_result:
-                        check_results[check_name] = "Failed"
-                        details[check_name] = check_details  # Correctly update details with check_details
-                    else:
-                        check_results[check_name] = "Passed"
-                        details[check_name] = check_details  # Correctly update details even if check passed
-    return check_results, details
\ No newline at end of file
+        lengths["promptShield(sources)"] = len(sources) if isinstance(sources, str) else sum(len(source) for source in sources)
+
+    def on_skip(check_name, reason):
+        # Coroutines the policy will not run are closed so nothing waits on them
+        if check_name == "TextAnalysis":
+            text_analysis_check.close()
+            text_analysis.close()
+            text_analysis_result.set_exception(CheckSkipped("Skipped", reason))
+        elif check_name in precomputed:
+            precomputed[check_name].close()
+
+    for check_name in {"TextAnalysis", *precomputed}:
+        if check_name not in check_profile.checks:
+            on_skip(check_name, f"Not in the '{check_profile.name}' profile")
+    check_results, details = await run_profile(check_profile, factories, lengths, fail_fast, on_skip)
+    if LOCAL_PREFILTER_ENABLED:
+        local_prefilter.record_outcome(check_results)
+        logging.info(f"Local pre-filter stats: {local_prefilter.stats()}")
+    logging.info(f"Verdict cache stats: {verdict_cache.stats()}")
+    logging.info(f"Single-flight stats: {verdict_cache.single_flight.stats()}")
+    logging.info(f"Content Safety scheduler stats: {content_safety_scheduler.stats()}")
+    if(RESPONSABLE_AI_CHECK==True):
+        logging.info(f"Plugin stats: {plugin_registry.stats()}")
+    return check_results, details
+
+async def fairness_check(answer, text_analysis_result):
+    """
+    Runs the fairness plugin under FAIRNESS_TIMEOUT_SECONDS, and only when the
+    answer's highest text analysis severity reaches FAIRNESS_MIN_SEVERITY.
+    """
+    if FAIRNESS_MIN_SEVERITY > 0:
+        try:
+            _, analysis = await asyncio.shield(text_analysis_result)
+            max_severity = max((category['severity'] for category in analysis['categoriesAnalysis']), default=0)
+        except asyncio.CancelledError:
+            if not text_analysis_result.cancelled():
+                raise
+            # Text analysis was cancelled, not this check
+            max_severity = FAIRNESS_MIN_SEVERITY
+        except Exception:
+            # No usable analysis: do not skip the fairness check because of it
+            max_severity = FAIRNESS_MIN_SEVERITY
+        if max_severity < FAIRNESS_MIN_SEVERITY:
+            raise CheckSkipped("Skipped", f"Highest text analysis severity {max_severity} is below {FAIRNESS_MIN_SEVERITY}")
+    try:
+        return await asyncio.wait_for(_fairness(answer, time.monotonic() + FAIRNESS_TIMEOUT_SECONDS), timeout=FAIRNESS_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logging.warning(f"Fairness check did not finish within {FAIRNESS_TIMEOUT_SECONDS} seconds")
+        raise CheckSkipped(TIMED_OUT, f"Fairness check did not finish within {FAIRNESS_TIMEOUT_SECONDS} seconds")
+
+async def _fairness(answer, deadline):
+    """
+    Calls the fairness plugin, asking the AOAI balancer for a resource on every
+    attempt. A 429 or 5xx puts that resource on cooldown, so the retry goes to
+    the next one straight away; only when none is left is there a backoff. No
+    retry is started that `deadline` (time.monotonic()) or the request deadline
+    would cut short.
+    """
+    # Semantic Kernel is loaded with the first fairness check, not at worker start
+    from semantic_kernel.functions.kernel_arguments import KernelArguments
+    raiPlugin = plugin_registry.get_plugin("ResponsibleAI/Semantic")
+    prompt_version = plugin_registry.get_version("ResponsibleAI/Semantic")
+    arguments=KernelArguments(answer=answer)
+    for attempt in range(FAIRNESS_MAX_ATTEMPTS):
+        chatgpt_config=await get_aoai_config(AZURE_OPENAI_CHATGPT_MODEL)
+        # Warm kernel and plugin, loaded once per worker and resource
+        kernel=await plugin_registry.get_kernel(chatgpt_config)
+        check=plugin_registry.timed("ResponsibleAI/Semantic", fairness(kernel, raiPlugin, arguments, prompt_version=prompt_version))
+        try:
+            # Each attempt feeds the AOAI balancer (outstanding requests, latency, cooldown on 429/5xx)
+            return await aoai_balancer.observe(chatgpt_config.get('resource'), check)
+        except Exception as e:
+            if attempt + 1 == FAIRNESS_MAX_ATTEMPTS or not resource_failure(e):
+                raise
+            delay = 0
+            if not resource_available(AZURE_OPENAI_CHATGPT_MODEL):
+                delay = random.uniform(0, min(FAIRNESS_RETRY_MAX_DELAY_SECONDS, FAIRNESS_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise
+            ensure_time("fairness", needed=delay)
+            logging.warning(f"Fairness check failed on {chatgpt_config.get('resource') or chatgpt_config.get('endpoint')}, "
+                            f"retry {attempt + 1}/{FAIRNESS_MAX_ATTEMPTS - 1} in {delay:.2f}s: {e}")
+            await asyncio.sleep(delay)
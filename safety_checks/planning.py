@@ -0,0 +1,81 @@
+import logging
+from shared.util import divide_string
+
+# Running totals of what the groundedness planner executed versus the cartesian plan
+groundedness_stats = {"requests": 0, "cartesian_calls": 0, "executed_calls": 0}
+# Running totals of source chunks versus shieldPrompt calls after packing
+prompt_shield_stats = {"requests": 0, "chunks": 0, "calls": 0}
+
+def pack_chunks(chunks, max_total_chars, max_items=None):
+    """
+    Greedily groups consecutive chunks so that each group's total length stays
+    within `max_total_chars` (and `max_items`, if given).
+    Returns a list of lists of chunk indexes.
+    """
+    packs = []
+    current = []
+    current_size = 0
+    for index, chunk in enumerate(chunks):
+        full = current and (current_size + len(chunk) > max_total_chars or (max_items and len(current) >= max_items))
+        if full:
+            packs.append(current)
+            current = []
+            current_size = 0
+        current.append(index)
+        current_size += len(chunk)
+    if current:
+        packs.append(current)
+    return packs
+
+class GroundednessPlan:
+    """Calls needed to check an answer against its sources, plus what the cartesian plan would have cost."""
+
+    def __init__(self, question, answer_chunks, source_packs, cartesian_calls):
+        self.question = question
+        self.answer_chunks = answer_chunks
+        self.source_packs = source_packs
+        self.cartesian_calls = cartesian_calls
+
+    @property
+    def calls(self):
+        # Answer chunks outermost: each one is decided independently
+        return [(self.question, answer, sources) for answer in self.answer_chunks for sources in self.source_packs]
+
+    @property
+    def planned_calls(self):
+        return len(self.answer_chunks) * len(self.source_packs)
+
+def plan_groundedness(question, answer, sources, max_question_chars, max_answer_chars, max_sources_chars, source_chunks=None):
+    """
+    Builds a bounded groundedness plan: one question chunk, and the source chunks
+    packed into as few `groundingSources` lists as the API size limit allows.
+    `source_chunks` lets callers pass passages they have already split.
+    """
+    if source_chunks is None:
+        source_chunks = divide_string(sources, max_chars=max_sources_chars)
+    question_chunks = divide_string(question, max_chars=max_question_chars)
+    answer_chunks = divide_string(answer, max_chars=max_answer_chars)
+    packs = pack_chunks(source_chunks, max_sources_chars)
+    source_packs = [[source_chunks[i] for i in pack] for pack in packs]
+    cartesian_calls = len(source_chunks) * len(question_chunks) * len(answer_chunks)
+    plan = GroundednessPlan(question_chunks[0] if question_chunks else question, answer_chunks, source_packs, cartesian_calls)
+    logging.info(f"[planning] groundedness plan: {plan.planned_calls} calls instead of {cartesian_calls}")
+    return plan
+
+def plan_prompt_shield_documents(chunks, max_total_chars, max_documents):
+    """
+    Packs source chunks into shieldPrompt `documents` arrays, as many per request
+    as the request limits allow. Returns a list of lists of chunk indexes.
+    """
+    packs = pack_chunks(chunks, max_total_chars, max_items=max_documents)
+    prompt_shield_stats["requests"] += 1
+    prompt_shield_stats["chunks"] += len(chunks)
+    prompt_shield_stats["calls"] += len(packs)
+    logging.info(f"[planning] prompt shield plan: {len(chunks)} source chunks in {len(packs)} calls")
+    return packs
+
+def record_groundedness(plan, executed_calls):
+    groundedness_stats["requests"] += 1
+    groundedness_stats["cartesian_calls"] += plan.cartesian_calls
+    groundedness_stats["executed_calls"] += executed_calls
+    logging.info(f"[planning] groundedness executed {executed_calls} calls, saved {plan.cartesian_calls - executed_calls} over the cartesian plan")
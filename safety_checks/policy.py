@@ -0,0 +1,193 @@
+import os
+import json
+import math
+import logging
+from safety_checks.runner import run_checks
+
+# JSON, or YAML when the file ends in .yaml/.yml and PyYAML is installed
+POLICY_FILE = os.environ.get("POLICY_FILE")
+ROUTES = ("question", "answer")
+# Used for any route a policy file does not define; same checks and order as before policies existed.
+# localPrefilter only runs when LOCAL_PREFILTER_ENABLED is set.
+DEFAULT_POLICY = {
+    "default_profile": "default",
+    "profiles": {
+        "default": {
+            "question": {"stages": [["localPrefilter"], ["promptShield(Question)", "jailbreak", "TextAnalysis"]]},
+            "answer": {"stages": [["localPrefilter"], ["groundedness", "protectedMaterial", "TextAnalysis", "promptShield(sources)", "fairness"]]},
+        }
+    },
+}
+
+# Checks that wait on another check's result (fairness gates on the text analysis
+# severities), so they cannot run in an earlier stage than that check
+WAITS_ON = {"fairness": "TextAnalysis"}
+
+class PolicyError(ValueError):
+    """Invalid policy file or unknown profile."""
+
+class CheckProfile:
+    """
+    How one route runs its checks under a named profile.
+
+    Stages run in order; the checks of a stage run together through run_checks.
+    Once a stage has a failure the later stages are skipped (unless
+    "stop_after_failure" is false), so cheap checks placed first keep the remote
+    calls of later stages from being made. Per check, the profile can also set:
+      - "min_length" / "max_length": skip the check for shorter / longer input;
+      - "requires": only run it when the listed checks, in earlier stages, passed;
+      - "severity_thresholds": fail it when a categoriesAnalysis severity reaches the
+        threshold for that category ("*" applies to every other category).
+    fairness cannot run in an earlier stage than TextAnalysis, whose result it waits on.
+    """
+
+    def __init__(self, name, route, config):
+        self.name = name
+        self.route = route
+        stages = config.get("stages")
+        if stages is None:
+            stages = [config.get("checks", [])]
+        if not isinstance(stages, list) or not all(isinstance(stage, list) for stage in stages):
+            raise PolicyError(f"profile '{name}' ({route}): 'stages' must be a list of lists of check names")
+        self.stages = [list(stage) for stage in stages if stage]
+        self.stop_after_failure = config.get("stop_after_failure", True)
+        self.min_length = dict(config.get("min_length", {}))
+        self.max_length = dict(config.get("max_length", {}))
+        self.requires = {check: list(dependencies) for check, dependencies in config.get("requires", {}).items()}
+        self.severity_thresholds = dict(config.get("severity_thresholds", {}))
+        self._validate()
+
+    def _validate(self):
+        stage_of = {}
+        for index, stage in enumerate(self.stages):
+            for check in stage:
+                if check in stage_of:
+                    raise PolicyError(f"profile '{self.name}' ({self.route}): check '{check}' appears more than once")
+                stage_of[check] = index
+        for check, awaited in WAITS_ON.items():
+            if stage_of.get(check, math.inf) < stage_of.get(awaited, -1):
+                raise PolicyError(f"profile '{self.name}' ({self.route}): '{check}' waits on the result of '{awaited}', "
+                                  f"which must not run in a later stage")
+        for check, dependencies in self.requires.items():
+            for dependency in dependencies:
+                if stage_of.get(dependency, math.inf) >= stage_of.get(check, -1):
+                    raise PolicyError(f"profile '{self.name}' ({self.route}): '{check}' requires '{dependency}', "
+                                      f"which must run in an earlier stage")
+
+    @property
+    def checks(self):
+        return [check for stage in self.stages for check in stage]
+
+    def skip_reason(self, check, length, check_results):
+        if length is not None and length < self.min_length.get(check, 0):
+            return f"Input is shorter than {self.min_length[check]} characters"
+        if length is not None and length > self.max_length.get(check, math.inf):
+            return f"Input is longer than {self.max_length[check]} characters"
+        for dependency in self.requires.get(check, []):
+            if check_results.get(dependency) != "Passed":
+                return f"Requires {dependency} to pass"
+        return None
+
+class Policy:
+    def __init__(self, config):
+        self.default_profile = config.get("default_profile", "default")
+        if isinstance(self.default_profile, str):
+            self.default_profile = {route: self.default_profile for route in ROUTES}
+        self.profiles = {}
+        for name, routes in {**DEFAULT_POLICY["profiles"], **config.get("profiles", {})}.items():
+            for route, route_config in routes.items():
+                if route not in ROUTES:
+                    raise PolicyError(f"profile '{name}': unknown route '{route}', expected one of {ROUTES}")
+                self.profiles[(name, route)] = CheckProfile(name, route, route_config)
+
+    def profile(self, route, name=None):
+        """Returns the CheckProfile for a route; `name` selects a profile, else the route's default."""
+        requested = name or self.default_profile.get(route, "default")
+        profile = self.profiles.get((requested, route))
+        if profile is None:
+            if any(profile_name == requested for profile_name, _ in self.profiles):
+                # The profile leaves this route as it was
+                return self.profiles[("default", route)]
+            raise PolicyError(f"Unknown check profile '{requested}'")
+        return profile
+
+def load_policy(path=POLICY_FILE):
+    if not path:
+        return Policy(DEFAULT_POLICY)
+    parse = json.load
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise PolicyError(f"{path} is YAML but PyYAML is not installed")
+        parse = yaml.safe_load
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = parse(f)
+    except (OSError, ValueError) as e:
+        raise PolicyError(f"Could not load check policy {path}: {e}") from e
+    policy = Policy(config or {})
+    logging.info(f"[policy] loaded {len(policy.profiles)} route profile(s) from {path}")
+    return policy
+
+def exceeds_thresholds(details, thresholds):
+    """Categories of a categoriesAnalysis result whose severity reaches its threshold."""
+    if not isinstance(details, dict):
+        return []
+    return [category['category'] for category in details.get('categoriesAnalysis', [])
+            if category['severity'] >= thresholds.get(category['category'], thresholds.get("*", math.inf))]
+
+async def _with_thresholds(check, thresholds):
+    check_result, details = await check
+    exceeded = exceeds_thresholds(details, thresholds)
+    if not check_result and exceeded:
+        logging.info(f"[policy] severity threshold reached for {', '.join(exceeded)}")
+        return True, details
+    return check_result, details
+
+async def run_profile(profile, factories, lengths=None, fail_fast=None, on_skip=None):
+    """
+    Runs the checks of `profile` and returns (check_results, details) like run_checks.
+
+    `factories` maps check names to zero-argument callables returning the check
+    coroutine; profile checks without a factory (e.g. fairness when it is turned
+    off) are left out. `lengths` gives the input length each check would see, and
+    `on_skip(check, reason)` is called for every check the policy does not start.
+    """
+    lengths = lengths or {}
+    check_results = {}
+    details = {}
+    failed = []
+    for stage in profile.stages:
+        checks = []
+        check_names = []
+        for check_name in stage:
+            if check_name not in factories:
+                continue
+            if failed and profile.stop_after_failure:
+                reason = f"Skipped after {', '.join(failed)} failed"
+            else:
+                reason = profile.skip_reason(check_name, lengths.get(check_name), check_results)
+            if reason is not None:
+                check_results[check_name] = "Skipped"
+                details[check_name] = reason
+                if on_skip is not None:
+                    on_skip(check_name, reason)
+                continue
+            check = factories[check_name]()
+            thresholds = profile.severity_thresholds.get(check_name)
+            checks.append(_with_thresholds(check, thresholds) if thresholds else check)
+            check_names.append(check_name)
+        if not checks:
+            continue
+        stage_results, stage_details = await run_checks(checks, check_names, fail_fast)
+        check_results.update(stage_results)
+        details.update(stage_details)
+        failed.extend(check_name for check_name in check_names if stage_results.get(check_name) == "Failed")
+    # Report in the profile's order, whatever stage each check ran in
+    order = {check_name: index for index, check_name in enumerate(profile.checks)}
+    check_results = dict(sorted(check_results.items(), key=lambda item: order[item[0]]))
+    details = dict(sorted(details.items(), key=lambda item: order[item[0]]))
+    return check_results, details
+
+policy = load_policy()
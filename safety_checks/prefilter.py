@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import time
+import logging
+
+LOCAL_PREFILTER_ENABLED = os.environ.get("LOCAL_PREFILTER_ENABLED", "false").lower() == "true"
+# JSON object {"blocklistName": ["term", ...]} or a text file with one term per line
+LOCAL_BLOCKLIST_FILE = os.environ.get("LOCAL_BLOCKLIST_FILE")
+JAILBREAK_SIGNATURES_FILE = os.environ.get("JAILBREAK_SIGNATURES_FILE") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "signatures", "jailbreak.txt")
+PREFILTER_RELOAD_CHECK_SECONDS = float(os.environ.get("PREFILTER_RELOAD_CHECK_SECONDS", "30"))
+# Blocklist name reported for terms of a plain text blocklist file
+LOCAL_BLOCKLIST_NAME = "local"
+REGEX_PREFIX = "re:"
+
+def _normalize(term):
+    return " ".join(term.lower().split())
+
+class TermMatcher:
+    """
+    One compiled alternation over a set of terms, so a text is scanned once however
+    many terms there are. Terms match case-insensitively, on word boundaries, with
+    any whitespace between their words. Entries given as regular expressions are
+    compiled separately and reported by their pattern.
+    """
+
+    def __init__(self, entries):
+        self._labels = {}  # normalized term -> [(label, term)]
+        self._patterns = []  # (label, pattern, compiled)
+        for label, term in entries:
+            if term.startswith(REGEX_PREFIX):
+                pattern = term[len(REGEX_PREFIX):]
+                self._patterns.append((label, pattern, re.compile(pattern, re.IGNORECASE)))
+            elif _normalize(term):
+                self._labels.setdefault(_normalize(term), []).append((label, term))
+        # Longest first so a term wins over its own prefix
+        alternatives = [r"\s+".join(re.escape(word) for word in term.split())
+                        for term in sorted(self._labels, key=len, reverse=True)]
+        self._regex = re.compile(r"(?<!\w)(?:" + "|".join(alternatives) + r")(?!\w)", re.IGNORECASE) if alternatives else None
+
+    def __len__(self):
+        return len(self._labels) + len(self._patterns)
+
+    def find(self, text):
+        """Returns the (label, term) pairs found in `text`, each once, in order of appearance."""
+        found = []
+        if self._regex is not None:
+            for match in self._regex.finditer(text):
+                for entry in self._labels.get(_normalize(match.group(0)), []):
+                    if entry not in found:
+                        found.append(entry)
+        for label, pattern, compiled in self._patterns:
+            if compiled.search(text) and (label, pattern) not in found:
+                found.append((label, pattern))
+        return found
+
+class _Source:
+    def __init__(self, path, parse):
+        self.path = path
+        self.parse = parse
+        self.mtime = None
+        self.matcher = TermMatcher([])
+
+    def reload_if_changed(self):
+        if not self.path or not os.path.isfile(self.path):
+            return False
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return False
+        start_time = time.time()
+        with open(self.path, encoding="utf-8") as f:
+            self.matcher = TermMatcher(self.parse(f.read()))
+        self.mtime = mtime
+        logging.info(f"[prefilter] loaded {len(self.matcher)} entries from {self.path}. {round(time.time() - start_time, 3)} seconds")
+        return True
+
+def _lines(content):
+    return [line.strip() for line in content.splitlines() if line.strip() and not line.strip().startswith("#")]
+
+def parse_blocklists(content):
+    try:
+        blocklists = json.loads(content)
+    except ValueError:
+        return [(LOCAL_BLOCKLIST_NAME, term) for term in _lines(content)]
+    return [(name, term) for name, terms in blocklists.items() for term in terms]
+
+def parse_signatures(content):
+    return [("jailbreak", signature) for signature in _lines(content)]
+
+class LocalPrefilter:
+    """
+    Finds exact blocklist terms and known jailbreak phrases locally, before any
+    remote check runs.
+
+    Each source file is compiled once into a TermMatcher and recompiled only when
+    that file changes (checked every PREFILTER_RELOAD_CHECK_SECONDS). A hit is
+    reported as a failed "localPrefilter" check with blocklistsMatch-style
+    details; the check profile then skips the remote checks of later stages.
+    """
+
+    def __init__(self, blocklist_file=LOCAL_BLOCKLIST_FILE, signatures_file=JAILBREAK_SIGNATURES_FILE):
+        self._blocklists = _Source(blocklist_file, parse_blocklists)
+        self._signatures = _Source(signatures_file, parse_signatures)
+        self._last_reload_check = 0
+        self.scans = 0
+        self.hits = 0
+        self.remote_checks_avoided = 0
+
+    def _reload_changed(self):
+        now = time.time()
+        if now - self._last_reload_check < PREFILTER_RELOAD_CHECK_SECONDS:
+            return
+        self._last_reload_check = now
+        for source in (self._blocklists, self._signatures):
+            try:
+                source.reload_if_changed()
+            except (OSError, ValueError, re.error) as e:
+                # Keep matching with the previous version of the file
+                logging.error(f"[prefilter] could not reload {source.path}: {e}")
+
+    def load(self):
+        """Compiles the source files now instead of on the first scan (used by the warm-up)."""
+        self._last_reload_check = 0
+        self._reload_changed()
+
+    def scan(self, text, jailbreak=True):
+        """Returns (detected, details) for `text`; jailbreak signatures only when `jailbreak`."""
+        self._reload_changed()
+        self.scans += 1
+        blocklists_match = [{"blocklistName": name, "blocklistItemText": term}
+                            for name, term in self._blocklists.matcher.find(text)]
+        signatures = [signature for _, signature in self._signatures.matcher.find(text)] if jailbreak else []
+        if not blocklists_match and not signatures:
+            return False, "Passed local pre-filter"
+        self.hits += 1
+        details = {"blocklistsMatch": blocklists_match, "categoriesAnalysis": []}
+        if signatures:
+            details["jailbreakAnalysis"] = {"detected": True, "signatures": signatures}
+        return True, details
+
+    def record_outcome(self, check_results):
+        """Counts the checks a local hit kept from running."""
+        if check_results.get("localPrefilter") == "Failed":
+            self.remote_checks_avoided += sum(1 for check_name, status in check_results.items()
+                                              if check_name != "localPrefilter" and status == "Skipped")
+
+    def stats(self):
+        return {"scans": self.scans, "hits": self.hits, "remote_checks_avoided": self.remote_checks_avoided,
+                "blocklist_terms": len(self._blocklists.matcher), "jailbreak_signatures": len(self._signatures.matcher)}
+
+local_prefilter = LocalPrefilter()
+
+async def local_prefilter_check(text, jailbreak=True):
+    return local_prefilter.scan(text, jailbreak=jailbreak)
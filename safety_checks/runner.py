@@ -0,0 +1,176 @@
+import os
+import asyncio
+import logging
+import weakref
+from contextvars import ContextVar
+from shared.telemetry import traced_check
+from shared.deadline import DeadlineExceeded, within_deadline
+
+FAIL_FAST_CHECKS = os.environ.get("FAIL_FAST_CHECKS", "false").lower() == "true"
+# Per-request override of FAIL_FAST_CHECKS; tasks inherit it from the request that created them
+fail_fast_mode = ContextVar("fail_fast_mode", default=FAIL_FAST_CHECKS)
+# Wrapped check -> callback that releases what it wraps, for checks closed before they start
+_close_hooks = weakref.WeakKeyDictionary()
+
+class CheckSkipped(Exception):
+    """Raised by a check that did not produce a verdict; reported with `status` instead of Failed."""
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+def observable(check):
+    """
+    Wraps a check so other checks can wait on its outcome. Returns the wrapped
+    coroutine, to be run like any other check, and a future with its result.
+    """
+    future = asyncio.get_running_loop().create_future()
+    # Mark the outcome as retrieved even if no other check waits on it
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def on_close(error):
+        # Never started: nothing will await the wrapped check or settle the future otherwise
+        if asyncio.iscoroutine(check):
+            check.close()
+        if not future.done():
+            future.set_exception(error)
+
+    async def run():
+        try:
+            result = await check
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        if not future.done():
+            future.set_result(result)
+        return result
+
+    wrapped = run()
+    _close_hooks[wrapped] = on_close
+    return wrapped, future
+
+def close_check(check, error):
+    """Closes a check that will not be started, and what it wraps; `error` is what waiters on it see."""
+    if asyncio.iscoroutine(check):
+        check.close()
+    hook = _close_hooks.pop(check, None)
+    if hook is not None:
+        hook(error)
+
+def is_decisive(result):
+    """A chunk result settles its check when it raised or flagged the chunk."""
+    return isinstance(result, BaseException) or bool(result[0])
+
+async def run_chunk_checks(checks):
+    """
+    Runs a wrapper's chunk checks.
+
+    By default this is asyncio.gather(..., return_exceptions=True). In fail-fast
+    mode the chunks run as tasks and, once one of them is decisive, the rest are
+    cancelled; only completed results are returned, in input order.
+
+    Chunks that could not run before the request deadline make the whole check
+    time out (DeadlineExceeded is raised) unless another chunk already flagged it.
+    """
+    if not fail_fast_mode.get():
+        return _settle_timeouts(await asyncio.gather(*checks, return_exceptions=True))
+    tasks = [asyncio.ensure_future(check) for check in checks]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(is_decisive(_task_result(task)) for task in done):
+                break
+    finally:
+        await _cancel_pending(tasks)
+    skipped = sum(1 for task in tasks if task.cancelled())
+    if skipped:
+        logging.info(f"[runner] fail-fast: cancelled {skipped} of {len(tasks)} chunk checks")
+    return _settle_timeouts([_task_result(task) for task in tasks if task.done() and not task.cancelled()])
+
+def _settle_timeouts(results):
+    timed_out = [result for result in results if isinstance(result, DeadlineExceeded)]
+    if not timed_out:
+        return results
+    completed = [result for result in results if not isinstance(result, DeadlineExceeded)]
+    if any(not isinstance(result, BaseException) and result[0] for result in completed):
+        # A flagged chunk settles the check whatever the missing chunks would say
+        return completed
+    raise timed_out[0]
+
+async def _cancel_pending(tasks):
+    pending = [task for task in tasks if not task.done()]
+    for task in pending:
+        task.cancel()
+    # Let the cancellations settle so every task is done when we read the results
+    await asyncio.gather(*pending, return_exceptions=True)
+
+def _task_result(task):
+    exception = task.exception()
+    return exception if exception is not None else task.result()
+
+async def run_checks(checks, check_names, fail_fast=None):
+    """
+    Runs the top-level checks of a request and returns (check_results, details).
+
+    In fail-fast mode the first check that reports a failure cancels the checks
+    still running; those are reported as "Skipped". `fail_fast` overrides
+    FAIL_FAST_CHECKS for this call and for the chunk checks it starts. Under a
+    request deadline (shared.deadline), checks that cannot finish in time are
+    cancelled, or not started, and reported as "TimedOut".
+    """
+    token = fail_fast_mode.set(fail_fast) if fail_fast is not None else None
+    try:
+        return await _run_checks(checks, check_names)
+    finally:
+        if token is not None:
+            fail_fast_mode.reset(token)
+
+async def _run_checks(checks, check_names):
+    check_results = {}
+    details = {}
+    logging.info("Starting content safety checks")
+    checks = [traced_check(check_name, within_deadline(check, check_name, close=close_check)) for check_name, check in zip(check_names, checks)]
+    if fail_fast_mode.get():
+        tasks = [asyncio.ensure_future(check) for check in checks]
+        failed_by = None
+        try:
+            pending = set(tasks)
+            while pending and failed_by is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = _task_result(task)
+                    if not isinstance(result, BaseException) and result[0]:
+                        failed_by = check_names[tasks.index(task)]
+                        break
+        finally:
+            await _cancel_pending(tasks)
+        results = [_task_result(task) if not task.cancelled() else None for task in tasks]
+    else:
+        failed_by = None
+        results = await asyncio.gather(*checks, return_exceptions=True)
+    for index, result in enumerate(results):
+        check_name = check_names[index]
+        if result is None:
+            check_results[check_name] = "Skipped"
+            details[check_name] = f"Skipped after {failed_by} failed"
+        elif isinstance(result, (CheckSkipped, DeadlineExceeded)):
+            logging.info(f"Checking {check_name}, result: {result.status}, details: {result.reason}")
+            check_results[check_name] = result.status
+            details[check_name] = result.reason
+        elif isinstance(result, BaseException):
+            # Handle the exception
+            logging.error(f"Error occurred during {check_name} content safety check: {result}")
+            check_results[check_name] = "Failed"
+        else:
+            check_result, check_details = result
+            logging.info(f"Checking {check_name}, result: {check_result}, details: {check_details}")
+            # If the check_result indicates a failure, record the failure
+            check_results[check_name] = "Failed" if check_result else "Passed"
+            details[check_name] = check_details
+    return check_results, details
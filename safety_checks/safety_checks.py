@@ -3,8 +3,13 @@ import logging
 from azure.ai.contentsafety.aio import ContentSafetyClient
 from azure.ai.contentsafety.models import AnalyzeTextOptions,AnalyzeTextResult
 from azure.core.rest import HttpRequest
-import asyncio
 from shared.util import divide_string
+from shared.chunking import chunk_spans, materialize
+from shared.clients import content_safety_clients
+from safety_checks.verdict_cache import verdict_cache
+from safety_checks.planning import plan_groundedness, record_groundedness, plan_prompt_shield_documents
+from safety_checks.runner import run_chunk_checks
+from safety_checks.sources import merge_spans
 CONTENT_SAFETY_API_VERSION = os.environ.get("CONTENT_SAFETY_API_VERSION", "2024-02-15-preview")
 CONTENT_SAFETY_ENDPOINT = os.environ.get("CONTENT_SAFETY_ENDPOINT")
 BLOCK_LIST_CHECK = os.environ.get("BLOCK_LIST_CHECK", "false").lower() == "true"
@@ -18,13 +23,22 @@ MAX_PROTECTED_MATERIAL_LENGTH = 1000
 MIN_PROTECTED_MATERIAL_LENGTH = 110
 MAX_ANALYZE_TEXT_LENGTH = 10000
 MAX_JAILBREAK_LENGTH = 1000
+# Groundedness calls in flight at once for a single answer
+GROUNDEDNESS_MAX_CONCURRENCY = int(os.environ.get("GROUNDEDNESS_MAX_CONCURRENCY", "4"))
+# Source chunks sent together in one shieldPrompt `documents` array, and their combined size;
+# the service rejects requests over MAX_PROMPTSHIELD_LENGTH, so the size can only be lowered
+MAX_PROMPTSHIELD_DOCUMENTS = int(os.environ.get("MAX_PROMPTSHIELD_DOCUMENTS", "5"))
+MAX_PROMPTSHIELD_DOCUMENTS_LENGTH = min(int(os.environ.get("MAX_PROMPTSHIELD_DOCUMENTS_LENGTH", str(MAX_PROMPTSHIELD_LENGTH))),
+                                        MAX_PROMPTSHIELD_LENGTH)
+# Characters of an attacked source chunk echoed back in the details
+ATTACKED_CHUNK_PREVIEW_LENGTH = 200
 
 async def groundedness_check(question, answer, sources, client: ContentSafetyClient):
     url = "/text:detectGroundedness"
     json_payload = {
         "task": "QnA",
         "text": answer,
-        "groundingSources": [sources],
+        "groundingSources": sources if isinstance(sources, list) else [sources],
         "qna": {"query": question},
     }
     params = {"api-version": CONTENT_SAFETY_API_VERSION}
@@ -40,24 +54,31 @@ async def groundedness_check(question, answer, sources, client: ContentSafetyCli
         await response.close()  # Ensure the response is closed
 
 # Wrapper function to handle the splitting of the input strings within API limits
-async def groundedness_check_wrapper(question, answer, sources, client: ContentSafetyClient):
-    sources=divide_string(sources, max_chars=MAX_GROUNDEDNESS_SOURCES_LENGTH)
-    question=divide_string(question, max_chars=MAX_GROUNDEDNESS_QUESTION_LENGTH)
-    answer=divide_string(answer, max_chars=MAX_GROUNDEDNESS_ANSWER_LENGTH)
-    checks=[]
-    for source in sources:
-        for q in question:
-            for a in answer:
-                checks.append(groundedness_check(q,a,source,client))
-    results=await asyncio.gather(*checks,return_exceptions=True)
-    for result in results:
-        if isinstance(result, Exception):
-            logging.error(f"Error occurred during groundedness check: {result}")
-            return False, f"Prompt failed groundedness check with exception {result}"
-        else:
-            check_result, check_details = result
-            if check_result:
-                return check_result, check_details
+async def groundedness_check_wrapper(question, answer, sources, client: ContentSafetyClient=None, source_plan=None):
+    if client is None:
+        client = content_safety_clients
+    source_chunks=source_plan.grounding.chunks if source_plan is not None else None
+    plan=plan_groundedness(question, answer, sources, MAX_GROUNDEDNESS_QUESTION_LENGTH, MAX_GROUNDEDNESS_ANSWER_LENGTH, MAX_GROUNDEDNESS_SOURCES_LENGTH, source_chunks)
+    calls=plan.calls
+    executed=0
+    try:
+        # Run in waves so that scheduling stops once an ungrounded answer is found
+        for wave_start in range(0, len(calls), GROUNDEDNESS_MAX_CONCURRENCY):
+            checks=[]
+            for q, a, source_pack in calls[wave_start:wave_start+GROUNDEDNESS_MAX_CONCURRENCY]:
+                checks.append(verdict_cache.cached("groundedness", (q, a, *source_pack), lambda q=q, a=a, source_pack=source_pack: groundedness_check(q,a,source_pack,client)))
+            executed+=len(checks)
+            results=await run_chunk_checks(checks)
+            for result in results:
+                if isinstance(result, Exception):
+                    logging.error(f"Error occurred during groundedness check: {result}")
+                    return False, f"Prompt failed groundedness check with exception {result}"
+                else:
+                    check_result, check_details = result
+                    if check_result:
+                        return check_result, check_details
+    finally:
+        record_groundedness(plan, executed)
     return False, "Prompt passed groundedness check"
     
     
@@ -66,7 +87,7 @@ async def prompt_shield(question=None,sources=None, client: ContentSafetyClient=
     url = "/text:shieldPrompt"
     
     json_payload = {"userPrompt": question,
-                    "documents": [sources]}
+                    "documents": sources if isinstance(sources, list) else [sources]}
     params = {"api-version": CONTENT_SAFETY_API_VERSION}
     request = HttpRequest("POST", url, json=json_payload, params=params)
     
@@ -87,19 +108,29 @@ async def prompt_shield(question=None,sources=None, client: ContentSafetyClient=
         await response.close()  # Ensure the response is closed
 
 # Wrapper function to handle the splitting of the input strings within API limits
-async def prompt_shield_wrapper(question=None,sources=None, client: ContentSafetyClient=None):
-    if(question):
-        text=divide_string(question, max_chars=MAX_PROMPTSHIELD_LENGTH)
-    else:
-        text=divide_string(sources, max_chars=MAX_PROMPTSHIELD_LENGTH)
+async def prompt_shield_wrapper(question=None,sources=None, client: ContentSafetyClient=None, source_plan=None):
+    if client is None:
+        client = content_safety_clients
     checks=[]
     if(question):
+        text=divide_string(question, max_chars=MAX_PROMPTSHIELD_LENGTH)
         for q in text:
-            checks.append(prompt_shield(question=q,client=client))
+            checks.append(verdict_cache.cached("promptShield(question)", (q,), lambda q=q: prompt_shield(question=q,client=client)))
     else:
-        for s in text:
-            checks.append(prompt_shield(sources=s,client=client))
-    results=await asyncio.gather(*checks,return_exceptions=True)
+        if source_plan is not None:
+            # One document per passage, so attackedChunks names the passage that carried
+            # the attack; short adjacent passages share a document, up to an equal share
+            # of the request. Offsets refer to the de-duplicated sources (source_plan.text)
+            spans=merge_spans(source_plan.passages, MAX_PROMPTSHIELD_DOCUMENTS_LENGTH // MAX_PROMPTSHIELD_DOCUMENTS)
+            text=materialize(source_plan.text, spans)
+        else:
+            spans=chunk_spans(sources, max_chars=MAX_PROMPTSHIELD_DOCUMENTS_LENGTH)
+            text=materialize(sources, spans)
+        spans, text = fit_documents(spans, text, MAX_PROMPTSHIELD_DOCUMENTS_LENGTH)
+        # Up to MAX_PROMPTSHIELD_DOCUMENTS documents per call, within the request limit
+        for pack in plan_prompt_shield_documents(text, MAX_PROMPTSHIELD_DOCUMENTS_LENGTH, MAX_PROMPTSHIELD_DOCUMENTS):
+            checks.append(prompt_shield_documents([(index, spans[index], text[index]) for index in pack], client))
+    results=await run_chunk_checks(checks)
     for result in results:
         if isinstance(result, Exception):
             logging.error(f"Error occurred during prompt shield check: {result}")
@@ -110,6 +141,32 @@ async def prompt_shield_wrapper(question=None,sources=None, client: ContentSafet
                 return check_result, check_details
     return False, "Prompt passed prompt shield check"
 
+def fit_documents(spans, chunks, max_chars):
+    """Splits any chunk longer than `max_chars`, so no shieldPrompt request goes over the limit."""
+    if all(len(chunk) <= max_chars for chunk in chunks):
+        return spans, chunks
+    fitted_spans, fitted_chunks = [], []
+    for (start, _), chunk in zip(spans, chunks):
+        for chunk_start, chunk_end in chunk_spans(chunk, max_chars=max_chars):
+            fitted_spans.append((start + chunk_start, start + chunk_end))
+            fitted_chunks.append(chunk[chunk_start:chunk_end])
+    return fitted_spans, fitted_chunks
+
+async def prompt_shield_documents(chunks, client: ContentSafetyClient):
+    """
+    Checks (index, (start, end), text) source chunks in one shieldPrompt call and,
+    when an attack is found, lists the chunks it came from under "attackedChunks".
+    """
+    documents=[chunk for _, _, chunk in chunks]
+    check_result, json_response = await verdict_cache.cached("promptShield(sources)", tuple(documents), lambda: prompt_shield(sources=documents,client=client))
+    if not check_result:
+        return check_result, json_response
+    attacked=[{"chunk": index, "start": start, "end": end, "preview": chunk[:ATTACKED_CHUNK_PREVIEW_LENGTH]}
+              for (index, (start, end), chunk), analysis in zip(chunks, json_response.get("documentsAnalysis", []))
+              if analysis.get("attackDetected")]
+    # The cached response is shared, so the mapping goes on a copy
+    return check_result, dict(json_response, attackedChunks=attacked)
+
 async def jailbreak_detection(question, client: ContentSafetyClient):
     url = "/text:detectJailbreak"
     json_payload = {"text": question}
@@ -129,12 +186,14 @@ async def jailbreak_detection(question, client: ContentSafetyClient):
         await response.close()  # Ensure the response is closed
         
 # Wrapper function to handle the splitting of the input strings within API limits
-async def jailbreak_detection_wrapper(question, client: ContentSafetyClient):
+async def jailbreak_detection_wrapper(question, client: ContentSafetyClient=None):
+    if client is None:
+        client = content_safety_clients
     question=divide_string(question, max_chars=MAX_JAILBREAK_LENGTH)
     checks=[]
     for q in question:
-        checks.append(jailbreak_detection(q,client))
-    results=await asyncio.gather(*checks,return_exceptions=True)
+        checks.append(verdict_cache.cached("jailbreak", (q,), lambda q=q: jailbreak_detection(q,client)))
+    results=await run_chunk_checks(checks)
     for result in results:
         if isinstance(result, Exception):
             logging.error(f"Error occurred during jailbreak check: {result}")
@@ -164,14 +223,23 @@ async def protected_material_detection(answer, client: ContentSafetyClient):
         await response.close()  # Ensure the response is closed
 
 # Wrapper function to handle the splitting of the input strings within API limits
-async def protected_material_detection_wrapper(answer, client: ContentSafetyClient):
+async def protected_material_detection_wrapper(answer, client: ContentSafetyClient=None):
+    if client is None:
+        client = content_safety_clients
     if(len(answer)<MIN_PROTECTED_MATERIAL_LENGTH):
         return True, f"Error: Answer is too short for protected material check(minimum length is {MIN_PROTECTED_MATERIAL_LENGTH} characters)"
     answer=divide_string(answer, min_chars=MIN_PROTECTED_MATERIAL_LENGTH, max_chars=MAX_PROTECTED_MATERIAL_LENGTH)
     checks=[]
     for a in answer:
-        checks.append(protected_material_detection(a,client))
-    results=await asyncio.gather(*checks,return_exceptions=True)
+        checks.append(protected_material_chunk_check(a,client))
+    results=await run_chunk_checks(checks)
+    return evaluate_protected_material_results(results)
+
+# Chunk-level call and result merge, shared with the streaming session
+def protected_material_chunk_check(answer, client: ContentSafetyClient):
+    return verdict_cache.cached("protectedMaterial", (answer,), lambda: protected_material_detection(answer,client))
+
+def evaluate_protected_material_results(results):
     for result in results:
         if isinstance(result, Exception):
             logging.error(f"Error occurred during protected material check: {result}")
@@ -189,17 +257,27 @@ async def analyze_text(text, client: ContentSafetyClient):
     else:    
         options=AnalyzeTextOptions(text=text)
     result= await client.analyze_text(options=options)
-    return False, result
+    # Plain dict so the verdict can be cached and serialized
+    return False, result.as_dict()
 
 # Wrapper function to handle the splitting of the input strings within API limits
-async def analyze_text_wrapper(text, client: ContentSafetyClient):
+async def analyze_text_wrapper(text, client: ContentSafetyClient=None):
+    if client is None:
+        client = content_safety_clients
     texts=divide_string(text, max_chars=MAX_ANALYZE_TEXT_LENGTH)
     checks=[]
+    for text in texts:
+        checks.append(analyze_text_chunk_check(text,client))
+    results=await run_chunk_checks(checks)
+    return evaluate_analyze_text_results(results)
+
+# Chunk-level call and result merge, shared with the streaming session
+def analyze_text_chunk_check(text, client: ContentSafetyClient):
+    return verdict_cache.cached("analyzeText", (text,), lambda: analyze_text(text,client), blocklists=BLOCK_LISTS_NAMES if BLOCK_LIST_CHECK else ())
+
+def evaluate_analyze_text_results(results):
     details={'blocklistsMatch': [], 'categoriesAnalysis': []}
     max_category_values={}
-    for text in texts:
-        checks.append(analyze_text(text,client))
-    results=await asyncio.gather(*checks,return_exceptions=True)
     for result in results:
         if isinstance(result, Exception):
             logging.error(f"Error occurred during text analysis check: {result}")
@@ -0,0 +1,106 @@
+import os
+import time
+import asyncio
+import logging
+from shared.deadline import clear_deadline
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+# Also coalesce between workers through a lock item in the shared verdict store
+SINGLE_FLIGHT_SHARED_LOCK = os.environ.get("SINGLE_FLIGHT_SHARED_LOCK", "false").lower() == "true"
+SINGLE_FLIGHT_LOCK_SECONDS = float(os.environ.get("SINGLE_FLIGHT_LOCK_SECONDS", "10"))
+SINGLE_FLIGHT_POLL_SECONDS = float(os.environ.get("SINGLE_FLIGHT_POLL_SECONDS", "0.2"))
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Shares one in-flight call between concurrent callers asking for the same key.
+
+    The first caller starts the call as a task; callers arriving before it
+    finishes await the same task instead of making their own request. The call
+    is cancelled only when every caller waiting on it has been cancelled.
+
+    With a shared store, the worker that takes the lock item for a key makes the
+    call and other workers poll the store for its verdict until the lock is
+    released or expires, then call themselves if nothing appeared.
+    """
+
+    def __init__(self, shared=None, enabled=SINGLE_FLIGHT_ENABLED, shared_lock=SINGLE_FLIGHT_SHARED_LOCK):
+        self.shared = shared if shared_lock else None
+        self.enabled = enabled
+        self._flights = {}  # key -> _Flight
+        self._stats = {}
+
+    def _count(self, label, outcome):
+        counters = self._stats.setdefault(label, {"calls": 0, "collapsed": 0, "shared_collapsed": 0})
+        counters[outcome] += 1
+
+    async def do(self, key, load, lookup=None, label=None):
+        """
+        Returns the result of `load()` for `key`, sharing it with concurrent callers.
+        `lookup()` reads a finished result from the shared store (None if absent).
+        """
+        if not self.enabled:
+            return await load()
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(self._lead(key, load, lookup, label)))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self._count(label, "calls")
+        else:
+            self._count(label, "collapsed")
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Nobody wants the result any more (e.g. fail-fast cancelled every caller)
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _lead(self, key, load, lookup, label):
+        # The call is shared by requests with different deadlines; each caller's own deadline bounds its wait
+        clear_deadline()
+        if self.shared is None or lookup is None:
+            return await load()
+        lock_key = f"lock|{key}"
+        try:
+            locked = await self.shared.try_lock(lock_key, SINGLE_FLIGHT_LOCK_SECONDS)
+        except Exception as e:
+            logging.warning(f"[single_flight] shared lock unavailable, calling directly: {e}")
+            return await load()
+        if locked:
+            try:
+                return await load()
+            finally:
+                try:
+                    await self.shared.release(lock_key)
+                except Exception as e:
+                    # The lock expires on its own
+                    logging.warning(f"[single_flight] could not release shared lock: {e}")
+        deadline = time.monotonic() + SINGLE_FLIGHT_LOCK_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+            try:
+                value = await lookup()
+                if value is not None:
+                    self._count(label, "shared_collapsed")
+                    return value
+                if not await self.shared.is_locked(lock_key):
+                    break
+            except Exception as e:
+                logging.warning(f"[single_flight] shared store read failed, calling directly: {e}")
+                break
+        return await load()
+
+    def stats(self):
+        return {label: dict(counters) for label, counters in self._stats.items()}
@@ -0,0 +1,186 @@
+import os
+import re
+import zlib
+import logging
+from shared.chunking import chunk_spans
+
+SOURCES_DEDUP_ENABLED = os.environ.get("SOURCES_DEDUP_ENABLED", "true").lower() == "true"
+# Estimated Jaccard similarity of word shingles above which a passage counts as a near duplicate
+SOURCES_NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("SOURCES_NEAR_DUPLICATE_THRESHOLD", "0.9"))
+# Passages shorter than this, and one-line passages, are never dropped: headers,
+# table rows and "Coverage: Yes" lines repeat legitimately
+SOURCES_DEDUP_MIN_CHARS = int(os.environ.get("SOURCES_DEDUP_MIN_CHARS", "200"))
+SHINGLE_WORDS = 5
+MINHASH_PERMUTATIONS = 32
+# Signature rows per LSH band; passages sharing any band are compared
+MINHASH_BAND_ROWS = 4
+# One XOR mask per hash function, fixed so signatures are the same in every worker
+_SEEDS = [zlib.crc32(f"minhash-{i}".encode()) for i in range(MINHASH_PERMUTATIONS)]
+# Between the documents of a list of sources
+PASSAGE_SEPARATOR = "\n\n"
+_BLANK_LINES = re.compile(r"\n(?:[ \t\r\f\v]*\n)+")
+_SPACES = re.compile(r"[ \t\r\f\v]+")
+
+def normalize_whitespace(text):
+    """Collapses runs of spaces and tabs, trims lines and keeps paragraph breaks."""
+    lines = [_SPACES.sub(" ", line).strip() for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def split_passages(text):
+    """
+    (start, end) offsets of the blank-line separated passages of `text`, without
+    their surrounding whitespace. Lines are never split apart, so a source without
+    blank lines is a single passage.
+    """
+    passages = []
+    start = 0
+    for separator in [*_BLANK_LINES.finditer(text), None]:
+        end = separator.start() if separator else len(text)
+        passage = text[start:end]
+        if passage.strip():
+            leading = len(passage) - len(passage.lstrip())
+            passages.append((start + leading, start + len(passage.rstrip())))
+        if separator:
+            start = separator.end()
+    return passages
+
+def split_pieces(text):
+    """(passage, separator) pairs of `text`, each passage with the original text that follows it."""
+    spans = split_passages(text)
+    return [(text[start:end], text[end:spans[index + 1][0]] if index + 1 < len(spans) else "")
+            for index, (start, end) in enumerate(spans)]
+
+def droppable(passage):
+    """Only long passages of several lines are de-duplicated."""
+    return len(passage) >= SOURCES_DEDUP_MIN_CHARS and "\n" in passage
+
+def minhash(passage):
+    words = passage.lower().split()
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+    return tuple(min([h ^ seed for h in hashes]) for seed in _SEEDS)
+
+def _similarity(signature, other):
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+def merge_spans(spans, max_chars):
+    """
+    Joins adjacent spans, together with the text between them, while the joined
+    span stays within `max_chars`.
+    """
+    merged = []
+    for start, end in spans:
+        if merged and end - merged[-1][0] <= max_chars:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+class SourcePlan:
+    """
+    The request's sources after de-duplication, and the chunk plan the source
+    checks share.
+
+    `text` is the kept passages with their original separators. `passages` are
+    their offsets in `text`, split further only where a passage is longer than
+    `max_chunk_chars`; promptShield(sources) sends them as separate documents.
+    `chunks` are adjacent passages joined up to `max_chunk_chars`, for
+    groundedness. Only exact duplicates are removed from this plan: a near
+    duplicate may be the copy that carries an injected instruction. `grounding`
+    is the plan for groundedness, which also drops near duplicates; it is this
+    plan when there are none.
+    """
+
+    def __init__(self, text, passages, max_chunk_chars, original_bytes, exact_duplicates, near_duplicates=0, grounding=None):
+        self.text = text
+        self.passages = [(start + chunk_start, start + chunk_end)
+                         for start, end in passages
+                         for chunk_start, chunk_end in chunk_spans(text[start:end], max_chars=max_chunk_chars)]
+        self.spans = merge_spans(self.passages, max_chunk_chars)
+        self.chunks = [text[start:end] for start, end in self.spans]
+        self.original_bytes = original_bytes
+        self.exact_duplicates = exact_duplicates
+        self.near_duplicates = near_duplicates
+        self.grounding = grounding or self
+
+    @property
+    def bytes_removed(self):
+        return max(0, self.original_bytes - len(self.text.encode("utf-8")))
+
+    def stats(self):
+        return {"original_bytes": self.original_bytes, "bytes_removed": self.bytes_removed,
+                "exact_duplicates": self.exact_duplicates, "near_duplicates": self.near_duplicates,
+                "passages": len(self.passages), "chunks": len(self.chunks), "grounding_chunks": len(self.grounding.chunks)}
+
+def drop_exact_duplicates(pieces, eligible=droppable):
+    """
+    Drops (passage, separator) pieces whose passage was seen before, ignoring
+    whitespace, keeping the first occurrence. Passages that are not `eligible`
+    are always kept.
+    """
+    kept = []
+    seen = set()
+    for piece in pieces:
+        if eligible(piece[0]):
+            key = normalize_whitespace(piece[0])
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(piece)
+    return kept, len(pieces) - len(kept)
+
+def drop_near_duplicates(pieces, threshold=SOURCES_NEAR_DUPLICATE_THRESHOLD):
+    """Drops eligible pieces whose estimated similarity to a kept one reaches `threshold`."""
+    kept = []
+    signatures = []
+    buckets = {}  # (band, band values) -> indexes in signatures
+    for piece in pieces:
+        if not droppable(piece[0]):
+            kept.append(piece)
+            continue
+        signature = minhash(piece[0])
+        bands = [(band, signature[band:band + MINHASH_BAND_ROWS]) for band in range(0, MINHASH_PERMUTATIONS, MINHASH_BAND_ROWS)]
+        candidates = {index for band in bands for index in buckets.get(band, ())}
+        if any(_similarity(signature, signatures[index]) >= threshold for index in candidates):
+            continue
+        for band in bands:
+            buckets.setdefault(band, []).append(len(signatures))
+        kept.append(piece)
+        signatures.append(signature)
+    return kept, len(pieces) - len(kept)
+
+def assemble(pieces):
+    """Joins (passage, separator) pieces back into one text; returns it and the passage offsets."""
+    parts = []
+    passages = []
+    position = 0
+    for index, (passage, separator) in enumerate(pieces):
+        if index + 1 == len(pieces):
+            separator = ""
+        passages.append((position, position + len(passage)))
+        parts.append(passage + separator)
+        position += len(passage) + len(separator)
+    return "".join(parts), passages
+
+def prepare_sources(sources, max_chunk_chars):
+    """Builds the SourcePlan for `sources`, a string or a list of strings."""
+    items = sources if isinstance(sources, list) else [sources or ""]
+    original_bytes = sum(len(item.encode("utf-8")) for item in items)
+    # Whole documents first: the same retrieval hit returned twice
+    documents, exact = drop_exact_duplicates([(item, PASSAGE_SEPARATOR) for item in items if item.strip()], eligible=lambda item: True)
+    pieces = []
+    for document, separator in documents:
+        document_pieces = split_pieces(document)
+        if document_pieces:
+            document_pieces[-1] = (document_pieces[-1][0], separator)
+        pieces.extend(document_pieces)
+    kept, exact_passages = drop_exact_duplicates(pieces)
+    exact += exact_passages
+    unique, near = drop_near_duplicates(kept)
+    grounding = None
+    if near:
+        grounding = SourcePlan(*assemble(unique), max_chunk_chars, original_bytes, exact, near)
+    plan = SourcePlan(*assemble(kept), max_chunk_chars, original_bytes, exact, near, grounding)
+    logging.info(f"[sources] {len(pieces)} passages in {len(plan.chunks)} chunks, removed {exact} exact duplicates "
+                 f"({plan.bytes_removed} of {original_bytes} bytes); {near} near duplicates left out of groundedness")
+    return plan
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import safety_checks.safety_checks as safety_checks
+from shared.chunking import next_chunk_end, chunk_spans
+from shared.clients import content_safety_clients
+
+class _ChunkTrack:
+    """
+    Follows the divide_string chunking of the growing answer for one check and
+    starts a chunk call as soon as that chunk can no longer change.
+    """
+
+    def __init__(self, max_chars, min_chars, chunk_check):
+        self.max_chars = max_chars
+        self.min_chars = min_chars
+        self.chunk_check = chunk_check
+        self.spans = []  # spans whose end is final
+        self.tasks = {}  # span -> asyncio.Task
+        self.next_start = 0
+
+    def advance(self, text, client):
+        # A chunk's end is known once the text reaches one character past its window
+        while len(text) > self.next_start + self.max_chars:
+            end = next_chunk_end(text, self.next_start, self.max_chars)
+            self.spans.append((self.next_start, end))
+            self.next_start = end
+        # With a minimum size the last two chunks of the full answer may be merged and
+        # re-split, and at least one more chunk always follows the final ones
+        safe = len(self.spans) - (1 if self.min_chars else 0)
+        for span in self.spans[:max(safe, 0)]:
+            if span not in self.tasks:
+                self.tasks[span] = asyncio.ensure_future(self.chunk_check(text[span[0]:span[1]], client))
+
+    async def results(self, text, client):
+        final_spans = chunk_spans(text, min_chars=self.min_chars, max_chars=self.max_chars)
+        for span, task in self.tasks.items():
+            if span not in final_spans:
+                task.cancel()
+        checks = []
+        for span in final_spans:
+            task = self.tasks.get(span)
+            checks.append(task if task is not None else self.chunk_check(text[span[0]:span[1]], client))
+        return await asyncio.gather(*checks, return_exceptions=True)
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+class AnswerStreamSession:
+    """
+    Runs the answer's text analysis and protected material checks while the answer
+    is still being generated.
+
+    Feed the LLM output with `append(delta)`; every chunk that divide_string would
+    produce on the full answer is sent as soon as it is complete, so the verdicts
+    are the same as running the checks on the finished answer. `finish()` runs the
+    remaining answer checks and returns the usual (check_results, details).
+    """
+
+    def __init__(self, client=None):
+        self.client = client if client is not None else content_safety_clients
+        self.text = ""
+        self._tracks = {
+            "TextAnalysis": _ChunkTrack(safety_checks.MAX_ANALYZE_TEXT_LENGTH, 0, safety_checks.analyze_text_chunk_check),
+            "protectedMaterial": _ChunkTrack(safety_checks.MAX_PROTECTED_MATERIAL_LENGTH, safety_checks.MIN_PROTECTED_MATERIAL_LENGTH,
+                                             safety_checks.protected_material_chunk_check),
+        }
+
+    def append(self, delta):
+        self.text += delta
+        for track in self._tracks.values():
+            track.advance(self.text, self.client)
+
+    async def _text_analysis(self):
+        results = await self._tracks["TextAnalysis"].results(self.text, self.client)
+        return safety_checks.evaluate_analyze_text_results(results)
+
+    async def _protected_material(self):
+        if len(self.text) < safety_checks.MIN_PROTECTED_MATERIAL_LENGTH:
+            self._tracks["protectedMaterial"].cancel()
+            return await safety_checks.protected_material_detection_wrapper(self.text, self.client)
+        results = await self._tracks["protectedMaterial"].results(self.text, self.client)
+        return safety_checks.evaluate_protected_material_results(results)
+
+    async def finish(self, question, sources, fail_fast=None, profile=None):
+        # Imported here: check_execution pulls in the fairness plugin stack
+        import safety_checks.check_execution as check_execution
+        started = sum(len(track.tasks) for track in self._tracks.values())
+        logging.info(f"[streaming] answer complete ({len(self.text)} chars), {started} chunk checks already started")
+        precomputed = {"TextAnalysis": self._text_analysis(), "protectedMaterial": self._protected_material()}
+        try:
+            return await check_execution.answer_checks(self.text, question, sources, fail_fast=fail_fast,
+                                                       precomputed=precomputed, profile=profile)
+        finally:
+            # Chunk checks of a check the profile skipped are still running
+            self.cancel()
+
+    def cancel(self):
+        for track in self._tracks.values():
+            track.cancel()
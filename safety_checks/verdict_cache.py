@@ -0,0 +1,190 @@
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from shared.identity import get_azure_credential
+from shared.telemetry import traced_chunk, record_chunk_hit
+from shared.deadline import ensure_time
+from safety_checks.single_flight import SingleFlight
+
+CONTENT_SAFETY_API_VERSION = os.environ.get("CONTENT_SAFETY_API_VERSION", "2024-02-15-preview")
+VERDICT_CACHE_ENABLED = os.environ.get("VERDICT_CACHE_ENABLED", "true").lower() == "true"
+VERDICT_CACHE_MAX_ENTRIES = int(os.environ.get("VERDICT_CACHE_MAX_ENTRIES", "10000"))
+VERDICT_CACHE_TTL_SECONDS = int(os.environ.get("VERDICT_CACHE_TTL_SECONDS", "3600"))
+# Optional Cosmos container (partitioned on /id, TTL enabled) shared by all workers
+VERDICT_CACHE_SHARED_CONTAINER = os.environ.get("VERDICT_CACHE_SHARED_CONTAINER")
+AZURE_DB_ID = os.environ.get("AZURE_DB_ID")
+AZURE_DB_NAME = os.environ.get("AZURE_DB_NAME")
+AZURE_DB_URI = f"https://{AZURE_DB_ID}.documents.azure.com:443/"
+
+class CosmosVerdictStore:
+    """Shared verdict tier backed by a Cosmos container; items expire through the container TTL."""
+
+    def __init__(self, container_name, ttl):
+        self.container_name = container_name
+        self.ttl = ttl
+        self._db_client = None
+        self._container = None
+
+    async def _get_container(self):
+        if self._container is None:
+            from azure.cosmos.aio import CosmosClient
+            self._db_client = CosmosClient(AZURE_DB_URI, credential=get_azure_credential())
+            db = self._db_client.get_database_client(database=AZURE_DB_NAME)
+            self._container = db.get_container_client(self.container_name)
+        return self._container
+
+    async def get(self, key):
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        container = await self._get_container()
+        try:
+            item = await container.read_item(item=key, partition_key=key)
+        except CosmosResourceNotFoundError:
+            return None
+        return item.get("verdict")
+
+    async def set(self, key, value):
+        container = await self._get_container()
+        await container.upsert_item(body={"id": key, "verdict": value, "ttl": self.ttl})
+
+    async def try_lock(self, key, ttl):
+        """Creates the lock item; False when another worker holds it."""
+        from azure.cosmos.exceptions import CosmosResourceExistsError
+        container = await self._get_container()
+        try:
+            await container.create_item(body={"id": key, "ttl": max(1, int(ttl))})
+        except CosmosResourceExistsError:
+            return False
+        return True
+
+    async def is_locked(self, key):
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        container = await self._get_container()
+        try:
+            await container.read_item(item=key, partition_key=key)
+        except CosmosResourceNotFoundError:
+            return False
+        return True
+
+    async def release(self, key):
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        container = await self._get_container()
+        try:
+            await container.delete_item(item=key, partition_key=key)
+        except CosmosResourceNotFoundError:
+            pass
+
+class VerdictCache:
+    """
+    Chunk-level cache of Content Safety verdicts.
+
+    Keys combine the check type, the API version, the blocklists in use and a
+    SHA-256 of the chunk text, so a verdict is only reused for an identical call.
+    The in-memory tier is an LRU with a per-entry TTL; an optional shared tier is
+    consulted on local misses. Only successful calls are cached. Concurrent misses
+    for the same key share one call through `single_flight`, cache or not.
+    """
+
+    def __init__(self, max_entries=VERDICT_CACHE_MAX_ENTRIES, ttl=VERDICT_CACHE_TTL_SECONDS, shared=None, enabled=True,
+                 single_flight=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.enabled = enabled
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._stats = {}
+
+    @staticmethod
+    def make_key(check, parts, blocklists=()):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update((part or "").encode("utf-8"))
+            digest.update(b"\x1f")
+        return f"{check}|{CONTENT_SAFETY_API_VERSION}|{','.join(sorted(blocklists))}|{digest.hexdigest()}"
+
+    def _count(self, check, outcome):
+        counters = self._stats.setdefault(check, {"hits": 0, "shared_hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.time() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key, value):
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def cached(self, check, parts, call, blocklists=()):
+        """
+        Returns the cached (check_result, details) for this chunk, or awaits `call()`
+        and stores its result. `call` is a zero-argument coroutine factory.
+        """
+        payload_chars = sum(len(part) for part in parts if isinstance(part, str))
+        key = self.make_key(check, parts, blocklists)
+        if not self.enabled:
+            ensure_time(check)
+            return await self.single_flight.do(key, lambda: traced_chunk(check, payload_chars, call()), label=check)
+        value = self._get_local(key)
+        if value is not None:
+            self._count(check, "hits")
+            record_chunk_hit(check, payload_chars)
+            return tuple(value)
+        if self.shared is not None:
+            try:
+                value = await self.shared.get(key)
+            except Exception as e:
+                logging.warning(f"[verdict_cache] shared tier read failed: {e}")
+                value = None
+            if value is not None:
+                self._count(check, "shared_hits")
+                self._set_local(key, value)
+                record_chunk_hit(check, payload_chars)
+                return tuple(value)
+        self._count(check, "misses")
+        # Verdicts already known are returned whatever the deadline; new calls need time left
+        ensure_time(check)
+        lookup = self._shared_lookup(key) if self.shared is not None else None
+        return await self.single_flight.do(key, lambda: self._load(check, key, payload_chars, call), lookup, label=check)
+
+    async def _load(self, check, key, payload_chars, call):
+        result = await traced_chunk(check, payload_chars, call())
+        self._set_local(key, result)
+        if self.shared is not None:
+            try:
+                await self.shared.set(key, list(result))
+            except Exception as e:
+                logging.warning(f"[verdict_cache] shared tier write failed: {e}")
+        return result
+
+    def _shared_lookup(self, key):
+        async def lookup():
+            value = await self.shared.get(key)
+            if value is None:
+                return None
+            self._set_local(key, value)
+            return tuple(value)
+        return lookup
+
+    def stats(self):
+        result = {}
+        for check, counters in self._stats.items():
+            total = counters["hits"] + counters["shared_hits"] + counters["misses"]
+            result[check] = dict(counters, hit_rate=round((counters["hits"] + counters["shared_hits"]) / total, 4) if total else 0.0)
+        return result
+
+    def clear(self):
+        self._entries.clear()
+
+shared_store = CosmosVerdictStore(VERDICT_CACHE_SHARED_CONTAINER, VERDICT_CACHE_TTL_SECONDS) if VERDICT_CACHE_SHARED_CONTAINER else None
+verdict_cache = VerdictCache(shared=shared_store, enabled=VERDICT_CACHE_ENABLED, single_flight=SingleFlight(shared=shared_store))
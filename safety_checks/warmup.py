@@ -0,0 +1,63 @@
+import os
+import time
+import asyncio
+import logging
+from shared.chunking import chunk_spans
+from shared.clients import content_safety_clients
+from shared.telemetry import configure_exporter
+from safety_checks.prefilter import local_prefilter, LOCAL_PREFILTER_ENABLED
+from safety_checks.sources import prepare_sources
+
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "true").lower() == "true"
+RESPONSABLE_AI_CHECK = os.environ.get("RESPONSABLE_AI_CHECK", "false").lower() == "true"
+_SAMPLE_TEXT = "Warm-up text. " * 100
+
+_warmups = {}  # event loop -> warm-up task
+
+def _prime_chunker():
+    chunk_spans(_SAMPLE_TEXT, max_chars=200, boundary="paragraph")
+    prepare_sources(_SAMPLE_TEXT, 200)
+
+def _load_plugins():
+    # Imported here: loading the plugins is what pulls in Semantic Kernel
+    from plugins.registry import plugin_registry
+    plugin_registry.load_all()
+
+async def _create_clients():
+    await asyncio.gather(*(content_safety_clients.get_client(endpoint) for endpoint in content_safety_clients.endpoints))
+
+async def _warm_up():
+    steps = [("telemetry_exporter", configure_exporter), ("content_safety_clients", _create_clients), ("chunker", _prime_chunker)]
+    if LOCAL_PREFILTER_ENABLED:
+        steps.append(("prefilter", local_prefilter.load))
+    if RESPONSABLE_AI_CHECK:
+        steps.append(("plugins", _load_plugins))
+    timings = {}
+    for name, step in steps:
+        start_time = time.time()
+        try:
+            result = step()
+            if asyncio.iscoroutine(result):
+                await result
+            timings[name] = round((time.time() - start_time) * 1000, 2)
+        except Exception as e:
+            # A failed step is retried lazily by the first request that needs it
+            logging.warning(f"[warmup] {name} failed: {e}")
+            timings[name] = None
+    logging.info(f"[warmup] done: {timings}")
+    return timings
+
+async def warm_up():
+    """
+    Configures the telemetry exporter, creates the shared Content Safety client
+    and builds the chunker, local pre-filter and plugins ahead of the first request, so that request does not
+    pay for them. Runs once per event loop; concurrent callers share the run.
+    Returns the milliseconds each step took (None for a step that failed).
+    """
+    if not WARMUP_ENABLED:
+        return {}
+    loop = asyncio.get_running_loop()
+    task = _warmups.get(loop)
+    if task is None:
+        task = _warmups[loop] = asyncio.ensure_future(_warm_up())
+    return await asyncio.shield(task)
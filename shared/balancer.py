@@ -0,0 +1,160 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from shared.identity import get_azure_credential
+
+AZURE_DB_ID = os.environ.get("AZURE_DB_ID")
+AZURE_DB_NAME = os.environ.get("AZURE_DB_NAME")
+AZURE_DB_URI = f"https://{AZURE_DB_ID}.documents.azure.com:443/"
+# round_robin | least_outstanding | latency_weighted
+AZURE_OPENAI_BALANCING_STRATEGY = os.environ.get("AZURE_OPENAI_BALANCING_STRATEGY", "round_robin").lower()
+AZURE_OPENAI_RESOURCES_SYNC_SECONDS = float(os.environ.get("AZURE_OPENAI_RESOURCES_SYNC_SECONDS", "300"))
+AZURE_OPENAI_COOLDOWN_SECONDS = float(os.environ.get("AZURE_OPENAI_COOLDOWN_SECONDS", "30"))
+# Smoothing factor of the latency moving average
+LATENCY_EWMA_ALPHA = 0.2
+
+class _ResourceState:
+    def __init__(self):
+        self.outstanding = 0
+        self.latency = None
+        self.cooldown_until = 0
+        self.requests = 0
+        self.failures = 0
+
+class ResourceBalancer:
+    """
+    Picks the Azure OpenAI resource for each call without a shared-store round trip.
+
+    Selection is local to the worker (asyncio runs it without interleaving, so no
+    lock is needed). The resource list is reconciled with the Cosmos 'models' item
+    at most every AZURE_OPENAI_RESOURCES_SYNC_SECONDS. Resources that answer 429 or
+    5xx are skipped until their cooldown ends, unless every resource is cooling down.
+    """
+
+    def __init__(self, strategy=AZURE_OPENAI_BALANCING_STRATEGY):
+        self.strategy = strategy
+        self._resources = {}  # model -> list of resources
+        self._synced_at = {}  # model -> time of the last Cosmos sync
+        self._cursor = {}  # model -> round robin position
+        self._states = {}  # resource -> _ResourceState
+
+    def _state(self, resource):
+        state = self._states.get(resource)
+        if state is None:
+            state = self._states[resource] = _ResourceState()
+        return state
+
+    async def next_resource(self, model, configured_resources):
+        if time.time() - self._synced_at.get(model, 0) >= AZURE_OPENAI_RESOURCES_SYNC_SECONDS:
+            await self._sync(model, configured_resources)
+        resources = self._resources.get(model) or configured_resources
+        now = time.time()
+        available = [resource for resource in resources if self._state(resource).cooldown_until <= now] or resources
+        if self.strategy == "least_outstanding":
+            resource = min(available, key=lambda r: self._state(r).outstanding)
+        elif self.strategy == "latency_weighted":
+            # Unmeasured resources get the best known latency so they are tried too
+            known = [self._state(r).latency for r in available if self._state(r).latency]
+            default = min(known) if known else 1.0
+            weights = [1 / (self._state(r).latency or default) for r in available]
+            resource = random.choices(available, weights=weights)[0]
+        else:
+            # Start each worker at a random offset so workers do not move in lockstep
+            cursor = self._cursor.get(model)
+            if cursor is None:
+                cursor = random.randrange(len(resources))
+            resource = available[cursor % len(available)]
+            self._cursor[model] = cursor + 1
+        logging.info(f"[balancer] model '{model}' resource {resource} ({self.strategy})")
+        return resource
+
+    async def _sync(self, model, configured_resources):
+        # Set first so a failing sync is not retried on every call
+        self._synced_at[model] = time.time()
+        start_time = time.time()
+        # Imported here so Cosmos is only loaded by workers that balance across resources
+        from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            async with AsyncCosmosClient(AZURE_DB_URI, get_azure_credential()) as db_client:
+                db = db_client.get_database_client(database=AZURE_DB_NAME)
+                container = db.get_container_client('models')
+                try:
+                    keyvalue = await container.read_item(item=model, partition_key=model)
+                    # The configured list wins; only write when it changed
+                    if set(keyvalue["resources"]) != set(configured_resources):
+                        keyvalue["resources"] = configured_resources
+                        await container.replace_item(item=model, body=keyvalue)
+                except CosmosResourceNotFoundError:
+                    logging.info(f"[balancer] keyvalue store with '{model}' id does not exist, creating a new one.")
+                    keyvalue = await container.create_item(body={"id": model, "resources": configured_resources})
+            self._resources[model] = list(keyvalue["resources"])
+        except Exception as e:
+            logging.warning(f"[balancer] could not sync resources for '{model}' with Cosmos, using configured list: {e}")
+            self._resources[model] = list(configured_resources)
+        response_time = round(time.time() - start_time, 2)
+        logging.info(f"[balancer] synced resources for '{model}'. {response_time} seconds")
+
+    async def observe(self, resource, awaitable):
+        """
+        Awaits a call made against `resource`, tracking outstanding requests and
+        latency, and starting a cooldown when it fails with 429 or 5xx.
+        """
+        if resource is None:
+            return await awaitable
+        state = self._state(resource)
+        state.outstanding += 1
+        state.requests += 1
+        start_time = time.time()
+        try:
+            result = await awaitable
+        except asyncio.CancelledError:
+            # Cut short by a timeout: the resource took at least this long
+            self._record_latency(state, time.time() - start_time)
+            raise
+        except Exception as e:
+            if resource_failure(e):
+                state.failures += 1
+                state.cooldown_until = time.time() + AZURE_OPENAI_COOLDOWN_SECONDS
+                logging.warning(f"[balancer] resource {resource} returned {_status_code(e)}, cooling down for {AZURE_OPENAI_COOLDOWN_SECONDS}s")
+            raise
+        finally:
+            state.outstanding -= 1
+        self._record_latency(state, time.time() - start_time)
+        return result
+
+    @staticmethod
+    def _record_latency(state, elapsed):
+        state.latency = elapsed if state.latency is None else LATENCY_EWMA_ALPHA * elapsed + (1 - LATENCY_EWMA_ALPHA) * state.latency
+
+    def available(self, model):
+        """Whether one of the model's synced resources is out of cooldown."""
+        now = time.time()
+        return any(self._state(resource).cooldown_until <= now for resource in self._resources.get(model, ()))
+
+    def stats(self):
+        now = time.time()
+        return {resource: {"outstanding": state.outstanding, "latency_s": round(state.latency, 3) if state.latency else None,
+                           "requests": state.requests, "failures": state.failures,
+                           "cooling_down": state.cooldown_until > now}
+                for resource, state in self._states.items()}
+
+def resource_failure(exception):
+    """A 429 or 5xx: the resource is overloaded or failing, and another one may answer."""
+    status_code = _status_code(exception)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+def _status_code(exception):
+    """Finds an HTTP status code on the exception or the exceptions it wraps."""
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        seen.add(id(exception))
+        status_code = getattr(exception, "status_code", None)
+        if isinstance(status_code, int):
+            return status_code
+        exception = exception.__cause__ or exception.__context__
+    return None
+
+aoai_balancer = ResourceBalancer()
@@ -0,0 +1,100 @@
+import re
+
+WHITESPACE = (' ', '\n', '\t')
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*[ \t\n]")
+
+def _last_whitespace(s, start, end):
+    """Index of the last whitespace character in s[start:end], or -1."""
+    return max(s.rfind(c, start, end) for c in WHITESPACE)
+
+def _first_whitespace(s, start, end):
+    found = [i for i in (s.find(c, start, end) for c in WHITESPACE) if i != -1]
+    return min(found) if found else -1
+
+def _last_match_end(pattern, s, start, end):
+    last = -1
+    for match in pattern.finditer(s, start, end):
+        last = match.end()
+    return last
+
+def _boundary_end(s, current_pos, end_pos, boundary):
+    """
+    Looks for a paragraph or sentence break in the second half of the window.
+    Returns the end position of the chunk, or -1 to fall back to whitespace.
+    """
+    window_start = current_pos + (end_pos - current_pos) // 2
+    patterns = [PARAGRAPH_BREAK, SENTENCE_END] if boundary == "paragraph" else [SENTENCE_END]
+    for pattern in patterns:
+        found = _last_match_end(pattern, s, window_start, end_pos)
+        if found > current_pos:
+            return found
+    return -1
+
+def next_chunk_end(s, current_pos, max_chars=1000, boundary="word"):
+    """
+    End of the chunk starting at `current_pos`. It only depends on
+    s[current_pos:current_pos + max_chars + 1], so a chunk is final as soon as that
+    much text is known, which is what streaming callers rely on.
+    """
+    length = len(s)
+    end_pos = min(length, current_pos + max_chars)
+    if end_pos < length and s[end_pos] not in WHITESPACE:
+        found = _boundary_end(s, current_pos, end_pos, boundary) if boundary != "word" else -1
+        if found == -1:
+            found = _last_whitespace(s, current_pos, end_pos) + 1
+        # No whitespace in the window: cut at the hard limit
+        if found > current_pos:
+            end_pos = found
+    elif end_pos < length and boundary != "word":
+        found = _boundary_end(s, current_pos, end_pos, boundary)
+        if found > current_pos:
+            end_pos = found
+    return end_pos
+
+def chunk_spans(s, min_chars=0, max_chars=1000, boundary="word"):
+    """
+    Splits `s` into (start, end) spans of at most `max_chars` characters in a single pass.
+
+    With boundary="word" the spans are the ones divide_string has always produced:
+    each chunk ends after the last whitespace inside the window (or at the hard
+    limit when there is none), and a final chunk shorter than `min_chars` is merged
+    with the previous one and split again near the middle. One intended
+    difference: where that split point would leave a piece over `max_chars`,
+    divide_string returned it as is and this splits at the exact middle instead
+    (see tests/test_chunking.py). With "sentence" or
+    "paragraph" the chunk ends at the last such break in the second half of the
+    window, falling back to whitespace.
+    """
+    spans = []
+    length = len(s)
+    current_pos = 0
+    while current_pos < length:
+        end_pos = next_chunk_end(s, current_pos, max_chars, boundary)
+        spans.append((current_pos, end_pos))
+        current_pos = end_pos
+
+    if len(spans) > 1 and spans[-1][1] - spans[-1][0] < min_chars:
+        start = spans[-2][0]
+        combined_length = length - start
+        half = combined_length // 2
+        # Nearest whitespace at or after the middle, else before it
+        split_point = _first_whitespace(s, start + half, length)
+        if split_point == -1:
+            split_point = _last_whitespace(s, start + 1, start + half + 1)
+        split_point = half if split_point == -1 else split_point - start
+        # Never produce a piece over the API limit
+        if split_point > max_chars or combined_length - split_point > max_chars:
+            split_point = half
+        spans[-2:] = [(start, start + split_point), (start + split_point, length)]
+
+    return spans
+
+def materialize(s, spans):
+    """Returns the chunk strings for `spans`."""
+    return [s[start:end] for start, end in spans]
+
+def iter_chunks(s, spans):
+    """Yields the chunk strings one at a time, so only one copy is alive at once."""
+    for start, end in spans:
+        yield s[start:end]
@@ -0,0 +1,246 @@
+import os
+import time
+import atexit
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ClientAuthenticationError
+from azure.ai.contentsafety.aio import ContentSafetyClient
+from shared.identity import get_azure_credential, new_azure_credential, close_azure_credential
+from shared.secret_cache import invalidate_secret
+from shared.rate_limiter import content_safety_scheduler
+from shared.telemetry import record_setup
+
+CONTENT_SAFETY_ENDPOINT = os.environ.get("CONTENT_SAFETY_ENDPOINT")
+APIM_ENABLED = os.environ.get("APIM_ENABLED", "false").lower() == "true"
+APIM_ENDPOINT = os.environ.get("APIM_ENDPOINT")
+# Comma-separated endpoints (regions or APIM gateways) in order of preference; replaces the single endpoint above
+CONTENT_SAFETY_ENDPOINTS = [endpoint.strip() for endpoint in os.environ.get("CONTENT_SAFETY_ENDPOINTS", "").split(",") if endpoint.strip()]
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+# Refresh the AAD token this many seconds before it expires
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+TOKEN_REFRESH_RETRY_SECONDS = 30
+
+class ContentSafetyClientManager:
+    """
+    Owns the worker's ContentSafetyClients, one per endpoint, for its whole lifetime.
+
+    A client is created on first use and kept open so that its connection pool
+    is reused across invocations. In AAD mode a background task keeps the token
+    warm so requests never wait on token acquisition. When the service answers
+    401 the endpoint's client is replaced (re-reading the APIM key, or with a new
+    AAD credential whose token cache does not hold the rejected token) and the
+    call is retried once; the old client is closed once the calls still using it
+    have finished. With CONTENT_SAFETY_ENDPOINTS, the shared scheduler picks the
+    endpoint of each call, fails over and hedges (see RequestScheduler.dispatch).
+
+    The manager exposes `send_request` and `analyze_text` with the same shape as
+    ContentSafetyClient, so it can be passed wherever a client is expected.
+    """
+
+    def __init__(self):
+        self._clients = {}  # endpoint -> ContentSafetyClient
+        self._in_use = {}  # client -> calls in flight
+        self._retired = set()  # replaced clients, closed when their last call finishes
+        self._credential = None
+        self._renew_credential = False  # the next AAD client gets a new credential
+        self._owned_credentials = set()  # credentials created here rather than the shared one
+        self._client_credentials = {}  # client -> credential it was built with
+        self._loop = None
+        self._lock = None
+        self._refresh_task = None
+        self.rebuilds = 0
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Objects created on another loop cannot be used (or closed) here
+            self._clients = {}
+            self._in_use = {}
+            self._retired = set()
+            self._credential = None
+            self._renew_credential = False
+            self._owned_credentials = set()
+            self._client_credentials = {}
+            self._refresh_task = None
+            self._lock = asyncio.Lock()
+            self._loop = loop
+
+    async def get_client(self, endpoint=None):
+        self._bind_loop()
+        endpoint = endpoint or self.endpoints[0]
+        client = self._clients.get(endpoint)
+        if client is not None:
+            return client
+        async with self._lock:
+            if endpoint not in self._clients:
+                await self._build(endpoint)
+        return self._clients[endpoint]
+
+    async def _build(self, endpoint):
+        start_time = time.time()
+        if self._credential is None:
+            if APIM_ENABLED:
+                # Imported lazily: shared.util pulls in Semantic Kernel and Cosmos
+                from shared.util import get_secret
+                self._credential = AzureKeyCredential(await get_secret("apimSubscriptionKey"))
+            elif self._renew_credential:
+                # The shared credential's cached token was rejected: start from an empty cache
+                self._credential = new_azure_credential()
+                self._owned_credentials.add(self._credential)
+                self._renew_credential = False
+                self._refresh_task = asyncio.create_task(self._refresh_token(self._credential))
+            else:
+                self._credential = get_azure_credential()
+                self._refresh_task = asyncio.create_task(self._refresh_token(self._credential))
+        # Status retries are left to the shared scheduler so they can back off across requests
+        client = ContentSafetyClient(endpoint=endpoint, credential=self._credential, retry_status=0)
+        await client.__aenter__()
+        self._clients[endpoint] = client
+        self._client_credentials[client] = self._credential
+        record_setup("content_safety_client", time.time() - start_time)
+        response_time = round(time.time() - start_time, 2)
+        logging.info(f"[clients] content safety client created for {endpoint}. {response_time} seconds")
+
+    async def _refresh_token(self, credential):
+        while True:
+            try:
+                token = await credential.get_token(COGNITIVE_SERVICES_SCOPE)
+                delay = max(token.expires_on - time.time() - TOKEN_REFRESH_MARGIN_SECONDS, TOKEN_REFRESH_RETRY_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[clients] background token refresh failed: {e}")
+                delay = TOKEN_REFRESH_RETRY_SECONDS
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def _lease(self, endpoint):
+        """The endpoint's current client, kept open until the block exits."""
+        client = await self.get_client(endpoint)
+        self._in_use[client] = self._in_use.get(client, 0) + 1
+        try:
+            yield client
+        finally:
+            self._in_use[client] -= 1
+            if not self._in_use[client]:
+                del self._in_use[client]
+                if client in self._retired:
+                    self._retired.discard(client)
+                    await self._close_client(client)
+
+    async def _close_client(self, client):
+        try:
+            await client.close()
+        except Exception as e:
+            logging.warning(f"[clients] error closing content safety client: {e}")
+        await self._release_credential(self._client_credentials.pop(client, None))
+
+    async def _release_credential(self, credential):
+        """Closes a credential created here once no client uses it and it is not the current one."""
+        if (credential not in self._owned_credentials or credential is self._credential
+                or credential in self._client_credentials.values()):
+            return
+        self._owned_credentials.discard(credential)
+        try:
+            await credential.close()
+        except Exception as e:
+            logging.warning(f"[clients] error closing credential: {e}")
+
+    async def invalidate(self, client=None, renew_credential=False):
+        """
+        Replaces `client` (every client when None) so the next calls build new ones,
+        with a new credential; with `renew_credential`, an AAD credential of their
+        own rather than the shared one. Nothing happens unless `client` is still a
+        current one, which keeps concurrent callers from rebuilding it several
+        times. A client is closed now if no call is using it, else when its last
+        call ends.
+        """
+        self._bind_loop()
+        async with self._lock:
+            if client is None:
+                old_clients = list(self._clients.values())
+                self._clients = {}
+            elif client in self._clients.values():
+                old_clients = [client]
+                self._clients = {endpoint: current for endpoint, current in self._clients.items() if current is not client}
+            else:
+                return
+            if not old_clients:
+                return
+            old_credential = self._credential
+            self._credential = None
+            self._renew_credential = renew_credential
+            if self._refresh_task is not None:
+                self._refresh_task.cancel()
+                self._refresh_task = None
+            self.rebuilds += 1
+            idle = [old_client for old_client in old_clients if old_client not in self._in_use]
+            self._retired.update(old_client for old_client in old_clients if old_client in self._in_use)
+        for old_client in idle:
+            await self._close_client(old_client)
+        await self._release_credential(old_credential)
+
+    async def _on_auth_failure(self, client):
+        if APIM_ENABLED:
+            # The subscription key may have been rotated; re-read it from Key Vault
+            invalidate_secret("apimSubscriptionKey")
+        await self.invalidate(client, renew_credential=not APIM_ENABLED)
+
+    @property
+    def endpoint(self):
+        return APIM_ENDPOINT if APIM_ENABLED else CONTENT_SAFETY_ENDPOINT
+
+    @property
+    def endpoints(self):
+        return CONTENT_SAFETY_ENDPOINTS or [self.endpoint]
+
+    async def send_request(self, request, **kwargs):
+        operation = request.url.split("?")[0].lstrip("/")
+        # send_request copies the request, so the same one can go to two endpoints when hedged
+        return await content_safety_scheduler.dispatch(self.endpoints, operation,
+                                                       lambda endpoint: self._send_request(endpoint, request, **kwargs))
+
+    async def _send_request(self, endpoint, request, **kwargs):
+        async with self._lease(endpoint) as client:
+            response = await client.send_request(request, **kwargs)
+        if response.status_code == 401:
+            logging.warning(f"[clients] content safety returned 401 on {endpoint}, rebuilding client")
+            await response.close()
+            await self._on_auth_failure(client)
+            async with self._lease(endpoint) as client:
+                response = await client.send_request(request, **kwargs)
+        return response
+
+    async def analyze_text(self, options, **kwargs):
+        return await content_safety_scheduler.dispatch(self.endpoints, "text:analyze",
+                                                       lambda endpoint: self._analyze_text(endpoint, options, **kwargs))
+
+    async def _analyze_text(self, endpoint, options, **kwargs):
+        try:
+            async with self._lease(endpoint) as client:
+                return await client.analyze_text(options=options, **kwargs)
+        except ClientAuthenticationError:
+            logging.warning(f"[clients] content safety rejected credentials on {endpoint}, rebuilding client")
+            await self._on_auth_failure(client)
+            async with self._lease(endpoint) as client:
+                return await client.analyze_text(options=options, **kwargs)
+
+    async def close(self):
+        if self._loop is not None and self._loop is asyncio.get_running_loop():
+            await self.invalidate()
+        await close_azure_credential()
+
+content_safety_clients = ContentSafetyClientManager()
+
+def _close_on_exit():
+    loop = content_safety_clients._loop
+    if loop is None or loop.is_closed() or loop.is_running():
+        return
+    try:
+        loop.run_until_complete(content_safety_clients.close())
+    except Exception as e:
+        logging.warning(f"[clients] error closing clients on shutdown: {e}")
+
+atexit.register(_close_on_exit)
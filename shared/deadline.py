@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Budget used when the caller sends none; 0 means no deadline
+REQUEST_DEADLINE_MS = float(os.environ.get("REQUEST_DEADLINE_MS", "0"))
+REQUEST_DEADLINE_HEADER = os.environ.get("REQUEST_DEADLINE_HEADER", "x-request-deadline-ms")
+# Kept back from the caller's budget to build and send the response
+DEADLINE_RESPONSE_MARGIN_MS = float(os.environ.get("DEADLINE_RESPONSE_MARGIN_MS", "50"))
+# A remote call is not started, or retried, with less time than this left
+DEADLINE_MIN_CALL_MS = float(os.environ.get("DEADLINE_MIN_CALL_MS", "100"))
+# Verdict when checks timed out: "fail" (fail closed), "pass" (decide on the completed checks) or "report" (no verdict)
+DEADLINE_DEGRADED_VERDICT = os.environ.get("DEADLINE_DEGRADED_VERDICT", "fail").lower()
+TIMED_OUT = "TimedOut"
+
+# time.monotonic() value by which the current request must be answered
+_deadline = ContextVar("request_deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    """A check or call that could not finish before the request deadline; reported as TimedOut."""
+
+    status = TIMED_OUT
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+def parse_deadline_ms(headers, body, default=REQUEST_DEADLINE_MS):
+    """
+    The request's latency budget in milliseconds: the `deadline_ms` body field, else
+    the REQUEST_DEADLINE_HEADER header, else `default`. None without one.
+    Raises ValueError for a value that is not a positive number.
+    """
+    value = body.get("deadline_ms") if isinstance(body, dict) else None
+    if value is None and headers is not None:
+        value = headers.get(REQUEST_DEADLINE_HEADER)
+    if value is None:
+        return default or None
+    try:
+        deadline_ms = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"deadline must be a number of milliseconds, got {value!r}")
+    if deadline_ms <= 0:
+        raise ValueError(f"deadline must be a positive number of milliseconds, got {value}")
+    return deadline_ms
+
+@contextmanager
+def deadline_scope(deadline_ms):
+    """
+    Runs the block, and every task it starts, under a deadline `deadline_ms` from
+    now. An enclosing deadline (e.g. of a whole batch) is never extended.
+    """
+    deadline = _deadline.get()
+    if deadline_ms:
+        own = time.monotonic() + max(0, deadline_ms - DEADLINE_RESPONSE_MARGIN_MS) / 1000
+        deadline = own if deadline is None else min(deadline, own)
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+def clear_deadline():
+    """Removes the deadline from the current task, for work shared by requests with different deadlines."""
+    _deadline.set(None)
+
+def remaining():
+    """Seconds left before the current deadline, or None without one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def ensure_time(operation, needed=0):
+    """Raises DeadlineExceeded unless `needed` seconds plus DEADLINE_MIN_CALL_MS are left."""
+    left = remaining()
+    if left is not None and left < needed + DEADLINE_MIN_CALL_MS / 1000:
+        raise DeadlineExceeded(f"{operation} was not started: {max(0, round(left * 1000))} ms left before the request deadline")
+
+async def within_deadline(check, name, close=None):
+    """
+    Awaits the `check` coroutine, cancelling it at the deadline; not started at all
+    when too little time is left. A check that is not started is closed, through
+    `close(check, error)` when given (for checks that wrap other awaitables).
+    """
+    left = remaining()
+    if left is None:
+        return await check
+    try:
+        ensure_time(name)
+    except DeadlineExceeded as e:
+        if close is not None:
+            close(check, e)
+        elif asyncio.iscoroutine(check):
+            check.close()
+        raise
+    try:
+        return await asyncio.wait_for(check, timeout=left)
+    except asyncio.TimeoutError:
+        if remaining() > 0:
+            # Raised by the check itself, not by the deadline
+            raise
+        raise DeadlineExceeded(f"{name} did not finish before the request deadline")
+
+def degraded_verdict(check_results, mode=DEADLINE_DEGRADED_VERDICT):
+    """
+    The overall verdict when some checks timed out: "Failed" or "Passed" according
+    to DEADLINE_DEGRADED_VERDICT, or None when nothing timed out or in "report" mode.
+    """
+    if TIMED_OUT not in check_results.values() or mode == "report":
+        return None
+    if mode == "pass":
+        return "Failed" if "Failed" in check_results.values() else "Passed"
+    return "Failed"
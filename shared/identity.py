@@ -0,0 +1,42 @@
+import asyncio
+import logging
+from azure.identity.aio import DefaultAzureCredential
+
+##########################################################
+# PROCESS-WIDE CREDENTIAL
+##########################################################
+
+_credential = None
+_credential_loop = None
+
+def get_azure_credential():
+    """
+    Returns the worker's shared DefaultAzureCredential.
+
+    The credential keeps its own token cache, so sharing one instance lets every
+    client in the process reuse tokens instead of acquiring them per request.
+    A new instance is created if the event loop changed since the last call.
+    """
+    global _credential, _credential_loop
+    loop = asyncio.get_running_loop()
+    if _credential is None or _credential_loop is not loop:
+        _credential = DefaultAzureCredential()
+        _credential_loop = loop
+        logging.info("[identity] created shared DefaultAzureCredential")
+    return _credential
+
+async def close_azure_credential():
+    global _credential, _credential_loop
+    credential = _credential
+    _credential = None
+    _credential_loop = None
+    if credential is not None:
+        await credential.close()
+
+def new_azure_credential():
+    """
+    Returns a DefaultAzureCredential of the caller's own, with an empty token
+    cache, for when a token of the shared one was rejected. The caller closes it.
+    """
+    logging.info("[identity] created a new DefaultAzureCredential")
+    return DefaultAzureCredential()
@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from shared.telemetry import record_api_call, record_hedge, record_endpoint_ejection
+from shared.deadline import ensure_time, DeadlineExceeded
+
+CONTENT_SAFETY_ENDPOINT_CONCURRENCY = int(os.environ.get("CONTENT_SAFETY_ENDPOINT_CONCURRENCY", "32"))
+CONTENT_SAFETY_OPERATION_CONCURRENCY = int(os.environ.get("CONTENT_SAFETY_OPERATION_CONCURRENCY", "16"))
+# Requests per second per operation; 0 disables the token bucket
+CONTENT_SAFETY_OPERATION_RPS = float(os.environ.get("CONTENT_SAFETY_OPERATION_RPS", "50"))
+# Per-operation overrides, e.g. {"text:shieldPrompt": {"concurrency": 8, "rps": 20}}
+CONTENT_SAFETY_OPERATION_LIMITS = json.loads(os.environ.get("CONTENT_SAFETY_OPERATION_LIMITS") or "{}")
+CONTENT_SAFETY_MAX_RETRIES = int(os.environ.get("CONTENT_SAFETY_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 20
+THROTTLE_STATUS_CODES = (429, 503)
+# Operations sent again to a second endpoint when the first is slow to answer
+CONTENT_SAFETY_HEDGED_OPERATIONS = [operation.strip() for operation in os.environ.get(
+    "CONTENT_SAFETY_HEDGED_OPERATIONS", "text:shieldPrompt,text:detectJailbreak").split(",") if operation.strip()]
+# The hedge is sent once the first call has taken longer than this latency percentile
+CONTENT_SAFETY_HEDGE_PERCENTILE = float(os.environ.get("CONTENT_SAFETY_HEDGE_PERCENTILE", "95"))
+CONTENT_SAFETY_HEDGE_MIN_DELAY_MS = float(os.environ.get("CONTENT_SAFETY_HEDGE_MIN_DELAY_MS", "20"))
+# Used until an endpoint has CONTENT_SAFETY_HEDGE_MIN_SAMPLES latencies for the operation
+CONTENT_SAFETY_HEDGE_DEFAULT_DELAY_MS = float(os.environ.get("CONTENT_SAFETY_HEDGE_DEFAULT_DELAY_MS", "500"))
+CONTENT_SAFETY_HEDGE_MIN_SAMPLES = int(os.environ.get("CONTENT_SAFETY_HEDGE_MIN_SAMPLES", "20"))
+# An endpoint whose last CONTENT_SAFETY_HEALTH_WINDOW calls reach this error rate is ejected for a while
+CONTENT_SAFETY_HEALTH_WINDOW = int(os.environ.get("CONTENT_SAFETY_HEALTH_WINDOW", "50"))
+CONTENT_SAFETY_EJECT_ERROR_RATE = float(os.environ.get("CONTENT_SAFETY_EJECT_ERROR_RATE", "0.5"))
+CONTENT_SAFETY_EJECT_MIN_REQUESTS = int(os.environ.get("CONTENT_SAFETY_EJECT_MIN_REQUESTS", "10"))
+CONTENT_SAFETY_EJECT_SECONDS = float(os.environ.get("CONTENT_SAFETY_EJECT_SECONDS", "30"))
+LATENCY_SAMPLES = 200
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def parse_retry_after(headers):
+    """Seconds to wait according to the Retry-After family of headers, or None."""
+    if not headers:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("Retry-After", 1)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue
+    return None
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Limiter:
+    """
+    Concurrency cap and optional token bucket for one endpoint or operation.
+
+    The bucket rate is adaptive: it halves when the service throttles and grows
+    back by 5% of the configured rate on each success. A Retry-After value pauses
+    all new requests through this limiter until it has elapsed.
+    """
+
+    def __init__(self, name, concurrency, rps=0):
+        self.name = name
+        self.max_rps = rps
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rps) if rps > 0 else None
+        self._paused_until = 0
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        start = time.monotonic()
+        self.queue_depth += 1
+        try:
+            # Paced before taking a concurrency slot, so a request waiting on the
+            # rate or a Retry-After pause never holds a slot others could use
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            await self._semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+        waited = time.monotonic() - start
+        self.requests += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def on_throttled(self, retry_after=None):
+        self.throttled += 1
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        if self._bucket is not None:
+            self._bucket.rate = max(self._bucket.rate / 2, 1)
+
+    def on_success(self):
+        if self._bucket is not None and self._bucket.rate < self.max_rps:
+            self._bucket.rate = min(self.max_rps, self._bucket.rate + self.max_rps * 0.05)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "wait_time_avg_ms": round(self.wait_time_total / self.requests * 1000, 2) if self.requests else 0.0,
+            "wait_time_max_ms": round(self.wait_time_max * 1000, 2),
+            "current_rps": round(self._bucket.rate, 2) if self._bucket is not None else None,
+        }
+
+class EndpointHealth:
+    """
+    Recent outcomes and per-operation latencies of one Content Safety endpoint.
+
+    Throttling, 5xx and connection errors count as errors. Once the error rate of
+    the last CONTENT_SAFETY_HEALTH_WINDOW calls reaches CONTENT_SAFETY_EJECT_ERROR_RATE
+    the endpoint is taken out of rotation for CONTENT_SAFETY_EJECT_SECONDS, then
+    comes back with a clean window.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self._outcomes = deque(maxlen=CONTENT_SAFETY_HEALTH_WINDOW)
+        self._latencies = {}  # operation -> recent successful call durations (seconds)
+        self.ejected_until = 0
+        self.ejections = 0
+
+    @property
+    def ejected(self):
+        return time.monotonic() < self.ejected_until
+
+    def record(self, operation, ok, latency):
+        self._outcomes.append(ok)
+        if ok:
+            self._latencies.setdefault(operation, deque(maxlen=LATENCY_SAMPLES)).append(latency)
+            return
+        errors = self._outcomes.count(False)
+        if (not self.ejected and len(self._outcomes) >= CONTENT_SAFETY_EJECT_MIN_REQUESTS
+                and errors / len(self._outcomes) >= CONTENT_SAFETY_EJECT_ERROR_RATE):
+            self.ejected_until = time.monotonic() + CONTENT_SAFETY_EJECT_SECONDS
+            self.ejections += 1
+            self._outcomes.clear()
+            logging.warning(f"[rate_limiter] endpoint {self.endpoint} ejected for {CONTENT_SAFETY_EJECT_SECONDS}s "
+                            f"after {errors} errors in its last calls")
+            record_endpoint_ejection(self.endpoint)
+
+    def latency_percentile(self, operation, percentile):
+        samples = self._latencies.get(operation)
+        if not samples or len(samples) < CONTENT_SAFETY_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def stats(self):
+        return {"ejected": self.ejected, "ejections": self.ejections,
+                "error_rate": round(self._outcomes.count(False) / len(self._outcomes), 2) if self._outcomes else 0.0}
+
+def _usable(task):
+    """A finished call whose result can be returned: no error and no retryable status."""
+    return (not task.cancelled() and task.exception() is None
+            and getattr(task.result(), "status_code", None) not in RETRY_STATUS_CODES)
+
+def _fails_over(task):
+    """
+    A finished call another endpoint may answer: a retryable status or an error
+    without one (connection refused, reset), but not the request deadline.
+    """
+    if task.cancelled():
+        return False
+    error = task.exception()
+    if error is None:
+        return getattr(task.result(), "status_code", None) in RETRY_STATUS_CODES
+    return not isinstance(error, DeadlineExceeded) and getattr(error, "status_code", None) in (None, *RETRY_STATUS_CODES)
+
+async def _discard(result):
+    close = getattr(result, "close", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception as e:
+            logging.warning(f"[rate_limiter] error closing discarded response: {e}")
+
+class RequestScheduler:
+    """
+    Shared gate in front of Content Safety calls.
+
+    Each call takes a slot on its (endpoint, operation) limiter, then one on its
+    endpoint limiter for the HTTP call itself. Throttled calls (429/503) feed back into both limiters; they and
+    other transient 5xx responses are retried with jittered exponential backoff,
+    honouring Retry-After.
+
+    With several endpoints, `dispatch` sends each call to the first healthy one and
+    fails over to the next, and hedges the latency-critical operations.
+    """
+
+    def __init__(self):
+        self._limiters = {}
+        self._health = {}  # endpoint -> EndpointHealth
+        self.retries = 0
+        self._hedges = {}  # operation -> {"hedged", "hedge_wins", "calls"}
+
+    def _limiter(self, key, concurrency, rps=0):
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = Limiter(key, concurrency, rps)
+            self._limiters[key] = limiter
+        return limiter
+
+    def limiters_for(self, endpoint, operation):
+        limits = CONTENT_SAFETY_OPERATION_LIMITS.get(operation, {})
+        endpoint_limiter = self._limiter(endpoint, CONTENT_SAFETY_ENDPOINT_CONCURRENCY)
+        operation_limiter = self._limiter(f"{endpoint}|{operation}",
+                                          limits.get("concurrency", CONTENT_SAFETY_OPERATION_CONCURRENCY),
+                                          limits.get("rps", CONTENT_SAFETY_OPERATION_RPS))
+        return endpoint_limiter, operation_limiter
+
+    async def run(self, endpoint, operation, attempt, sent=None):
+        """
+        Calls `attempt()` through the limiters. It may return an HTTP response or
+        raise an azure.core HttpResponseError; either one with a retryable status
+        is retried up to CONTENT_SAFETY_MAX_RETRIES times. No attempt or retry is
+        started that the request deadline would not leave time for. `sent`, an
+        asyncio.Event, is set once the first attempt has its limiter slots.
+        """
+        endpoint_limiter, operation_limiter = self.limiters_for(endpoint, operation)
+        health = self.health(endpoint)
+        for retry in range(CONTENT_SAFETY_MAX_RETRIES + 1):
+            ensure_time(operation)
+            last_attempt = retry == CONTENT_SAFETY_MAX_RETRIES
+            # The operation's own pacing comes first: a throttled operation then
+            # waits without holding one of the endpoint's slots
+            async with operation_limiter.slot(), endpoint_limiter.slot():
+                if sent is not None:
+                    sent.set()
+                start_time = time.monotonic()
+                try:
+                    result = await attempt()
+                except Exception as e:
+                    response = getattr(e, "response", None)
+                    status_code = getattr(e, "status_code", None)
+                    # Client errors (4xx) say nothing about the endpoint's health
+                    health.record(operation, status_code is not None and status_code not in RETRY_STATUS_CODES,
+                                  time.monotonic() - start_time)
+                    if last_attempt or status_code not in RETRY_STATUS_CODES:
+                        record_api_call(operation, status_code, retried=False)
+                        raise
+                    headers = getattr(response, "headers", None)
+                else:
+                    status_code = getattr(result, "status_code", None)
+                    health.record(operation, status_code not in RETRY_STATUS_CODES, time.monotonic() - start_time)
+                    if status_code not in RETRY_STATUS_CODES:
+                        record_api_call(operation, status_code, retried=False)
+                        operation_limiter.on_success()
+                        return result
+                    if last_attempt:
+                        record_api_call(operation, status_code, retried=False)
+                        return result
+                    headers = result.headers
+                    await result.close()
+            record_api_call(operation, status_code, retried=True)
+            retry_after = parse_retry_after(headers)
+            if status_code in THROTTLE_STATUS_CODES:
+                endpoint_limiter.on_throttled(retry_after)
+                operation_limiter.on_throttled(retry_after)
+            backoff = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** retry))
+            delay = retry_after + random.uniform(0, RETRY_BASE_DELAY_SECONDS) if retry_after else backoff
+            # Waiting out the backoff only to find the deadline passed would waste the remaining budget
+            ensure_time(operation, needed=delay)
+            self.retries += 1
+            logging.warning(f"[rate_limiter] {operation} returned {status_code}, retry {retry + 1}/{CONTENT_SAFETY_MAX_RETRIES} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    def health(self, endpoint):
+        health = self._health.get(endpoint)
+        if health is None:
+            health = self._health[endpoint] = EndpointHealth(endpoint)
+        return health
+
+    def healthy(self, endpoints):
+        """Endpoints in rotation, in their configured order; all of them if every one is ejected."""
+        return [endpoint for endpoint in endpoints if not self.health(endpoint).ejected] or list(endpoints)
+
+    def hedge_delay(self, endpoint, operation):
+        """Seconds to wait for `endpoint` before hedging: its latency percentile for the operation."""
+        latency = self.health(endpoint).latency_percentile(operation, CONTENT_SAFETY_HEDGE_PERCENTILE)
+        if latency is None:
+            return CONTENT_SAFETY_HEDGE_DEFAULT_DELAY_MS / 1000
+        return max(latency, CONTENT_SAFETY_HEDGE_MIN_DELAY_MS / 1000)
+
+    async def dispatch(self, endpoints, operation, attempt):
+        """
+        Calls `attempt(endpoint)` through `run` on the first healthy endpoint. A call
+        that still fails with a retryable error is tried once on the next healthy
+        endpoint. CONTENT_SAFETY_HEDGED_OPERATIONS are hedged instead: see `_hedged`.
+        """
+        candidates = self.healthy(endpoints)
+        if operation in CONTENT_SAFETY_HEDGED_OPERATIONS and len(candidates) > 1:
+            return await self._hedged(candidates[0], candidates[1], operation, attempt)
+        candidates = candidates[:2]
+        for index, endpoint in enumerate(candidates):
+            last = index == len(candidates) - 1
+            try:
+                result = await self.run(endpoint, operation, lambda endpoint=endpoint: attempt(endpoint))
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if last or getattr(e, "status_code", None) not in (None, *RETRY_STATUS_CODES):
+                    raise
+                logging.warning(f"[rate_limiter] {operation} failed on {endpoint}, failing over: {e}")
+                continue
+            if last or getattr(result, "status_code", None) not in RETRY_STATUS_CODES:
+                return result
+            logging.warning(f"[rate_limiter] {operation} returned {result.status_code} on {endpoint}, failing over")
+            await _discard(result)
+
+    async def _hedged(self, primary, secondary, operation, attempt):
+        """
+        Sends the call to `primary` and, if it has not answered within the hedge
+        delay, a duplicate to `secondary`; if it fails before then, the call goes
+        to `secondary` straight away. The delay runs from when the call is
+        sent, so time queued in the local limiters does not trigger a hedge. The
+        first usable answer is returned and the other call is cancelled (or its
+        response closed).
+        """
+        counters = self._hedges.setdefault(operation, {"calls": 0, "hedged": 0, "hedge_wins": 0})
+        counters["calls"] += 1
+        sent = asyncio.Event()
+        first = asyncio.ensure_future(self.run(primary, operation, lambda: attempt(primary), sent=sent))
+        tasks = [first]
+        winner = None
+        try:
+            waiting = asyncio.ensure_future(sent.wait())
+            try:
+                await asyncio.wait([first, waiting], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiting.cancel()
+            done = {first} if first.done() else set()
+            if not done:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(primary, operation))
+            if first in done:
+                if not _fails_over(first):
+                    winner = first
+                    return first.result()
+                # Failed before the hedge was due: fail over at once, as dispatch does
+                logging.warning(f"[rate_limiter] {operation} failed on {primary}, failing over to {secondary}")
+                winner = asyncio.ensure_future(self.run(secondary, operation, lambda: attempt(secondary)))
+                tasks.append(winner)
+                return await winner
+            counters["hedged"] += 1
+            tasks.append(asyncio.ensure_future(self.run(secondary, operation, lambda: attempt(secondary))))
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in tasks if task in done and _usable(task)), None)
+            if winner is None:
+                # Neither answered usably; report what the primary got
+                winner = first
+            won = winner is not first
+            counters["hedge_wins"] += 1 if won else 0
+            record_hedge(operation, won)
+            return winner.result()
+        finally:
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                if not task.cancelled() and task.exception() is None:
+                    await _discard(task.result())
+
+    def stats(self):
+        return {"retries": self.retries, "limiters": {key: limiter.stats() for key, limiter in self._limiters.items()},
+                "endpoints": {endpoint: health.stats() for endpoint, health in self._health.items()},
+                "hedging": {operation: dict(counters) for operation, counters in self._hedges.items()}}
+
+content_safety_scheduler = RequestScheduler()
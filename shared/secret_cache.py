@@ -0,0 +1,92 @@
+import os
+import time
+import asyncio
+import logging
+
+SECRET_CACHE_TTL_SECONDS = int(os.environ.get("SECRET_CACHE_TTL_SECONDS", "3600"))
+# Fraction of an entry's lifetime after which it is refreshed in the background
+CACHE_REFRESH_AHEAD_RATIO = float(os.environ.get("CACHE_REFRESH_AHEAD_RATIO", "0.8"))
+
+class RefreshingCache:
+    """
+    In-process cache for secrets and tokens.
+
+    Each entry expires at the time returned by its loader. Once an entry is past
+    CACHE_REFRESH_AHEAD_RATIO of its lifetime, callers still get the cached value
+    while a background task reloads it. Concurrent misses for the same key share a
+    single load, so a cold worker calls the backing service once per key.
+    """
+
+    def __init__(self, name, refresh_ahead_ratio=CACHE_REFRESH_AHEAD_RATIO):
+        self.name = name
+        self.refresh_ahead_ratio = refresh_ahead_ratio
+        self._entries = {}  # key -> (value, refresh_at, expires_at)
+        self._inflight = {}  # key -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    async def get(self, key, loader):
+        """
+        Returns the cached value for `key`, calling `loader()` on a miss.
+        `loader` is an async callable returning a (value, expires_on) tuple where
+        expires_on is a POSIX timestamp.
+        """
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None:
+            value, refresh_at, expires_at = entry
+            if now < expires_at:
+                self.hits += 1
+                if now >= refresh_at and key not in self._inflight:
+                    self.refreshes += 1
+                    self._start_load(key, loader, background=True)
+                return value
+        self.misses += 1
+        task = self._inflight.get(key) or self._start_load(key, loader)
+        return await asyncio.shield(task)
+
+    def _start_load(self, key, loader, background=False):
+        task = asyncio.ensure_future(self._load(key, loader, background))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None) if self._inflight.get(key) is task else None)
+        if background:
+            # Nobody may await a background refresh; mark its error as retrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _load(self, key, loader, background):
+        fetched_at = time.time()
+        try:
+            value, expires_on = await loader()
+        except Exception as e:
+            if background:
+                # Callers keep getting the current value until it actually expires.
+                # A caller that misses while this refresh is running awaits it, so
+                # the error is raised to it rather than returned as a None value.
+                logging.warning(f"[secret_cache] {self.name}: background refresh of '{key}' failed: {e}")
+            raise
+        lifetime = max(expires_on - fetched_at, 0)
+        self._entries[key] = (value, fetched_at + lifetime * self.refresh_ahead_ratio, expires_on)
+        return value
+
+    def invalidate(self, key=None):
+        """Drops one entry, or every entry when `key` is None."""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+        logging.info(f"[secret_cache] {self.name}: invalidated {key if key is not None else 'all entries'}")
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "refreshes": self.refreshes}
+
+secret_cache = RefreshingCache("secrets")
+token_cache = RefreshingCache("tokens")
+
+def invalidate_secret(secret_name=None):
+    """Hook for key rotation: forces the next read of the secret to go to Key Vault."""
+    secret_cache.invalidate(secret_name)
+
+def invalidate_tokens(scope=None):
+    token_cache.invalidate(scope)
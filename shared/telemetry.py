@@ -0,0 +1,244 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TELEMETRY_ENABLED = os.environ.get("TELEMETRY_ENABLED", "true").lower() == "true"
+# Adds the `timings` block to every response, not only when the request asks for it
+RESPONSE_TIMINGS = os.environ.get("RESPONSE_TIMINGS", "false").lower() == "true"
+APPLICATIONINSIGHTS_CONNECTION_STRING = os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING")
+INSTRUMENTATION_NAME = "securityhub"
+
+try:
+    from opentelemetry import trace, metrics
+    from opentelemetry.trace import Status, StatusCode
+except ImportError:
+    trace = metrics = None
+
+class RequestTimings:
+    """What one request spent, returned as the response's `timings` block."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.checks = {}
+        self.setup = {}
+        self.sources = None
+
+    def check(self, name):
+        return self.checks.setdefault(name, {"ms": None, "status": None, "chunks": 0, "payload_chars": 0,
+                                             "cache_hits": 0, "api_calls": 0, "retries": 0, "hedges": 0})
+
+    def as_dict(self):
+        timings = {"total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+                   "checks": self.checks,
+                   "setup_ms": {component: round(ms, 2) for component, ms in self.setup.items()}}
+        if self.sources is not None:
+            timings["sources"] = self.sources
+        return timings
+
+_request_timings = ContextVar("request_timings", default=None)
+# Name of the top-level check the current task is running for; chunk tasks inherit it
+_current_check = ContextVar("current_check", default=None)
+
+class _Instruments:
+    def __init__(self):
+        self.tracer = trace.get_tracer(INSTRUMENTATION_NAME)
+        meter = metrics.get_meter(INSTRUMENTATION_NAME)
+        self.check_duration = meter.create_histogram("securityhub.check.duration", unit="ms",
+                                                     description="Duration of a top-level security check")
+        self.check_chunks = meter.create_histogram("securityhub.check.chunks",
+                                                   description="Chunk calls made by a security check")
+        self.chunk_duration = meter.create_histogram("securityhub.chunk.duration", unit="ms",
+                                                     description="Duration of a single remote chunk call")
+        self.chunk_payload = meter.create_histogram("securityhub.chunk.payload_size", unit="chars",
+                                                    description="Characters sent in a single chunk call")
+        self.api_calls = meter.create_counter("securityhub.api.calls", description="HTTP calls to Content Safety")
+        self.api_retries = meter.create_counter("securityhub.api.retries", description="Content Safety calls that were retried")
+        self.setup_duration = meter.create_histogram("securityhub.setup.duration", unit="ms",
+                                                     description="Time spent creating credentials, clients and reading secrets")
+        self.hedges = meter.create_counter("securityhub.hedge.requests", description="Content Safety calls hedged to a second endpoint")
+        self.hedge_wins = meter.create_counter("securityhub.hedge.wins", description="Hedged calls answered first by the second endpoint")
+        self.endpoint_ejections = meter.create_counter("securityhub.endpoint.ejections",
+                                                       description="Content Safety endpoints taken out of rotation for their error rate")
+        self.sources_removed = meter.create_histogram("securityhub.sources.bytes_removed", unit="By",
+                                                      description="Source bytes removed as duplicates before the checks ran")
+
+_instruments = None
+# Result of configure_exporter, once it has run
+_exporter_configured = None
+
+def _get_instruments():
+    global _instruments
+    if _instruments is None and TELEMETRY_ENABLED and trace is not None:
+        _instruments = _Instruments()
+    return _instruments
+
+def configure_exporter():
+    """
+    Sends spans and metrics to the Application Insights resource the host logs to
+    (APPLICATIONINSIGHTS_CONNECTION_STRING), when azure-monitor-opentelemetry is
+    installed. Logs keep going through the Functions host.
+
+    Runs once, from the warm-up hook or else the first request, never at import:
+    the exporter package alone takes about as long to import as the whole app.
+    """
+    global _exporter_configured
+    if _exporter_configured is None:
+        _exporter_configured = _configure_exporter()
+    return _exporter_configured
+
+def _configure_exporter():
+    if not TELEMETRY_ENABLED or not APPLICATIONINSIGHTS_CONNECTION_STRING:
+        return False
+    try:
+        from azure.monitor.opentelemetry import configure_azure_monitor
+    except ImportError:
+        logging.info("[telemetry] azure-monitor-opentelemetry is not installed, spans and metrics are not exported")
+        return False
+    configure_azure_monitor(connection_string=APPLICATIONINSIGHTS_CONNECTION_STRING, disable_logging=True)
+    logging.info("[telemetry] exporting spans and metrics to Application Insights")
+    return True
+
+@contextmanager
+def request_scope():
+    """Collects the timings of the checks run inside the block."""
+    configure_exporter()
+    timings = RequestTimings()
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+def timings_requested(flag):
+    return RESPONSE_TIMINGS or flag is True or str(flag).lower() == "true"
+
+def _check_timings():
+    timings = _request_timings.get()
+    check = _current_check.get()
+    if timings is None or check is None:
+        return None
+    return timings.check(check)
+
+@contextmanager
+def _span(name, attributes):
+    instruments = _get_instruments()
+    if instruments is None:
+        yield None
+        return
+    with instruments.tracer.start_as_current_span(name, attributes=attributes) as span:
+        yield span
+
+async def traced_check(check_name, check):
+    """Awaits a top-level check inside its span and records its duration and chunk count."""
+    token = _current_check.set(check_name)
+    timings = _request_timings.get()
+    check_timings = timings.check(check_name) if timings is not None else None
+    start_time = time.perf_counter()
+    status = "Passed"
+    try:
+        with _span("securityhub.check", {"securityhub.check": check_name}) as span:
+            try:
+                result = await check
+            except BaseException as e:
+                # CheckSkipped carries its own status
+                status = "Cancelled" if isinstance(e, asyncio.CancelledError) else getattr(e, "status", "Error")
+                if span is not None:
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
+                raise
+            if result[0]:
+                status = "Failed"
+            return result
+    finally:
+        _current_check.reset(token)
+        elapsed = (time.perf_counter() - start_time) * 1000
+        instruments = _get_instruments()
+        chunks = check_timings["chunks"] if check_timings is not None else None
+        if instruments is not None:
+            attributes = {"securityhub.check": check_name, "securityhub.status": status}
+            instruments.check_duration.record(elapsed, attributes)
+            if chunks is not None:
+                instruments.check_chunks.record(chunks, attributes)
+        if check_timings is not None:
+            check_timings["ms"] = round(elapsed, 2)
+            check_timings["status"] = status
+
+async def traced_chunk(operation, payload_chars, call):
+    """Awaits one remote chunk call of the current check inside its span."""
+    check_timings = _check_timings()
+    if check_timings is not None:
+        check_timings["chunks"] += 1
+        check_timings["payload_chars"] += payload_chars
+    attributes = {"securityhub.check": _current_check.get() or operation, "securityhub.operation": operation,
+                  "securityhub.payload_chars": payload_chars}
+    start_time = time.perf_counter()
+    try:
+        with _span("securityhub.chunk", attributes):
+            return await call
+    finally:
+        instruments = _get_instruments()
+        if instruments is not None:
+            metric_attributes = {"securityhub.operation": operation, "securityhub.cache_hit": False}
+            instruments.chunk_duration.record((time.perf_counter() - start_time) * 1000, metric_attributes)
+            instruments.chunk_payload.record(payload_chars, metric_attributes)
+
+def record_chunk_hit(operation, payload_chars):
+    """Counts a chunk answered from the verdict cache; no span, nothing was called."""
+    check_timings = _check_timings()
+    if check_timings is not None:
+        check_timings["chunks"] += 1
+        check_timings["payload_chars"] += payload_chars
+        check_timings["cache_hits"] += 1
+    instruments = _get_instruments()
+    if instruments is not None:
+        instruments.chunk_payload.record(payload_chars, {"securityhub.operation": operation, "securityhub.cache_hit": True})
+
+def record_api_call(operation, status_code, retried):
+    """Counts one HTTP attempt against Content Safety; `retried` when it will be retried."""
+    check_timings = _check_timings()
+    if check_timings is not None:
+        check_timings["api_calls"] += 1
+        check_timings["retries"] += 1 if retried else 0
+    instruments = _get_instruments()
+    if instruments is not None:
+        attributes = {"securityhub.operation": operation, "http.status_code": status_code or 0}
+        instruments.api_calls.add(1, attributes)
+        if retried:
+            instruments.api_retries.add(1, attributes)
+
+def record_setup(component, seconds):
+    """Records time spent on a credential, client or secret."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.setup[component] = timings.setup.get(component, 0) + seconds * 1000
+    instruments = _get_instruments()
+    if instruments is not None:
+        instruments.setup_duration.record(seconds * 1000, {"securityhub.component": component})
+
+def record_sources(stats):
+    """Records what source de-duplication removed for the current request."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.sources = stats
+    instruments = _get_instruments()
+    if instruments is not None:
+        instruments.sources_removed.record(stats["bytes_removed"])
+
+def record_hedge(operation, won):
+    """Counts a hedged call; `won` when the hedge answered before the original call."""
+    check_timings = _check_timings()
+    if check_timings is not None:
+        check_timings["hedges"] += 1
+    instruments = _get_instruments()
+    if instruments is not None:
+        attributes = {"securityhub.operation": operation}
+        instruments.hedges.add(1, attributes)
+        if won:
+            instruments.hedge_wins.add(1, attributes)
+
+def record_endpoint_ejection(endpoint):
+    instruments = _get_instruments()
+    if instruments is not None:
+        instruments.endpoint_ejections.add(1, {"securityhub.endpoint": endpoint})
@@ -0,0 +1,47 @@
+"""
+In-process stand-ins for the Content Safety client, shared by the tests.
+
+FakeContentSafetyClient answers `send_request` with a handler's (status, body)
+and records every request, so tests can count calls and inspect payloads.
+"""
+import json
+import asyncio
+from azure.core.exceptions import HttpResponseError
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.reason = "Fake"
+        self.headers = headers or {}
+        self.body = body if body is not None else {}
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HttpResponseError(message=f"Operation returned {self.status_code}", response=self)
+
+    def json(self):
+        return self.body
+
+    async def close(self):
+        self.closed = True
+
+class FakeContentSafetyClient:
+    """`handler(operation, payload)` returns (status, body); `delay` seconds are awaited first."""
+
+    def __init__(self, handler, delay=0):
+        self.handler = handler
+        self.delay = delay
+        self.requests = []  # (operation, payload)
+
+    async def send_request(self, request):
+        operation = request.url.split("?")[0].lstrip("/")
+        payload = json.loads(request.content)
+        self.requests.append((operation, payload))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        status, body = self.handler(operation, payload)
+        return FakeResponse(status, body)
+
+    def calls(self, operation):
+        return [payload for called, payload in self.requests if called == operation]
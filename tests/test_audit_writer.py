@@ -0,0 +1,120 @@
+"""
+Buffered audit writer: records that cannot be written are spilled and replayed,
+rejected ones are dead-lettered, and nothing queued is lost on SIGTERM.
+"""
+import json
+import signal
+import asyncio
+import pytest
+
+pytest.importorskip("azure.functions")
+
+from auditing import writer
+from auditing.writer import AuditWriter
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Operation returned {status_code}")
+        self.status_code = status_code
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """Cosmos stand-in: conversation id -> interactions written; `failures` are raised first, in order."""
+    store = {"written": {}, "failures": []}
+
+    async def write_interactions(db, conversation_id, interactions):
+        if store["failures"]:
+            raise store["failures"].pop(0)
+        store["written"].setdefault(conversation_id, []).extend(interactions)
+
+    async def get_db(self):
+        return None
+
+    monkeypatch.setattr(writer.audit, "write_interactions", write_interactions)
+    monkeypatch.setattr(AuditWriter, "_get_db", get_db)
+    monkeypatch.setattr(writer, "AUDIT_SPILL_FILE", str(tmp_path / "spill.ndjson"))
+    monkeypatch.setattr(writer, "AUDIT_DEAD_LETTER_FILE", str(tmp_path / "deadletter.ndjson"))
+    monkeypatch.setattr(writer, "AUDIT_FLUSH_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(writer, "AUDIT_WRITE_RETRIES", 1)
+    return store
+
+def submit(audit_writer, conversation_id, question):
+    return audit_writer.submit(conversation_id, question, "answer", "sources", {"results": {}})
+
+def questions(store, conversation_id):
+    return [interaction["question"] for interaction in store["written"].get(conversation_id, [])]
+
+def files(tmp_path):
+    return sorted(path.name for path in tmp_path.iterdir())
+
+def test_failed_write_is_spilled_then_replayed(store, tmp_path):
+    store["failures"] = [StatusError(503)]
+    async def main():
+        first = AuditWriter()
+        submit(first, "conversation-1", "q1")
+        await first.close()
+        assert first.stats()["spilled"] == 1
+        assert questions(store, "conversation-1") == []
+        # The next worker replays what the first one spilled
+        second = AuditWriter()
+        submit(second, "conversation-1", "q2")
+        await second.close()
+    asyncio.run(main())
+    assert sorted(questions(store, "conversation-1")) == ["q1", "q2"]
+    assert files(tmp_path) == []
+
+def test_rejected_write_is_dead_lettered_not_spilled(store, tmp_path):
+    store["failures"] = [StatusError(400)]
+    async def main():
+        audit_writer = AuditWriter()
+        submit(audit_writer, "conversation-1", "q1")
+        await audit_writer.close()
+        return audit_writer.stats()
+    stats = asyncio.run(main())
+    assert stats["dead_lettered"] == 1 and stats["spilled"] == 0
+    [dead_letter] = files(tmp_path)
+    with open(tmp_path / dead_letter, encoding="utf-8") as f:
+        [record] = [json.loads(line) for line in f]
+    assert record["conversation_id"] == "conversation-1"
+    assert "400" in record["error"]
+
+def test_invalid_conversation_id_is_rejected_at_submit(store):
+    async def main():
+        with pytest.raises(ValueError):
+            submit(AuditWriter(), "a/b", "q1")
+    asyncio.run(main())
+
+def test_replay_file_of_a_dead_process_is_taken_over(store, tmp_path):
+    record = {"conversation_id": "conversation-1", "interaction": {"question": "orphaned"}}
+    # Claimed by a process of this host that no longer exists, and never re-queued
+    orphan = tmp_path / f"spill.ndjson.{writer.socket.gethostname()}-999999999.0.replay"
+    orphan.write_text(json.dumps(record) + "\n", encoding="utf-8")
+    async def main():
+        audit_writer = AuditWriter()
+        submit(audit_writer, "conversation-2", "q")
+        await audit_writer.close()
+    asyncio.run(main())
+    assert questions(store, "conversation-1") == ["orphaned"]
+    assert files(tmp_path) == []
+
+def test_sigterm_flushes_the_queue_then_passes_the_signal_on(store, monkeypatch):
+    delivered = []
+    real_signal = signal.signal
+    def set_handler(signum, handler):
+        if signum != signal.SIGTERM:
+            return real_signal(signum, handler)
+        delivered.append(("handler", handler))
+    monkeypatch.setattr(writer.signal, "signal", set_handler)
+    monkeypatch.setattr(writer.os, "kill", lambda pid, signum: delivered.append(("kill", signum)))
+    monkeypatch.setattr(writer, "_install_sigterm_handler", lambda loop: None)
+    audit_writer = AuditWriter()
+    monkeypatch.setattr(writer, "audit_writer", audit_writer)
+    async def main():
+        loop = asyncio.get_running_loop()
+        monkeypatch.setattr(loop, "remove_signal_handler", lambda signum: True)
+        submit(audit_writer, "conversation-1", "q1")
+        submit(audit_writer, "conversation-1", "q2")
+        await writer._drain_on_sigterm(loop, signal.SIG_DFL)
+    asyncio.run(main())
+    assert questions(store, "conversation-1") == ["q1", "q2"]
+    assert delivered == [("handler", signal.SIG_DFL), ("kill", signal.SIGTERM)]
@@ -0,0 +1,85 @@
+"""
+Property tests for shared.chunking against the divide_string loop it replaced.
+
+Inputs are generated from fixed seeds, so a failure always reproduces; the
+failing (text, min_chars, max_chars) is part of the assertion message.
+"""
+import random
+import pytest
+from shared.chunking import chunk_spans, materialize
+
+WHITESPACE = (' ', '\n', '\t')
+# Alphabets that exercise long words, mixed whitespace and sentence/paragraph breaks
+ALPHABETS = ["ab ", "abcdefg \n\t", "a" * 20 + " ", "xy.\n ", "a", " ", "Hi. There!\n\n"]
+SEEDS = range(5)
+CASES_PER_SEED = 2000
+
+def reference_divide_string(s, min_chars=0, max_chars=1000):
+    """divide_string as it was before the single-pass chunker (shared/util.py at the baseline)."""
+    result = []
+    current_pos = 0
+    while current_pos < len(s):
+        end_pos = min(len(s), current_pos + max_chars)
+        if end_pos < len(s) and s[end_pos] not in WHITESPACE:
+            while end_pos > current_pos and s[end_pos - 1] not in WHITESPACE:
+                end_pos -= 1
+        if end_pos == current_pos:
+            end_pos = min(len(s), current_pos + max_chars)
+        result.append(s[current_pos:end_pos])
+        current_pos = end_pos
+    if len(result) > 1 and len(result[-1]) < min_chars:
+        combined = result[-2] + result[-1]
+        result.pop()
+        result[-1] = combined
+        half = len(combined) // 2
+        split_point = half
+        while split_point < len(combined) and combined[split_point] not in WHITESPACE:
+            split_point += 1
+        if split_point == len(combined):
+            split_point = half
+            while split_point > 0 and combined[split_point] not in WHITESPACE:
+                split_point -= 1
+        if split_point in [0, len(combined)]:
+            split_point = half
+        result[-1] = combined[:split_point]
+        result.append(combined[split_point:])
+    return result
+
+def generated_cases(seed):
+    rng = random.Random(seed)
+    for _ in range(CASES_PER_SEED):
+        alphabet = rng.choice(ALPHABETS)
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 300)))
+        max_chars = rng.randint(1, 60)
+        yield text, rng.randint(0, max_chars), max_chars
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_matches_reference_within_the_limit(seed):
+    for text, min_chars, max_chars in generated_cases(seed):
+        case = (text, min_chars, max_chars)
+        chunks = materialize(text, chunk_spans(text, min_chars, max_chars))
+        assert "".join(chunks) == text, case
+        assert all(len(chunk) <= max_chars for chunk in chunks), case
+        expected = reference_divide_string(text, min_chars, max_chars)
+        # The only intended difference: see test_never_exceeds_max_chars_where_reference_did
+        if any(len(chunk) > max_chars for chunk in expected):
+            continue
+        assert chunks == expected, case
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("boundary", ["sentence", "paragraph"])
+def test_boundaries_keep_text_and_limit(seed, boundary):
+    for text, min_chars, max_chars in generated_cases(seed):
+        case = (text, min_chars, max_chars, boundary)
+        chunks = materialize(text, chunk_spans(text, min_chars, max_chars, boundary))
+        assert "".join(chunks) == text, case
+        assert all(0 < len(chunk) <= max_chars for chunk in chunks), case
+
+def test_never_exceeds_max_chars_where_reference_did():
+    # Documented divergence: when the last chunk is shorter than min_chars, the old
+    # loop re-split the last two chunks at the first whitespace past the middle,
+    # which could leave a piece over max_chars (and over the API limit). The
+    # single-pass chunker splits at the middle instead.
+    text, min_chars, max_chars = "baaa ", 3, 3
+    assert reference_divide_string(text, min_chars, max_chars) == ["baaa", " "]
+    assert materialize(text, chunk_spans(text, min_chars, max_chars)) == ["ba", "aa "]
@@ -0,0 +1,93 @@
+"""
+Content Safety clients: a 401 rebuilds the endpoint's client, and in AAD mode
+the rebuilt one gets a credential whose token cache did not hold the rejected token.
+"""
+import asyncio
+import pytest
+
+pytest.importorskip("azure.ai.contentsafety")
+
+from azure.core.rest import HttpRequest
+from fakes import FakeResponse
+from shared import clients
+from shared.clients import ContentSafetyClientManager
+
+class FakeToken:
+    def __init__(self, token):
+        self.token = token
+        self.expires_on = 2 ** 40
+
+class FakeCredential:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    async def get_token(self, *scopes, **kwargs):
+        return FakeToken(self.name)
+
+    async def close(self):
+        self.closed = True
+
+@pytest.fixture
+def credentials(monkeypatch):
+    """The shared credential's tokens are rejected; those of any new one are accepted."""
+    shared = FakeCredential("shared")
+    created = []
+
+    def new_azure_credential():
+        created.append(FakeCredential(f"new-{len(created)}"))
+        return created[-1]
+
+    class FakeClient:
+        def __init__(self, endpoint, credential, **kwargs):
+            self.credential = credential
+
+        async def __aenter__(self):
+            return self
+
+        async def send_request(self, request, **kwargs):
+            return FakeResponse(401 if self.credential is shared else 200)
+
+        async def close(self):
+            pass
+
+    monkeypatch.setattr(clients, "APIM_ENABLED", False)
+    monkeypatch.setattr(clients, "CONTENT_SAFETY_ENDPOINTS", ["https://a.cognitiveservices.azure.com"])
+    monkeypatch.setattr(clients, "ContentSafetyClient", FakeClient)
+    monkeypatch.setattr(clients, "get_azure_credential", lambda: shared)
+    monkeypatch.setattr(clients, "new_azure_credential", new_azure_credential)
+    return shared, created
+
+def request():
+    return HttpRequest("POST", "/text:shieldPrompt?api-version=2024-09-01", json={"documents": []})
+
+def test_auth_failure_rebuilds_with_a_new_credential(credentials):
+    shared, created = credentials
+    manager = ContentSafetyClientManager()
+    async def main():
+        response = await manager.send_request(request())
+        assert response.status_code == 200
+        # Later calls keep the new credential rather than going back to the shared one
+        response = await manager.send_request(request())
+        assert response.status_code == 200
+        client = await manager.get_client()
+        await manager.invalidate()
+        return client
+    client = asyncio.run(main())
+    assert [credential.name for credential in created] == ["new-0"]
+    assert client.credential is created[0]
+    # The manager closes the credential it created, never the shared one
+    assert created[0].closed and not shared.closed
+
+def test_replaced_credential_is_closed_once_unused(credentials):
+    _, created = credentials
+    manager = ContentSafetyClientManager()
+    async def main():
+        await manager.send_request(request())
+        first = await manager.get_client()
+        await manager.invalidate(first, renew_credential=True)
+        await manager.get_client()
+        assert created[0].closed and not created[1].closed
+        await manager.invalidate()
+    asyncio.run(main())
+    assert all(credential.closed for credential in created)
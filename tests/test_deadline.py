@@ -0,0 +1,74 @@
+"""
+Request deadlines: checks that cannot finish in time are cancelled, or never
+started, and reported as TimedOut; a flagged chunk still settles its check.
+"""
+import time
+import asyncio
+import pytest
+from shared import deadline
+from shared.deadline import deadline_scope, parse_deadline_ms, degraded_verdict, DeadlineExceeded, TIMED_OUT
+from safety_checks.runner import run_checks, run_chunk_checks
+
+async def verdict(result, delay=0):
+    await asyncio.sleep(delay)
+    return result, "details"
+
+def run_with_deadline(deadline_ms, checks, check_names):
+    async def main():
+        with deadline_scope(deadline_ms):
+            return await run_checks(checks, check_names, fail_fast=False)
+    return asyncio.run(main())
+
+def test_check_past_the_deadline_times_out():
+    start = time.monotonic()
+    check_results, details = run_with_deadline(300, [verdict(False), verdict(False, 5)], ["Prompt Shield", "Fairness"])
+    assert check_results == {"Prompt Shield": "Passed", "Fairness": TIMED_OUT}
+    assert "deadline" in details["Fairness"]
+    assert time.monotonic() - start < 1
+
+def test_check_is_not_started_without_enough_time(monkeypatch):
+    monkeypatch.setattr(deadline, "DEADLINE_MIN_CALL_MS", 1000)
+    check = verdict(False)
+    check_results, details = run_with_deadline(300, [check], ["Fairness"])
+    assert check_results == {"Fairness": TIMED_OUT}
+    assert "was not started" in details["Fairness"]
+    assert check.cr_frame is None  # closed, never awaited
+
+def test_flagged_chunk_settles_the_check_despite_missing_chunks():
+    results = [(True, "flagged"), DeadlineExceeded("chunk 2 was not started")]
+    async def chunks():
+        return await run_chunk_checks([asyncio.sleep(0, result) for result in results])
+    assert asyncio.run(chunks()) == [(True, "flagged")]
+
+def test_missing_chunks_time_the_check_out():
+    results = [(False, "clean"), DeadlineExceeded("chunk 2 was not started")]
+    async def chunks():
+        return await run_chunk_checks([asyncio.sleep(0, result) for result in results])
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(chunks())
+
+def test_inner_deadline_never_extends_the_outer_one():
+    async def main():
+        with deadline_scope(200):
+            outer = deadline.remaining()
+            with deadline_scope(10_000):
+                return outer, deadline.remaining()
+    outer, inner = asyncio.run(main())
+    assert inner <= outer
+
+@pytest.mark.parametrize("body,headers,expected", [
+    ({"deadline_ms": 250}, None, 250),
+    ({}, {deadline.REQUEST_DEADLINE_HEADER: "400"}, 400),
+    ({}, {}, None),
+])
+def test_deadline_is_read_from_body_then_header(body, headers, expected):
+    assert parse_deadline_ms(headers, body, default=0) == expected
+
+@pytest.mark.parametrize("value", ["soon", 0, -5])
+def test_invalid_deadline_is_rejected(value):
+    with pytest.raises(ValueError):
+        parse_deadline_ms(None, {"deadline_ms": value})
+
+@pytest.mark.parametrize("mode,expected", [("fail", "Failed"), ("pass", "Passed"), ("report", None)])
+def test_degraded_verdict(mode, expected):
+    assert degraded_verdict({"Prompt Shield": "Passed", "Fairness": TIMED_OUT}, mode) == expected
@@ -0,0 +1,86 @@
+"""
+Several Content Safety endpoints: a call failing with a 5xx or a connection
+error goes to the next endpoint, a client error does not, and latency-critical
+operations are hedged.
+"""
+import asyncio
+import pytest
+
+pytest.importorskip("azure.core")
+
+from fakes import FakeResponse
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from shared import rate_limiter
+from shared.rate_limiter import RequestScheduler
+
+ENDPOINTS = ["https://a.cognitiveservices.azure.com", "https://b.cognitiveservices.azure.com"]
+PRIMARY, SECONDARY = ENDPOINTS
+OPERATION = "text:analyze"
+HEDGED = "text:shieldPrompt"
+
+@pytest.fixture(autouse=True)
+def no_retries(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_MAX_RETRIES", 0)
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_HEDGED_OPERATIONS", [HEDGED])
+
+def endpoints_answering(outcomes, delays=None):
+    """attempt(endpoint) raises outcomes[endpoint] if it is an exception, else returns a FakeResponse with that status."""
+    calls = []
+    async def attempt(endpoint):
+        calls.append(endpoint)
+        await asyncio.sleep((delays or {}).get(endpoint, 0))
+        if isinstance(outcomes[endpoint], Exception):
+            raise outcomes[endpoint]
+        return FakeResponse(outcomes[endpoint])
+    return attempt, calls
+
+def http_error(status):
+    return HttpResponseError(message=f"Operation returned {status}", response=FakeResponse(status))
+
+@pytest.mark.parametrize("failure", [503, http_error(500), ServiceRequestError("connection refused")],
+                         ids=["503 response", "500 error", "connection error"])
+def test_server_failure_fails_over(failure):
+    attempt, calls = endpoints_answering({PRIMARY: failure, SECONDARY: 200})
+    response = asyncio.run(RequestScheduler().dispatch(ENDPOINTS, OPERATION, attempt))
+    assert response.status_code == 200
+    assert calls == ENDPOINTS
+
+def test_client_error_does_not_fail_over():
+    attempt, calls = endpoints_answering({PRIMARY: http_error(400), SECONDARY: 200})
+    with pytest.raises(HttpResponseError):
+        asyncio.run(RequestScheduler().dispatch(ENDPOINTS, OPERATION, attempt))
+    assert calls == [PRIMARY]
+
+def test_client_error_response_is_returned_as_is():
+    attempt, calls = endpoints_answering({PRIMARY: 400, SECONDARY: 200})
+    response = asyncio.run(RequestScheduler().dispatch(ENDPOINTS, OPERATION, attempt))
+    assert response.status_code == 400
+    assert calls == [PRIMARY]
+
+def test_unhealthy_endpoint_is_ejected(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_EJECT_MIN_REQUESTS", 4)
+    scheduler = RequestScheduler()
+    attempt, calls = endpoints_answering({PRIMARY: 503, SECONDARY: 200})
+    async def main():
+        for _ in range(6):
+            await scheduler.dispatch(ENDPOINTS, OPERATION, attempt)
+    asyncio.run(main())
+    # Four failures eject the primary; the later calls go straight to the secondary
+    assert calls.count(PRIMARY) == 4
+    assert scheduler.stats()["endpoints"][PRIMARY]["ejected"]
+
+def test_slow_primary_is_hedged(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_HEDGE_DEFAULT_DELAY_MS", 20)
+    scheduler = RequestScheduler()
+    attempt, calls = endpoints_answering({PRIMARY: 200, SECONDARY: 200}, delays={PRIMARY: 1})
+    response = asyncio.run(scheduler.dispatch(ENDPOINTS, HEDGED, attempt))
+    assert response.status_code == 200
+    assert calls == ENDPOINTS
+    assert scheduler.stats()["hedging"][HEDGED] == {"calls": 1, "hedged": 1, "hedge_wins": 1}
+
+def test_hedged_call_fails_over_without_waiting_for_the_hedge(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_HEDGE_DEFAULT_DELAY_MS", 10_000)
+    attempt, calls = endpoints_answering({PRIMARY: 503, SECONDARY: 200})
+    response = asyncio.run(asyncio.wait_for(RequestScheduler().dispatch(ENDPOINTS, HEDGED, attempt), timeout=1))
+    assert response.status_code == 200
+    assert calls == ENDPOINTS
@@ -0,0 +1,91 @@
+"""
+Fairness retries: every attempt goes through the AOAI balancer, a 429/5xx moves
+the call to the next resource at once, and no retry outlives the deadline.
+"""
+import time
+import asyncio
+import pytest
+
+pytest.importorskip("semantic_kernel")
+
+from safety_checks import check_execution
+from shared.balancer import ResourceBalancer
+
+MODEL = "gpt-4o"
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Operation returned {status_code}")
+        self.status_code = status_code
+
+@pytest.fixture
+def balancer(monkeypatch):
+    balancer = ResourceBalancer("round_robin")
+    # Resource list already synced, so no Cosmos call is made
+    balancer._resources[MODEL] = ["a", "b"]
+    balancer._synced_at[MODEL] = time.time()
+    balancer._cursor[MODEL] = 0
+
+    async def get_aoai_config(model):
+        resource = await balancer.next_resource(model, ["a", "b"])
+        return {"resource": resource, "endpoint": f"https://{resource}.openai.azure.com"}
+
+    async def get_kernel(chatgpt_config):
+        return chatgpt_config["resource"]
+
+    monkeypatch.setattr(check_execution, "aoai_balancer", balancer)
+    monkeypatch.setattr(check_execution, "AZURE_OPENAI_CHATGPT_MODEL", MODEL)
+    monkeypatch.setattr(check_execution, "get_aoai_config", get_aoai_config)
+    monkeypatch.setattr(check_execution, "resource_available", balancer.available)
+    monkeypatch.setattr(check_execution.plugin_registry, "get_kernel", get_kernel)
+    monkeypatch.setattr(check_execution.plugin_registry, "get_plugin", lambda key: {"Fairness": None})
+    monkeypatch.setattr(check_execution.plugin_registry, "get_version", lambda key: None)
+    return balancer
+
+def answering(monkeypatch, outcomes):
+    """Makes the fairness call on resource r raise outcomes[r] if it is an exception, else return it."""
+    calls = []
+    async def fairness(kernel, rai_plugin, arguments, prompt_version=None):
+        calls.append(kernel)
+        if isinstance(outcomes[kernel], Exception):
+            raise outcomes[kernel]
+        return outcomes[kernel]
+    monkeypatch.setattr(check_execution, "fairness", fairness)
+    return calls
+
+def test_throttled_resource_is_skipped_without_waiting(monkeypatch, balancer):
+    calls = answering(monkeypatch, {"a": StatusError(429), "b": (False, "fair")})
+    start = time.monotonic()
+    result = asyncio.run(check_execution._fairness("answer", time.monotonic() + 30))
+    assert result == (False, "fair")
+    assert calls == ["a", "b"]
+    assert time.monotonic() - start < 0.5
+    stats = balancer.stats()
+    assert stats["a"]["cooling_down"] and stats["a"]["failures"] == 1
+    assert not stats["b"]["cooling_down"]
+
+def test_client_error_is_not_retried(monkeypatch, balancer):
+    calls = answering(monkeypatch, {"a": StatusError(400), "b": (False, "fair")})
+    with pytest.raises(StatusError):
+        asyncio.run(check_execution._fairness("answer", time.monotonic() + 30))
+    assert calls == ["a"]
+
+def test_no_backoff_past_the_fairness_deadline(monkeypatch, balancer):
+    monkeypatch.setattr(check_execution, "FAIRNESS_RETRY_BASE_DELAY_SECONDS", 5)
+    calls = answering(monkeypatch, {"a": StatusError(503), "b": StatusError(503)})
+    start = time.monotonic()
+    with pytest.raises(StatusError):
+        asyncio.run(check_execution._fairness("answer", time.monotonic() + 0.2))
+    # Both resources cooling down: the backoff would outlive the deadline, so it is not taken
+    assert calls[:2] == ["a", "b"]
+    assert time.monotonic() - start < 0.5
+
+def test_cancelled_call_is_recorded():
+    balancer = ResourceBalancer("least_outstanding")
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(balancer.observe("a", asyncio.sleep(1)), timeout=0.05)
+    asyncio.run(main())
+    stats = balancer.stats()["a"]
+    assert stats["outstanding"] == 0
+    assert stats["latency_s"] >= 0.05
@@ -0,0 +1,65 @@
+"""
+Groundedness planner: one call per answer chunk and source pack instead of the
+sources × question × answer product, run in waves that stop once an answer
+chunk is found ungrounded.
+"""
+import asyncio
+import pytest
+
+pytest.importorskip("azure.ai.contentsafety")
+
+from fakes import FakeContentSafetyClient
+from safety_checks import safety_checks
+from safety_checks.planning import plan_groundedness, pack_chunks
+from safety_checks.verdict_cache import verdict_cache
+
+UNGROUNDED = "The policy also covers flood damage."
+
+@pytest.fixture(autouse=True)
+def empty_verdict_cache():
+    verdict_cache.clear()
+
+def words(prefix, count):
+    return " ".join(f"{prefix}{index}" for index in range(count))
+
+def grounding():
+    def handler(operation, payload):
+        return 200, {"ungroundedDetected": UNGROUNDED in payload["text"]}
+    return handler
+
+def check(question, answer, sources, client):
+    return asyncio.run(safety_checks.groundedness_check_wrapper(question, answer, sources, client=client))
+
+def test_pack_chunks_respects_size_and_count():
+    assert pack_chunks(["aaa", "bb", "cccc", "d"], max_total_chars=5) == [[0, 1], [2, 3]]
+    assert pack_chunks(["a"] * 5, max_total_chars=100, max_items=2) == [[0, 1], [2, 3], [4]]
+    # A chunk longer than the limit still gets a pack of its own
+    assert pack_chunks(["a" * 10, "b"], max_total_chars=5) == [[0], [1]]
+
+def test_plan_is_bounded_by_answer_chunks_and_source_packs():
+    question, answer, sources = words("q", 500), words("a", 1500), words("s", 20000)
+    plan = plan_groundedness(question, answer, sources, 1500, 6000, 55000)
+    assert len(plan.answer_chunks) == 2 and len(plan.source_packs) == 3
+    assert plan.planned_calls == 6
+    # 3 source chunks x 2 question chunks x 2 answer chunks
+    assert plan.cartesian_calls == 12
+    assert all(called_question == plan.question for called_question, _, _ in plan.calls)
+    assert len(plan.question) <= 1500
+
+def test_grounded_answer_makes_the_planned_calls():
+    client = FakeContentSafetyClient(grounding())
+    question, answer, sources = words("q", 500), words("a", 1500), words("s", 20000)
+    assert check(question, answer, sources, client) == (False, "Prompt passed groundedness check")
+    calls = client.calls("text:detectGroundedness")
+    assert len(calls) == 6
+    for call in calls:
+        assert sum(len(source) for source in call["groundingSources"]) <= safety_checks.MAX_GROUNDEDNESS_SOURCES_LENGTH
+
+def test_ungrounded_answer_stops_the_later_waves(monkeypatch):
+    monkeypatch.setattr(safety_checks, "GROUNDEDNESS_MAX_CONCURRENCY", 2)
+    client = FakeContentSafetyClient(grounding())
+    answer = UNGROUNDED + " " + words("a", 1500)
+    flagged, details = check("Is flooding covered?", answer, words("s", 20000), client)
+    assert flagged and details == {"ungroundedDetected": True}
+    # Six calls planned, only the first wave made
+    assert len(client.calls("text:detectGroundedness")) == 2
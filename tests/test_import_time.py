@@ -0,0 +1,21 @@
+"""
+Worker start: importing the function app (in a fresh interpreter, under
+`python -X importtime`) must not load the modules deferred to first use.
+
+The absolute limit is deliberately generous, since the time depends on the
+machine; benchmarks/import_budget.py holds the tighter baseline check.
+"""
+import os
+import pytest
+
+pytest.importorskip("azure.functions")
+
+from benchmarks.import_budget import measure, deferred_imported, MEASURE_ENV
+
+IMPORT_TIME_TEST_BUDGET_MS = float(os.environ.get("IMPORT_TIME_TEST_BUDGET_MS", "5000"))
+
+@pytest.mark.parametrize("responsible_ai_check", ["false", "true"])
+def test_deferred_modules_are_not_imported_at_start(responsible_ai_check):
+    cumulative, total = measure("function_app", dict(MEASURE_ENV, RESPONSABLE_AI_CHECK=responsible_ai_check))
+    assert deferred_imported(cumulative) == []
+    assert total / 1000 < IMPORT_TIME_TEST_BUDGET_MS
@@ -0,0 +1,74 @@
+"""
+Check policies: invalid profiles are rejected when loaded, and a failing stage
+keeps the checks of later stages from being started.
+"""
+import json
+import asyncio
+import pytest
+from safety_checks.policy import Policy, PolicyError, load_policy, run_profile
+
+def profile(stages, **config):
+    return Policy({"profiles": {"strict": {"answer": {"stages": stages, **config}}}}).profile("answer", "strict")
+
+def factories(results, started):
+    def factory(check_name):
+        async def check():
+            started.append(check_name)
+            return results[check_name], f"{check_name} details"
+        return check
+    return {check_name: factory(check_name) for check_name in results}
+
+def test_default_policy_keeps_the_original_checks():
+    checks = load_policy(None).profile("answer").checks
+    assert checks == ["localPrefilter", "groundedness", "protectedMaterial", "TextAnalysis", "promptShield(sources)", "fairness"]
+
+@pytest.mark.parametrize("stages", [[["fairness"], ["TextAnalysis"]], [["fairness", "jailbreak"], ["TextAnalysis"]]])
+def test_fairness_before_text_analysis_is_rejected(stages):
+    with pytest.raises(PolicyError, match="fairness"):
+        profile(stages)
+
+def test_fairness_with_text_analysis_is_accepted():
+    assert profile([["TextAnalysis", "fairness"]]).checks == ["TextAnalysis", "fairness"]
+
+@pytest.mark.parametrize("stages,config", [
+    ([["jailbreak"], ["jailbreak"]], {}),
+    ([["groundedness", "protectedMaterial"]], {"requires": {"groundedness": ["protectedMaterial"]}}),
+    ("jailbreak", {}),
+])
+def test_invalid_profiles_are_rejected(stages, config):
+    with pytest.raises(PolicyError):
+        profile(stages, **config)
+
+def test_unknown_profile_and_route_are_rejected(tmp_path):
+    with pytest.raises(PolicyError, match="Unknown check profile"):
+        load_policy(None).profile("answer", "missing")
+    path = tmp_path / "policy.json"
+    path.write_text(json.dumps({"profiles": {"strict": {"header": {"checks": []}}}}), encoding="utf-8")
+    with pytest.raises(PolicyError, match="unknown route"):
+        load_policy(str(path))
+
+def test_failed_stage_skips_the_later_stages():
+    started = []
+    results = {"localPrefilter": True, "groundedness": False, "TextAnalysis": False}
+    strict = profile([["localPrefilter"], ["groundedness", "TextAnalysis"]])
+    check_results, details = asyncio.run(run_profile(strict, factories(results, started)))
+    assert started == ["localPrefilter"]
+    assert check_results == {"localPrefilter": "Failed", "groundedness": "Skipped", "TextAnalysis": "Skipped"}
+    assert details["groundedness"] == "Skipped after localPrefilter failed"
+
+def test_short_input_and_unmet_requirements_skip_a_check():
+    started = []
+    results = {"jailbreak": True, "promptShield(Question)": False, "TextAnalysis": False}
+    lenient = profile([["jailbreak"], ["promptShield(Question)", "TextAnalysis"]], stop_after_failure=False,
+                      min_length={"TextAnalysis": 50}, requires={"promptShield(Question)": ["jailbreak"]})
+    check_results, details = asyncio.run(run_profile(lenient, factories(results, started), lengths={"TextAnalysis": 10}))
+    assert started == ["jailbreak"]
+    assert details["promptShield(Question)"] == "Requires jailbreak to pass"
+    assert details["TextAnalysis"] == "Input is shorter than 50 characters"
+
+def test_severity_threshold_fails_a_passing_check():
+    async def text_analysis():
+        return False, {"categoriesAnalysis": [{"category": "Hate", "severity": 2}, {"category": "Violence", "severity": 0}]}
+    strict = profile([["TextAnalysis"]], severity_thresholds={"TextAnalysis": {"Hate": 2, "*": 4}})
+    check_results, _ = asyncio.run(run_profile(strict, {"TextAnalysis": text_analysis}))
+    assert check_results == {"TextAnalysis": "Failed"}
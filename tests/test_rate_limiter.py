@@ -0,0 +1,95 @@
+"""
+Content Safety scheduler: throttled calls back off and slow the limiters down,
+client errors are not retried, and concurrency stays within the caps.
+"""
+import time
+import asyncio
+import pytest
+
+pytest.importorskip("azure.core")
+
+from fakes import FakeResponse
+from azure.core.exceptions import HttpResponseError
+from shared import rate_limiter
+from shared.rate_limiter import RequestScheduler, parse_retry_after
+from shared.deadline import deadline_scope, DeadlineExceeded
+
+ENDPOINT = "https://a.cognitiveservices.azure.com"
+OPERATION = "text:shieldPrompt"
+
+def responses(*statuses, headers=None):
+    """An attempt returning a FakeResponse with each status in turn; the statuses seen are recorded."""
+    remaining = list(statuses)
+    seen = []
+    async def attempt():
+        status = remaining.pop(0)
+        seen.append(status)
+        return FakeResponse(status, headers=headers if status == 429 else None)
+    return attempt, seen
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RETRY_BASE_DELAY_SECONDS", 0.01)
+
+@pytest.mark.parametrize("headers,expected", [
+    ({"retry-after-ms": "250"}, 0.25),
+    ({"Retry-After": "2"}, 2),
+    ({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, None),
+    (None, None),
+])
+def test_retry_after_headers(headers, expected):
+    assert parse_retry_after(headers) == expected
+
+def test_throttled_call_is_retried_after_retry_after():
+    scheduler = RequestScheduler()
+    attempt, seen = responses(429, 200, headers={"retry-after-ms": "100"})
+    start = time.monotonic()
+    response = asyncio.run(scheduler.run(ENDPOINT, OPERATION, attempt))
+    assert response.status_code == 200 and seen == [429, 200]
+    assert time.monotonic() - start >= 0.1
+    assert scheduler.retries == 1
+    limiter = scheduler.stats()["limiters"][f"{ENDPOINT}|{OPERATION}"]
+    assert limiter["throttled"] == 1
+    # Halved on the 429, then grown back by 5% of the configured rate on the success
+    assert limiter["current_rps"] == pytest.approx(rate_limiter.CONTENT_SAFETY_OPERATION_RPS * 0.55)
+
+def test_client_error_is_not_retried():
+    scheduler = RequestScheduler()
+    async def attempt():
+        raise HttpResponseError(message="Operation returned 400", response=FakeResponse(400))
+    with pytest.raises(HttpResponseError):
+        asyncio.run(scheduler.run(ENDPOINT, OPERATION, attempt))
+    assert scheduler.retries == 0
+
+def test_last_retryable_response_is_returned(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_MAX_RETRIES", 2)
+    scheduler = RequestScheduler()
+    attempt, seen = responses(503, 503, 503)
+    response = asyncio.run(scheduler.run(ENDPOINT, OPERATION, attempt))
+    assert response.status_code == 503 and seen == [503, 503, 503]
+
+def test_no_retry_past_the_deadline():
+    scheduler = RequestScheduler()
+    attempt, seen = responses(429, 200, headers={"Retry-After": "5"})
+    async def main():
+        with deadline_scope(500):
+            await scheduler.run(ENDPOINT, OPERATION, attempt)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(main())
+    assert seen == [429]
+    assert time.monotonic() - start < 0.5
+
+def test_endpoint_concurrency_is_capped(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "CONTENT_SAFETY_ENDPOINT_CONCURRENCY", 3)
+    scheduler = RequestScheduler()
+    in_flight = []
+    async def attempt():
+        in_flight.append(scheduler.stats()["limiters"][ENDPOINT]["in_flight"])
+        await asyncio.sleep(0.01)
+        return FakeResponse(200)
+    async def main():
+        await asyncio.gather(*(scheduler.run(ENDPOINT, OPERATION, attempt) for _ in range(12)))
+    asyncio.run(main())
+    assert len(in_flight) == 12
+    assert max(in_flight) == 3
@@ -0,0 +1,44 @@
+"""
+Fail-fast evaluation: once a check fails, the checks still running are
+cancelled and reported as Skipped, and a flagged chunk cancels its siblings.
+"""
+import asyncio
+import pytest
+from safety_checks.runner import run_checks, run_chunk_checks, CheckSkipped
+
+async def verdict(result, delay=0, ran=None, name=None):
+    await asyncio.sleep(delay)
+    if ran is not None:
+        ran.append(name)
+    return result, f"{name} details"
+
+def test_failure_skips_the_checks_still_running():
+    ran = []
+    checks = [verdict(True, 0.01, ran, "Prompt Shield"), verdict(False, 1, ran, "Fairness"), verdict(False, 0, ran, "Text Analysis")]
+    check_results, details = asyncio.run(run_checks(checks, ["Prompt Shield", "Fairness", "Text Analysis"], fail_fast=True))
+    assert check_results == {"Prompt Shield": "Failed", "Fairness": "Skipped", "Text Analysis": "Passed"}
+    assert details["Fairness"] == "Skipped after Prompt Shield failed"
+    assert "Fairness" not in ran
+
+def test_without_fail_fast_every_check_completes():
+    checks = [verdict(True, 0.01, name="Prompt Shield"), verdict(False, 0.05, name="Fairness")]
+    check_results, _ = asyncio.run(run_checks(checks, ["Prompt Shield", "Fairness"], fail_fast=False))
+    assert check_results == {"Prompt Shield": "Failed", "Fairness": "Passed"}
+
+def test_skipped_check_reports_its_own_status():
+    async def not_applicable():
+        raise CheckSkipped("NotApplicable", "no sources")
+    check_results, details = asyncio.run(run_checks([not_applicable()], ["Groundedness"], fail_fast=True))
+    assert check_results == {"Groundedness": "NotApplicable"}
+    assert details == {"Groundedness": "no sources"}
+
+def test_flagged_chunk_cancels_the_other_chunks():
+    ran = []
+    async def main():
+        # run_checks sets the mode that the chunk checks inherit
+        async def check():
+            return (await run_chunk_checks([verdict(True, 0.01, ran, 0), verdict(False, 1, ran, 1), verdict(False, 0, ran, 2)]))[0]
+        return await run_checks([check()], ["Prompt Shield"], fail_fast=True)
+    check_results, _ = asyncio.run(main())
+    assert check_results == {"Prompt Shield": "Failed"}
+    assert sorted(ran) == [0, 2]
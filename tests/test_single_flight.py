@@ -0,0 +1,112 @@
+"""
+Single flight: concurrent callers for one key share a single call, which
+survives the cancellation of any caller but the last.
+"""
+import asyncio
+import pytest
+from safety_checks import single_flight as module
+from safety_checks.single_flight import SingleFlight
+
+class Load:
+    """A call that counts its starts and answers once `release` is set."""
+
+    def __init__(self):
+        self.started = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.started += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return (False, "clean")
+
+def test_concurrent_callers_share_one_call():
+    single_flight = SingleFlight(enabled=True)
+    async def main():
+        load = Load()
+        callers = [asyncio.ensure_future(single_flight.do("key", load, label="promptShield")) for _ in range(5)]
+        await asyncio.sleep(0)
+        load.release.set()
+        return load, await asyncio.gather(*callers)
+    load, results = asyncio.run(main())
+    assert load.started == 1
+    assert results == [(False, "clean")] * 5
+    assert single_flight.stats() == {"promptShield": {"calls": 1, "collapsed": 4, "shared_collapsed": 0}}
+
+def test_cancelled_leader_does_not_cancel_the_call_for_a_waiter():
+    single_flight = SingleFlight(enabled=True)
+    async def main():
+        load = Load()
+        leader = asyncio.ensure_future(single_flight.do("key", load))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(single_flight.do("key", load))
+        await asyncio.sleep(0)
+        # e.g. fail-fast cancelled the leader's request
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        load.release.set()
+        return load, leader, await waiter
+    load, leader, result = asyncio.run(main())
+    assert leader.cancelled()
+    assert result == (False, "clean")
+    assert load.started == 1 and not load.cancelled
+
+def test_call_is_cancelled_with_its_last_caller():
+    single_flight = SingleFlight(enabled=True)
+    async def main():
+        load = Load()
+        callers = [asyncio.ensure_future(single_flight.do("key", load)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        # The next caller starts a new call rather than joining the cancelled one
+        second = Load()
+        second.release.set()
+        return load, await single_flight.do("key", second), second
+    load, result, second = asyncio.run(main())
+    assert load.cancelled
+    assert result == (False, "clean") and second.started == 1
+
+def test_failure_is_shared_then_forgotten():
+    single_flight = SingleFlight(enabled=True)
+    calls = []
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0)
+        raise RuntimeError("503")
+    async def main():
+        results = await asyncio.gather(*(single_flight.do("key", failing) for _ in range(3)), return_exceptions=True)
+        assert [str(result) for result in results] == ["503"] * 3
+        with pytest.raises(RuntimeError):
+            await single_flight.do("key", failing)
+    asyncio.run(main())
+    assert len(calls) == 2
+
+def test_verdict_of_another_worker_is_polled_from_the_shared_store(monkeypatch):
+    monkeypatch.setattr(module, "SINGLE_FLIGHT_POLL_SECONDS", 0.01)
+
+    class LockedStore:
+        """Another worker holds the lock and writes its verdict after two polls."""
+        def __init__(self):
+            self.polls = 0
+        async def try_lock(self, key, ttl):
+            return False
+        async def is_locked(self, key):
+            return True
+        async def lookup(self):
+            self.polls += 1
+            return (False, "from another worker") if self.polls >= 2 else None
+
+    store = LockedStore()
+    single_flight = SingleFlight(shared=store, enabled=True, shared_lock=True)
+    load = Load()
+    result = asyncio.run(single_flight.do("key", load, lookup=store.lookup, label="promptShield"))
+    assert result == (False, "from another worker")
+    assert load.started == 0
+    assert single_flight.stats()["promptShield"]["shared_collapsed"] == 1